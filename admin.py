@@ -1,12 +1,29 @@
 from django.contrib import admin
 
-from .models import Announcement
+from .models import Announcement, ArchivedAnnouncement
 
 
 class AnnouncementAdmin(admin.ModelAdmin):
-    list_display = ('subject', 'visible_from', 'visible_to', 'is_urgent', 'audience', 'programme', 'created', 'modified')
+    list_display = ('subject', 'visible_from', 'visible_to', 'is_urgent', 'audience', 'programme', 'read_count',
+                    'recipient_count', 'created', 'modified')
+    list_select_related = ('programme',)
     list_filter = ('visible_from', 'visible_to', 'is_urgent', 'audience', 'programme', 'created', 'modified')
     search_fields = ('subject', 'body', 'user__first_name', 'user__last_name', 'user__username')
 
 
+class ArchivedAnnouncementAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'visible_from', 'visible_to', 'is_urgent', 'audience', 'programme', 'read_count',
+                    'recipient_count', 'created', 'archived')
+    list_select_related = ('programme',)
+    list_filter = ('visible_from', 'visible_to', 'is_urgent', 'audience', 'programme', 'archived')
+    search_fields = ('subject', 'body', 'user__first_name', 'user__last_name', 'user__username')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
 admin.site.register(Announcement, AnnouncementAdmin)
+admin.site.register(ArchivedAnnouncement, ArchivedAnnouncementAdmin)
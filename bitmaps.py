@@ -0,0 +1,195 @@
+from array import array
+from struct import Struct
+
+try:
+    from pyroaring import BitMap
+except ImportError:
+    BitMap = None
+
+
+# containers switch from a sorted array of low halves to a 2**16 bit bitset past this many members, as in roaring
+array_max_size = 4096
+
+_header = Struct('<HBI')
+
+
+class RoaringBitmap:
+
+    # a set of unsigned 32 bit ints, split by their high 16 bits into containers holding the low 16 bits
+    def __init__(self, values=()):
+        self._containers = {}
+        for value in values:
+            self.add(value)
+
+    def add(self, value):
+        high, low = value >> 16, value & 0xffff
+        container = self._containers.get(high)
+        if container is None:
+            self._containers[high] = array('H', [low])
+        elif isinstance(container, int):
+            self._containers[high] = container | (1 << low)
+        else:
+            i = _bisect(container, low)
+            if i == len(container) or container[i] != low:
+                container.insert(i, low)
+                if len(container) > array_max_size:
+                    self._containers[high] = _to_bitset(container)
+
+    def discard(self, value):
+        high, low = value >> 16, value & 0xffff
+        container = self._containers.get(high)
+        if container is None:
+            return
+        if isinstance(container, int):
+            container &= ~(1 << low)
+            if bin(container).count('1') <= array_max_size:
+                container = _to_array(container)
+            self._containers[high] = container
+        else:
+            i = _bisect(container, low)
+            if i < len(container) and container[i] == low:
+                del container[i]
+        if not container:
+            del self._containers[high]
+
+    def __contains__(self, value):
+        container = self._containers.get(value >> 16)
+        if container is None:
+            return False
+        low = value & 0xffff
+        if isinstance(container, int):
+            return bool(container >> low & 1)
+        i = _bisect(container, low)
+        return i < len(container) and container[i] == low
+
+    def __len__(self):
+        return sum(bin(c).count('1') if isinstance(c, int) else len(c) for c in self._containers.values())
+
+    def __iter__(self):
+        for high in sorted(self._containers):
+            container = self._containers[high]
+            lows = _to_array(container) if isinstance(container, int) else container
+            for low in lows:
+                yield high << 16 | low
+
+    def __and__(self, other):
+        result = RoaringBitmap()
+        for high in self._containers.keys() & other._containers.keys():
+            _set(result, high, _as_bitset(self._containers[high]) & _as_bitset(other._containers[high]))
+        return result
+
+    def __sub__(self, other):
+        result = RoaringBitmap()
+        for high, container in self._containers.items():
+            if high in other._containers:
+                _set(result, high, _as_bitset(container) & ~_as_bitset(other._containers[high]))
+            else:
+                result._containers[high] = _copy(container)
+        return result
+
+    def __or__(self, other):
+        result = RoaringBitmap()
+        for high in self._containers.keys() | other._containers.keys():
+            _set(
+                result,
+                high,
+                _as_bitset(self._containers.get(high, array('H'))) | _as_bitset(other._containers.get(high, array('H')))
+            )
+        return result
+
+    def __eq__(self, other):
+        return isinstance(other, RoaringBitmap) and list(self) == list(other)
+
+    def serialize(self):
+        parts = []
+        for high in sorted(self._containers):
+            container = self._containers[high]
+            if isinstance(container, int):
+                parts.append(_header.pack(high, 1, bin(container).count('1')))
+                parts.append(container.to_bytes(8192, 'little'))
+            else:
+                parts.append(_header.pack(high, 0, len(container)))
+                parts.append(_little_endian(container).tobytes())
+        return b''.join(parts)
+
+    @classmethod
+    def deserialize(cls, data):
+        bitmap = cls()
+        offset = 0
+        while offset < len(data):
+            high, kind, size = _header.unpack_from(data, offset)
+            offset += _header.size
+            if kind == 1:
+                bitmap._containers[high] = int.from_bytes(data[offset:offset + 8192], 'little')
+                offset += 8192
+            else:
+                container = array('H')
+                container.frombytes(data[offset:offset + 2 * size])
+                bitmap._containers[high] = _little_endian(container)
+                offset += 2 * size
+        return bitmap
+
+
+def get_bitmap_class():
+    # pyroaring when it is installed, which has the same interface
+    return BitMap if BitMap is not None else RoaringBitmap
+
+
+def bitmap_format(cls=None):
+    # stored with each serialized bitmap, so one written by the other implementation is rebuilt rather than misread
+    return 'pyroaring' if (cls or get_bitmap_class()) is BitMap else 'roaring'
+
+
+def _bisect(container, low):
+    lo, hi = 0, len(container)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if container[mid] < low:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _to_bitset(container):
+    bitset = 0
+    for low in container:
+        bitset |= 1 << low
+    return bitset
+
+
+def _to_array(bitset):
+    lows = array('H')
+    low = 0
+    while bitset:
+        if bitset & 1:
+            lows.append(low)
+        # skip runs of unset bits a byte at a time
+        if not bitset & 0xff:
+            bitset >>= 8
+            low += 8
+        else:
+            bitset >>= 1
+            low += 1
+    return lows
+
+
+def _as_bitset(container):
+    return container if isinstance(container, int) else _to_bitset(container)
+
+
+def _set(bitmap, high, bitset):
+    if bitset:
+        size = bin(bitset).count('1')
+        bitmap._containers[high] = bitset if size > array_max_size else _to_array(bitset)
+
+
+def _copy(container):
+    return container if isinstance(container, int) else array('H', container)
+
+
+def _little_endian(container):
+    if array('H', [1]).tobytes() != b'\x01\x00':
+        container = array('H', container)
+        container.byteswap()
+    return container
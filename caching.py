@@ -0,0 +1,118 @@
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from random import uniform
+from threading import Lock
+from time import sleep, time
+
+from django.conf import settings
+
+from .routers import reads_from_primary
+from .tracing import current_span
+
+# hits, stale, misses and refreshes per cache name, for this process
+stats = Counter()
+
+_missing = object()
+
+_request_memo = ContextVar('announcements_request_memo', default=None)
+
+
+def get_or_compute(cache, name, key, compute, version=None, timeout=300, valid=None, entry=_missing):
+    # entries keep the version they were computed at and when they stop being fresh, and outlive that by
+    # ANNOUNCEMENTS_CACHE_STALE_TIMEOUT so one process refreshes them while the others are served the stale value.
+    # timeout may be a function of the computed value, valid a check the value still applies to this call
+    if entry is _missing:
+        entry = cache.get(key)
+    usable = entry is not None and (valid is None or valid(entry['value']))
+    if usable and entry['version'] == version and time() < entry['fresh_until']:
+        return _count(name, 'hits', entry['value'])
+
+    lock_key = '%s.lock' % key
+    locked = cache.add(lock_key, 1, getattr(settings, 'ANNOUNCEMENTS_CACHE_LOCK_TIMEOUT', 10))
+    if not locked:
+        if usable:
+            return _count(name, 'stale', entry['value'])
+
+        # nothing to serve yet, wait briefly for the process holding the lock, then compute without it rather than
+        # hold up the request for as long as the other build takes
+        deadline = time() + getattr(settings, 'ANNOUNCEMENTS_CACHE_LOCK_WAIT', 1)
+        while time() < deadline:
+            sleep(0.05)
+            entry = cache.get(key)
+            if entry is not None and entry['version'] == version and (valid is None or valid(entry['value'])):
+                return _count(name, 'hits', entry['value'])
+
+    try:
+        # shared values are built from the primary, so replica lag is never cached
+        with reads_from_primary():
+            value = compute()
+        fresh = timeout(value) if callable(timeout) else timeout
+        if fresh > 0:
+            # jittered, so entries computed together do not all expire together
+            fresh *= uniform(1 - getattr(settings, 'ANNOUNCEMENTS_CACHE_JITTER', 0.1), 1)
+            cache.set(
+                key,
+                {'value': value, 'version': version, 'fresh_until': time() + fresh},
+                int(fresh) + getattr(settings, 'ANNOUNCEMENTS_CACHE_STALE_TIMEOUT', 60)
+            )
+    finally:
+        # only a lock this call took, never one another process holds
+        if locked:
+            cache.delete(lock_key)
+    return _count(name, 'refreshes' if entry is not None else 'misses', value)
+
+
+class LRUCache:
+
+    # a bounded in-process cache whose entries are only returned at the version they were stored with
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                stats[self.name, 'misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+        return _count(self.name, 'hits', entry[1])
+
+    def set(self, key, version, value):
+        with self._lock:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+@contextmanager
+def request_memo():
+    # values memoised inside the block are computed once, including by threads run with a copy of its context
+    token = _request_memo.set({})
+    try:
+        yield
+    finally:
+        _request_memo.reset(token)
+
+
+def memoised(key, compute):
+    memo = _request_memo.get()
+    if memo is None:
+        return compute()
+    if key not in memo:
+        memo[key] = compute()
+    return memo[key]
+
+
+def _count(name, outcome, value):
+    stats[name, outcome] += 1
+    current_span().set(cache=outcome)
+    return value
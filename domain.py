@@ -1,25 +1,103 @@
-from datetime import datetime, time
+import asyncio
+import contextvars
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time, timedelta, timezone
 from functools import partial, reduce
+from hashlib import sha1
 from itertools import groupby
+from logging import getLogger
+from threading import Lock, Thread
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core import signing
 from django.core.cache import caches
-from django.db.models import Count, Q, Case, When, Value
-from django.db.models.functions import Concat
+from django.db import close_old_connections, connection, connections, transaction
+from django.db.models import (BooleanField, CharField, Count, Exists, F, Max, Min, OuterRef, Q, Case, Subquery, When,
+                              Value)
+from django.db.models.functions import Coalesce, Concat
+from django.dispatch import Signal
 from django.utils.timezone import now, make_aware
 from django.utils.translation import gettext as _
 
-from rest_framework.exceptions import PermissionDenied
+from rest_framework.exceptions import PermissionDenied, ValidationError
 
 from .models import AUDIENCES
 from programmes.domain import get_scheduled_course_and_group_memberships_from_cache, course_and_group_memberships_cache_key
-from programmes.models import Programme, ProgrammeMasterCourse, MasterCourse, ScheduledCourse, ScheduledCourseGroup
-from announcements.models import Announcement, UserAnnouncement
+from programmes.models import Programme, UserProgramme, ProgrammeMasterCourse, MasterCourse, ScheduledCourse, ScheduledCourseGroup
+from announcements.models import (Announcement, UserAnnouncement, ArchivedAnnouncement, ArchivedUserAnnouncement,
+                                  AnnouncementTombstone, AnnouncementReaders)
+from .bitmaps import get_bitmap_class, bitmap_format
+from .caching import get_or_compute, memoised, LRUCache
+from .pubsub import publish, user_channel
+from .readbuffer import get_read_buffer
+from .routers import reads_from_primary
+from . import readstate
+from .tracing import traced, current_span
 
 announcement_id_prefix = 'AN-'
 
 announcement_chars_truncate = 80
 
+# ids searched by prefix are expanded to ranges up to this many digits
+id_max_digits = 10
+
+# sent once per purged announcement, instead of per-object signals for its read receipts
+announcement_purged = Signal()
+
+sync_token_salt = 'announcements.sync'
+
+visible_cursor_salt = 'announcements.visible'
+
+# changes committed while a sync was being computed are picked up again by the next one
+sync_overlap = timedelta(seconds=5)
+
+# async callers share one bounded pool, so they never hold more database connections than it has threads
+_thread_pool = None
+_thread_pool_lock = Lock()
+
+reach_version_cache_key = 'announcements.reach.version'
+
+# bumped when any announcement changes, and per user when their read state or memberships change
+announcements_version_cache_key = 'announcements.version'
+
+# admin searches, as the ids of their first ANNOUNCEMENTS_SEARCH_CACHE_IDS results and their total
+_search_cache = LRUCache('search', getattr(settings, 'ANNOUNCEMENTS_SEARCH_CACHE_SIZE', 256))
+
+# the columns visibility is decided and ordered on
+visible_announcement_fields = ('id', 'audience', 'programme_id', 'is_urgent', 'visible_from', 'visible_to', 'modified',
+                               'created', 'published')
+
+archived_announcement_fields = ('id', 'subject', 'body', 'visible_from', 'visible_to', 'is_urgent', 'audience',
+                                'programme_id', 'user_id', 'created', 'modified', 'read_count', 'recipient_count')
+
+
+class UserContext:
+
+    # what a user can see depends on, loaded once per request and passed to the visibility functions. Scheduled
+    # course and group memberships are only read from the memberships cache when something asks for them
+    def __init__(self, user, group_names, programme_ids):
+        self.user = user
+        self.group_names = group_names
+        self.programme_ids = programme_ids
+        self._memberships = None
+
+    @property
+    def memberships(self):
+        # the vle course ids the user is a member of, and the (vle course id, vle group id) pairs
+        if self._memberships is None:
+            data = caches['default'].get(course_and_group_memberships_cache_key) or {}
+            username = self.user.username
+            self._memberships = (
+                set(c for c, course in data.items() if username in course.get('members', ())),
+                set(
+                    (c, v) for c, course in data.items() for v, members in course.get('groups', {}).items()
+                    if username in members
+                ),
+            )
+        return self._memberships
+
 
 def fst(list):
     return list[0]
@@ -29,29 +107,102 @@ def snd(list):
     return list[1]
 
 
+@traced(attributes=lambda announcement_serializer, user: {'user_id': user.pk})
 def add_announcement(announcement_serializer, user):
     if announcement_serializer.is_valid(raise_exception=True):
         announcement_serializer.save()
 
 
+@traced(attributes=lambda announcement_serializer, user: {
+    'announcement_id': announcement_serializer.instance.pk,
+    'user_id': user.pk
+})
 def update_announcement(announcement_serializer, user):
     if announcement_serializer.is_valid(raise_exception=True):
         announcement_serializer.save()
 
 
+@traced(attributes=lambda user: {'user_id': user.pk})
+def get_user_context(user):
+    # once per request, and kept in the cache between requests at the versions their group and programme changes bump
+    def load():
+        timeout = getattr(settings, 'ANNOUNCEMENTS_USER_CONTEXT_TIMEOUT', 60)
+        if not timeout:
+            return UserContext(user, *_load_audience_inputs(user))
+        cache = caches['default']
+        key = 'announcements.usercontext.%d' % user.pk
+        version_keys = [announcements_version_cache_key, _user_version_cache_key(user.pk)]
+        cached = cache.get_many(version_keys + [key])
+        group_names, programme_ids = get_or_compute(
+            cache,
+            'user_context',
+            key,
+            partial(_load_audience_inputs, user),
+            version=[cached[k] if k in cached else _get_cache_version(cache, k) for k in version_keys],
+            timeout=timeout,
+            entry=cached.get(key)
+        )
+        return UserContext(user, group_names, programme_ids)
+    return memoised(('user_context', user.pk), load)
+
+
+@traced(attributes=lambda pk: {'announcement_id': pk})
 def get_announcement(pk):
     try:
-        announcement = Announcement.objects.get(pk=pk)
+        announcement = Announcement.objects.get(pk=pk, deleted__isnull=True)
         announcement.display_id = "%s%d" % (announcement_id_prefix, announcement.id)
         return announcement
     except Announcement.DoesNotExist:
         return None
 
 
-def delete_announcement(announcement, user):
-    announcement.delete()
+@traced(attributes=lambda announcement, user, asynchronous=None: {
+    'announcement_id': announcement.pk,
+    'user_id': user.pk
+})
+def delete_announcement(announcement, user, asynchronous=None):
+    if asynchronous is None:
+        asynchronous = getattr(settings, 'ANNOUNCEMENTS_ASYNC_DELETE', False)
+
+    if not asynchronous:
+        purge_announcement(announcement.pk)
+        return
+
+    # tombstone, so the announcement disappears straight away, and purge after the commit
+    announcement.deleted = now()
+    announcement.save(update_fields=['deleted'])
+    transaction.on_commit(lambda: Thread(target=_purge_announcement_in_thread, args=(announcement.pk,), daemon=True).start())
+
+
+@traced(attributes=lambda announcement_id, batch_size=None: {'announcement_id': announcement_id})
+def purge_announcement(announcement_id, batch_size=None):
+    batch_size = batch_size or getattr(settings, 'ANNOUNCEMENTS_DELETE_BATCH_SIZE', 5000)
+
+    # read receipts go in bounded batches, each in its own short transaction
+    user_announcements = 0
+    while True:
+        with transaction.atomic():
+            deleted = _delete_user_announcements_batch(announcement_id, batch_size)
+        user_announcements += deleted
+        if deleted < batch_size:
+            break
 
+    audience = Announcement.objects.filter(pk=announcement_id).values('audience', 'programme_id').first() or {}
+    Announcement.objects.filter(pk=announcement_id).delete()
+    AnnouncementTombstone.objects.create(announcement_id=announcement_id, **audience)
+    announcement_purged.send(sender=Announcement, announcement_id=announcement_id, user_announcements=user_announcements)
+    current_span().set(rows=user_announcements)
+    return user_announcements
 
+
+def purge_deleted_announcements(batch_size=None):
+    announcement_ids = list(Announcement.objects.filter(deleted__isnull=False).values_list('id', flat=True))
+    for announcement_id in announcement_ids:
+        purge_announcement(announcement_id, batch_size)
+    return len(announcement_ids)
+
+
+@traced(attributes=lambda programme_id: {'programme_id': programme_id})
 def get_announcement_options(programme_id):
     master_courses = []
     scheduled_courses = []
@@ -73,6 +224,7 @@ def get_announcement_options(programme_id):
     }
 
 
+@traced()
 def get_audiences_and_programmes():
     # get audiences, programmes, programme master courses
     audiences = dict(AUDIENCES)
@@ -101,6 +253,7 @@ def get_audiences_and_programmes():
     }
 
 
+@traced()
 def get_master_courses(master_course_ids):
     # get master courses, scheduled courses
     master_courses = dict(
@@ -130,6 +283,7 @@ def get_master_courses(master_course_ids):
     return master_courses
 
 
+@traced()
 def get_scheduled_courses(scheduled_course_ids):
     # get scheduled courses, scheduled course groups
     scheduled_courses = dict(
@@ -157,6 +311,7 @@ def get_scheduled_courses(scheduled_course_ids):
     return scheduled_courses
 
 
+@traced()
 def get_scheduled_course_groups(scheduled_course_group_ids):
     return dict(
         ScheduledCourseGroup.objects
@@ -165,59 +320,91 @@ def get_scheduled_course_groups(scheduled_course_group_ids):
     )
 
 
-def get_visible_announcements_for_user(user, current_datetime, urgent_only=False):
-    # all announcements within the visible datetime range
-    announcements = Announcement \
-        .objects \
-        .filter(visible_from__lte=current_datetime, visible_to__gte=current_datetime) \
-        .select_related('programme') \
-        .order_by('-is_urgent', '-visible_from')
-
-    if urgent_only:
-        announcements = announcements.filter(is_urgent=True)
-
-    # announcements visible to a specific group
-    announcements = filter(
-        partial(_audience, user=user),
-        announcements
-    )
+@traced(attributes=lambda user, current_datetime, urgent_only=False, context=None: {
+    'user_id': user.pk,
+    'urgent_only': urgent_only
+})
+def get_visible_announcements_for_user(user, current_datetime, urgent_only=False, context=None):
+    # users with the same groups and programmes see the same announcements, so the list is shared by the cohort
+    context = context or get_user_context(user)
+    group_names, programme_ids = context.group_names, context.programme_ids
+    signature = sha1(_audience_signature(group_names, programme_ids).encode()).hexdigest()
+
+    def compute():
+        # the list holds for any time between the boundaries either side of current_datetime
+        lower, upper = _visibility_window(current_datetime)
+        # without the subject and body, which are loaded for the rows actually returned
+        return lower, upper, [
+            a for a in Announcement
+            .objects
+            .filter(visible_from__lte=current_datetime, visible_to__gte=current_datetime, deleted__isnull=True)
+            .only(*visible_announcement_fields)
+            .order_by('-is_urgent', '-visible_from')
+            if _visible_to_audience(a, group_names, programme_ids)
+        ]
 
-    # announcements visible to a specific programme
-    announcements = filter(
-        partial(_programme, user=user),
-        announcements
+    cache = caches['default']
+    key = 'announcements.cohort.%s' % signature
+    cached = cache.get_many([announcements_version_cache_key, key])
+    _lower, _upper, announcements = get_or_compute(
+        cache,
+        'cohort',
+        key,
+        compute,
+        version=cached.get(announcements_version_cache_key) or _get_cache_version(cache, announcements_version_cache_key),
+        timeout=getattr(settings, 'ANNOUNCEMENTS_COHORT_CACHE_TIMEOUT', 3600),
+        valid=lambda window: window[0] < current_datetime < window[1],
+        entry=cached.get(key)
     )
 
+    if urgent_only:
+        announcements = [a for a in announcements if a.is_urgent]
     return announcements
 
 
-def get_announcements_marked_read_for_user(visible_announcements, user, limit=30):
-    user_announcements = UserAnnouncement \
-        .objects \
-        .filter(user=user) \
-        .filter(announcement__id__in=list(map(lambda va: va.id, visible_announcements)))
+@traced(attributes=lambda visible_announcements, user, limit=30, with_text=True, context=None: {
+    'user_id': user.pk,
+    'limit': limit
+})
+def get_announcements_marked_read_for_user(visible_announcements, user, limit=30, with_text=True, context=None):
+    visible_announcements = list(visible_announcements)
+    if readstate.uses_watermarks():
+        marked_read = readstate.get_marked_read(user, visible_announcements, _visible_for(user, context))
+    else:
+        marked_read = dict(
+            UserAnnouncement
+            .objects
+            .filter(user=user)
+            .filter(announcement__id__in=list(map(lambda va: va.id, visible_announcements)))
+            .values_list('announcement_id', 'created')
+        )
+
+    # the user sees their own buffered writes before they are flushed
+    read_buffer = get_read_buffer()
+    if read_buffer is not None:
+        for announcement_id, buffered in read_buffer.pending_for_user(user.pk).items():
+            if buffered is None:
+                marked_read.pop(announcement_id, None)
+            else:
+                marked_read[announcement_id] = buffered
 
     def to_dict(visible_announcement):
-        user_announcement = user_announcements.get(announcement=visible_announcement) \
-            if user_announcements.filter(announcement=visible_announcement).exists() \
-            else None
         modified = visible_announcement.modified \
             if visible_announcement.modified > visible_announcement.created \
             else None
         return {
             'id': visible_announcement.id,
-            'subject': visible_announcement.subject,
-            'body': visible_announcement.body,
             'visible_from': visible_announcement.visible_from,
             'is_urgent': visible_announcement.is_urgent,
             'modified': modified,
-            'marked_read': None if user_announcement is None else user_announcement.created,
+            'marked_read': marked_read.get(visible_announcement.id),
         }
 
     def always_include(user_announcement):
         return user_announcement['is_urgent'] or user_announcement['marked_read'] is None
 
     all_announcements = list(map(to_dict, visible_announcements))
+    current_span().set(rows=len(all_announcements))
     extra_limit = max(0, limit - len(list(filter(always_include, all_announcements))))
 
     def f(user_announcement):
@@ -227,65 +414,529 @@ def get_announcements_marked_read_for_user(visible_announcements, user, limit=30
         return always_inc or f.extra_count <= extra_limit
     f.extra_count = 0
 
-    return filter(f, all_announcements)
+    returned = list(filter(f, all_announcements))
+    if with_text:
+        _add_subject_and_body(returned, visible_announcements)
+    return iter(returned)
+
+
+@traced(attributes=lambda user, current_datetime, cursor=None, limit=30, context=None: {
+    'user_id': user.pk,
+    'limit': limit
+})
+def get_visible_announcements_page_for_user(user, current_datetime, cursor=None, limit=30, context=None):
+    # the first page is every urgent and unread announcement and the newest read ones up to limit in all, as
+    # get_announcements_marked_read_for_user returns; the cursor then pages back through older read announcements.
+    # Both are ordered and limited in the database, as two bounded queries merged here
+    try:
+        limit = min(max(int(limit), 1), 100)
+    except ValueError:
+        raise ValidationError(_('Invalid page size'))
+    context = context or get_user_context(user)
+    announcements = Announcement.objects \
+        .filter(visible_from__lte=current_datetime, visible_to__gte=current_datetime, deleted__isnull=True) \
+        .filter(_visible_to_audience_q(context.group_names, context.programme_ids)) \
+        .annotate(is_read=_is_read_expression(user, context)) \
+        .only(*visible_announcement_fields)
+    order_by = ('-is_urgent', '-visible_from', '-id')
+
+    read = announcements.filter(is_urgent=False, is_read=True).order_by(*order_by)
+    if cursor:
+        visible_from, pk = _parse_visible_cursor(cursor)
+        if visible_from is not None:
+            read = read.filter(Q(visible_from__lt=visible_from) | Q(visible_from=visible_from, id__lt=pk))
+        always = []
+        read_limit = limit
+    else:
+        always = list(announcements.filter(Q(is_urgent=True) | Q(is_read=False)).order_by(*order_by))
+        read_limit = max(0, limit - len(always))
+
+    # one more than is needed, to know whether there is a next page
+    read = list(read[:read_limit + 1])
+    more, read = len(read) > read_limit, read[:read_limit]
+    page = sorted(always + read, key=lambda a: (a.is_urgent, a.visible_from, a.id), reverse=True)
+
+    current_span().set(rows=len(page))
+    return {
+        'announcements': list(get_announcements_marked_read_for_user(page, user, limit=len(page), context=context)),
+        'next': signing.dumps(
+            [read[-1].visible_from.isoformat(), read[-1].id] if read else [None, None],
+            salt=visible_cursor_salt
+        ) if more else None,
+    }
+
+
+async def aget_visible_announcements_for_user(user, current_datetime, urgent_only=False, context=None):
+    return await run_in_thread_pool(
+        lambda: list(get_visible_announcements_for_user(user, current_datetime, urgent_only, context))
+    )
+
+
+async def aget_announcements_marked_read_for_user(visible_announcements, user, limit=30, with_text=True, context=None):
+    return await run_in_thread_pool(
+        lambda: list(get_announcements_marked_read_for_user(visible_announcements, user, limit, with_text, context))
+    )
 
 
+async def amark_announcement_read_for_user(announcement_id, user):
+    return await run_in_thread_pool(mark_announcement_read_for_user, announcement_id, user)
+
+
+async def amark_announcement_unread_for_user(announcement_id, user):
+    return await run_in_thread_pool(mark_announcement_unread_for_user, announcement_id, user)
+
+
+async def run_in_thread_pool(func, *args):
+    # in a copy of the caller's context, so its database routing applies in the thread
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        _get_thread_pool(),
+        partial(context.run, _call_with_connection, func, *args)
+    )
+
+
+def map_in_thread_pool(func, items):
+    # the sync counterpart of run_in_thread_pool, calling func on each item concurrently
+    pool = _get_thread_pool()
+    futures = [pool.submit(contextvars.copy_context().run, _call_with_connection, func, item) for item in items]
+    return [future.result() for future in futures]
+
+
+@traced(attributes=lambda announcement_id, user: {'announcement_id': announcement_id, 'user_id': user.pk})
 def mark_announcement_read_for_user(announcement_id, user):
+    read_buffer = get_read_buffer()
+    if read_buffer is not None:
+        announcement = Announcement.objects.get(pk=announcement_id)
+        marked_read = now()
+        _buffer_read_state(read_buffer, announcement_id, user, marked_read)
+        return _marked_read_dict(announcement, marked_read)
+
+    if readstate.uses_watermarks():
+        announcement = Announcement.objects.get(pk=announcement_id)
+        if readstate.mark_read(user, announcement, _visible_for(user)):
+            Announcement.objects.filter(pk=announcement_id).update(read_count=F('read_count') + 1)
+            _announcement_readers_changed(announcement_id, read=[user.pk])
+        _read_state_changed(user, announcement_id, 'read')
+        return _marked_read_dict(announcement, now())
+
     user_announcement, created = UserAnnouncement.objects.get_or_create(
         announcement_id=announcement_id,
         user=user
     )
-    user_announcement.created = now()
-    user_announcement.save()
-    return {
-        'id': announcement_id,
-        'subject': user_announcement.announcement.subject,
-        'body': user_announcement.announcement.body,
-        'visible_from': user_announcement.announcement.visible_from,
-        'is_urgent': user_announcement.announcement.is_urgent,
-        'modified': user_announcement.announcement.modified,
-        'marked_read': user_announcement.created
-    }
+    if created:
+        Announcement.objects.filter(pk=announcement_id).update(read_count=F('read_count') + 1)
+        _announcement_readers_changed(announcement_id, read=[user.pk])
+    else:
+        user_announcement.created = now()
+        user_announcement.save()
+    invalidate_announcements_cache_for_user(user.pk)
+    return _marked_read_dict(user_announcement.announcement, user_announcement.created)
 
 
+@traced(attributes=lambda announcement_id, user: {'announcement_id': announcement_id, 'user_id': user.pk})
 def mark_announcement_unread_for_user(announcement_id, user):
-    UserAnnouncement.objects.filter(
+    read_buffer = get_read_buffer()
+    if read_buffer is not None:
+        _buffer_read_state(read_buffer, announcement_id, user, None)
+        return
+
+    if readstate.uses_watermarks():
+        announcement = Announcement.objects.filter(pk=announcement_id).first()
+        if announcement is not None and readstate.mark_unread(user, announcement, _visible_for(user)):
+            Announcement.objects.filter(pk=announcement_id, read_count__gt=0).update(read_count=F('read_count') - 1)
+            AnnouncementTombstone.objects.create(announcement_id=announcement_id, user=user)
+            _announcement_readers_changed(announcement_id, unread=[user.pk])
+            _read_state_changed(user, announcement_id, 'unread')
+        return
+
+    deleted, _rows = UserAnnouncement.objects.filter(
         announcement_id=announcement_id,
         user=user
     ).delete()
+    if deleted:
+        Announcement.objects.filter(pk=announcement_id, read_count__gt=0).update(read_count=F('read_count') - 1)
+        AnnouncementTombstone.objects.create(announcement_id=announcement_id, user=user)
+        _announcement_readers_changed(announcement_id, unread=[user.pk])
+        invalidate_announcements_cache_for_user(user.pk)
+
+
+@traced()
+def flush_read_buffer():
+    read_buffer = get_read_buffer()
+    if read_buffer is not None:
+        read_buffer.flush(_apply_read_states)
+
+
+@traced(attributes=lambda user, token, current_datetime: {'user_id': user.pk})
+def get_announcement_changes_for_user(user, token, current_datetime):
+    since, since_audience = _parse_sync_token(token)
+    context = get_user_context(user)
+    audience = _audience_signature(context.group_names, context.programme_ids)
+    changes = {
+        'token': signing.dumps([current_datetime.timestamp(), audience], salt=sync_token_salt),
+        'reset': False,
+        'announcements': [],
+        'removed': [],
+        'read': [],
+    }
 
+    # without a usable token, or one older than the tombstones kept, the client starts again from the full list
+    retention = timedelta(days=getattr(settings, 'ANNOUNCEMENTS_SYNC_RETENTION_DAYS', 30))
+    if since is None or since < current_datetime - retention:
+        visible_announcements = list(get_visible_announcements_for_user(user, current_datetime, context=context))
+        changes['reset'] = True
+        changes['announcements'] = list(get_announcements_marked_read_for_user(
+            visible_announcements,
+            user,
+            context=context
+        ))
+        return changes
+    since -= sync_overlap
 
-def get_announcements(column='', order='', q='', limitfrom=None, limitnum=None):
+    # announcements edited or scheduled to appear since the token, and whether the user can still see them
+    changed = Announcement.objects.filter(
+        Q(modified__gt=since) | Q(visible_from__gt=since, visible_from__lte=current_datetime)
+    )
+    visible_announcements = list(_filter_visible_to_user(changed, context, current_datetime))
+    visible_ids = set(map(lambda a: a.id, visible_announcements))
+
+    # and those the user's group and programme changes since the token made visible or hid
+    joined, left = [], set()
+    if audience != since_audience:
+        joined, left = _audience_change(user, since_audience, context, current_datetime)
+    visible_announcements.extend(a for a in joined if a.id not in visible_ids)
+    visible_announcements.sort(key=lambda a: (a.is_urgent, a.visible_from), reverse=True)
+    visible_ids.update(a.id for a in joined)
+
+    # announcements expired, deleted or no longer visible, of those that existed when the token was issued and
+    # were addressed to the user
+    removed = set(changed.filter(created__lte=since).exclude(id__in=visible_ids).values_list('id', flat=True))
+    removed.update(
+        Announcement.objects
+        .filter(created__lte=since)
+        .filter(Q(visible_to__gt=since, visible_to__lt=current_datetime) | Q(deleted__gt=since))
+        .values_list('id', flat=True)
+    )
+    removed.update(
+        AnnouncementTombstone.objects
+        .filter(user__isnull=True, created__gt=since)
+        .values_list('announcement_id', flat=True)
+    )
+    removed = _addressed_to(context, removed - visible_ids) | left
+
+    # read state changes, the latest of a read receipt or its tombstone winning
+    unread = AnnouncementTombstone.objects \
+        .filter(user=user, created__gt=since) \
+        .values_list('created', 'announcement_id')
+    if readstate.uses_watermarks():
+        marked_read = readstate.get_read_since(user, since, _visible_for(user, context))
+    else:
+        marked_read = UserAnnouncement.objects \
+            .filter(user=user, created__gt=since) \
+            .values_list('created', 'announcement_id')
+    read = {}
+    for created, announcement_id, is_read in sorted(
+        [(c, a, False) for c, a in unread] + [(c, a, True) for c, a in marked_read],
+        key=fst
+    ):
+        read[announcement_id] = created if is_read else None
+
+    changes['announcements'] = list(get_announcements_marked_read_for_user(
+        visible_announcements,
+        user,
+        limit=len(visible_announcements),
+        context=context
+    ))
+    changes['removed'] = sorted(removed)
+    changes['read'] = [
+        {'id': announcement_id, 'marked_read': marked_read}
+        for announcement_id, marked_read in sorted(read.items())
+        if announcement_id not in visible_ids and announcement_id not in removed
+    ]
+    current_span().set(rows=len(changes['announcements']) + len(changes['removed']) + len(changes['read']))
+    return changes
+
+
+@traced(attributes=lambda before: {'before': before})
+def prune_announcement_tombstones(before):
+    deleted, _rows = AnnouncementTombstone.objects.filter(created__lt=before).delete()
+    return deleted
+
+
+@traced(attributes=lambda user, events, checked_from, current_datetime: {'user_id': user.pk, 'rows': len(events)})
+def get_announcement_events_for_user(user, events, checked_from, current_datetime):
+    context = get_user_context(user)
+    user_events = []
+    seen = set()
+
+    def add(event_type, announcement_id):
+        if (event_type, announcement_id) not in seen:
+            seen.add((event_type, announcement_id))
+            user_events.append({'type': event_type, 'announcement_id': announcement_id})
+
+    # events published from the announcement and user announcement signals
+    announcement_ids = [e['announcement_id'] for c, s, e in events if e['type'] in ('created', 'updated')]
+    visible_ids = set(map(lambda a: a.id, _filter_visible_to_user(
+        Announcement.objects.filter(id__in=announcement_ids),
+        context,
+        current_datetime
+    ))) if announcement_ids else set()
+
+    # updates and deletions only remove announcements from the users they were addressed to
+    addressed_ids = _addressed_to(context, set(
+        e['announcement_id'] for c, s, e in events
+        if e['type'] == 'deleted' or e['type'] == 'updated' and e['announcement_id'] not in visible_ids
+    ))
+
+    for channel, seq, event in events:
+        if event['type'] in ('created', 'updated'):
+            if event['announcement_id'] in visible_ids:
+                add('visible' if event['type'] == 'created' else 'updated', event['announcement_id'])
+            elif event['type'] == 'updated' and event['announcement_id'] in addressed_ids:
+                add('removed', event['announcement_id'])
+        elif event['type'] == 'deleted':
+            if event['announcement_id'] in addressed_ids:
+                add('removed', event['announcement_id'])
+        else:
+            add(event['type'], event['announcement_id'])
+
+    # announcements scheduled to become visible since the last check
+    scheduled = Announcement.objects.filter(visible_from__gt=checked_from)
+    for announcement in _filter_visible_to_user(scheduled, context, current_datetime):
+        add('visible', announcement.id)
+
+    return user_events
+
+
+@traced(attributes=lambda column='', order='', q='', limitfrom=None, limitnum=None, include_archived=False: {
+    'column': column,
+    'order': order,
+    'q': q,
+    'include_archived': include_archived
+})
+def get_announcements(column='', order='', q='', limitfrom=None, limitnum=None, include_archived=False):
     # ordering
     order_by = _get_order_by(column, order)
 
-    # create a Q object from the query string
-    q_object = reduce(lambda acc, _q: acc & _get_q_filter(_q), q.split(' '), Q())
-
-    announcements = Announcement\
-        .objects \
-        .filter(q_object) \
-        .select_related('programme') \
-        .annotate(
-            recipient=Case(
-                *_get_recipient_as_conditional_expressions(),
-                default='audience'
-            ),
-            display_id=Concat(Value(announcement_id_prefix), 'id')
-        ) \
-        .order_by(*order_by)
-
-    total = announcements.count()
+    # paging through a search already made only loads the rows on the page
+    cached_ids = getattr(settings, 'ANNOUNCEMENTS_SEARCH_CACHE_IDS', 1000)
+    if cached_ids and order_by[0].lstrip('-') not in ('read_count', 'recipient_count'):
+        key = (' '.join(q.lower().split()), tuple(order_by), include_archived)
+        version = _get_cache_version(caches['default'], announcements_version_cache_key)
+        cached = _search_cache.get(key, version)
+        if cached is None:
+            # from the primary, like the other shared caches
+            with reads_from_primary():
+                announcements, total = _search_announcements(order_by, q, include_archived)
+                # the columns of a union cannot be narrowed once it is ordered by an annotation
+                if include_archived:
+                    ids = [a.id for a in announcements[:cached_ids]]
+                else:
+                    ids = list(announcements.values_list('id', flat=True)[:cached_ids])
+            cached = ids, total
+            _search_cache.set(key, version, cached)
+        ids, total = cached
+        start, end = _page_bounds(limitfrom, limitnum, total)
+        if end <= len(ids) or len(ids) == total:
+            current_span().set(rows=total)
+            return _get_announcements_in_order(ids[start:end], include_archived), total
+
+    announcements, total = _search_announcements(order_by, q, include_archived)
+    current_span().set(rows=total)
 
     # apply limit and offset
     if limitfrom is not None or limitnum is not None:
-        start = int(limitfrom) if limitfrom else 0
-        end = int(limitnum) + start if limitnum else total
+        start, end = _page_bounds(limitfrom, limitnum, total)
         announcements = announcements[start:end]
 
     return announcements, total
 
 
+@traced(attributes=lambda before=None, chunk_size=500: {'before': before, 'chunk_size': chunk_size})
+def archive_expired_announcements(before=None, chunk_size=500):
+    before = before or now()
+    archived_announcements = 0
+    archived_user_announcements = 0
+
+    while True:
+        ids = list(
+            Announcement.objects
+            .filter(visible_to__lt=before, deleted__isnull=True)
+            .order_by('id')
+            .values_list('id', flat=True)[:chunk_size]
+        )
+        if not ids:
+            break
+
+        # each chunk is moved in its own transaction so a run can be interrupted safely
+        with transaction.atomic():
+            archived = list(Announcement.objects.filter(id__in=ids).values(*archived_announcement_fields))
+            ArchivedAnnouncement.objects.bulk_create(ArchivedAnnouncement(**a) for a in archived)
+            archived_user_announcements += _archive_user_announcements(ids)
+            Announcement.objects.filter(id__in=ids).delete()
+            AnnouncementTombstone.objects.bulk_create(
+                AnnouncementTombstone(announcement_id=a['id'], audience=a['audience'], programme_id=a['programme_id'])
+                for a in archived
+            )
+        archived_announcements += len(ids)
+
+    current_span().set(rows=archived_announcements, user_announcement_rows=archived_user_announcements)
+    return archived_announcements, archived_user_announcements
+
+
+@traced(attributes=lambda chunk_size=500: {'chunk_size': chunk_size})
+def reconcile_announcement_counters(chunk_size=500):
+    # recompute the counters from the read receipts and current memberships, returning how many were wrong
+    corrected = 0
+    last_id = 0
+    while True:
+        announcements = list(
+            Announcement.objects
+            .filter(id__gt=last_id)
+            .select_related('programme')
+            .annotate(actual_read_count=_read_count_subquery())
+            .order_by('id')[:chunk_size]
+        )
+        if not announcements:
+            break
+        for announcement in announcements:
+            if readstate.uses_watermarks():
+                # there are no read receipts to count, the read counts are only kept up to date as users read
+                announcement.actual_read_count = announcement.read_count
+            recipient_count = count_announcement_recipients(announcement)
+            if (announcement.read_count, announcement.recipient_count) != (announcement.actual_read_count, recipient_count):
+                Announcement.objects \
+                    .filter(pk=announcement.pk) \
+                    .update(read_count=announcement.actual_read_count, recipient_count=recipient_count)
+                corrected += 1
+        last_id = announcements[-1].id
+
+    # the reader bitmaps are rebuilt from the read state when next needed
+    AnnouncementReaders.objects.all().delete()
+    current_span().set(rows=corrected)
+    return corrected
+
+
+@traced(attributes=lambda audience, programme_id=None: {'audience': audience, 'programme_id': programme_id})
+def get_announcement_reach(audience, programme_id=None):
+    if audience not in dict(AUDIENCES):
+        raise ValidationError(_('Unknown audience %s') % audience)
+    programme = None
+    if programme_id is not None:
+        try:
+            programme_id = int(programme_id)
+        except (TypeError, ValueError):
+            raise ValidationError(_('Programme with id %s does not exist') % programme_id)
+        programme = Programme.objects.filter(pk=programme_id).first()
+        if programme is None:
+            raise ValidationError(_('Programme with id %s does not exist') % programme_id)
+
+    # cached per audience and programme until memberships change
+    cache = caches['default']
+    return get_or_compute(
+        cache,
+        'reach',
+        'announcements.reach.%s.%s' % (audience, programme_id),
+        lambda: _count_announcement_reach(Announcement(audience=audience, programme=programme)),
+        version=_get_cache_version(cache, reach_version_cache_key),
+        timeout=getattr(settings, 'ANNOUNCEMENTS_REACH_CACHE_TIMEOUT', 300)
+    )
+
+
+def invalidate_announcement_reach():
+    # a new version orphans every cached reach, which then expire
+    _bump_cache_version(reach_version_cache_key)
+
+
+@traced(attributes=lambda user, name, current_datetime, build: {'user_id': user.pk, 'cache_name': name})
+def get_cached_for_user(user, name, current_datetime, build):
+    # the cached value is kept with the versions it was built at, so a hit is a single get_many
+    cache = caches['default']
+    key = 'announcements.%s.%d' % (name, user.pk)
+    version_keys = [announcements_version_cache_key, _user_version_cache_key(user.pk)]
+    cached = cache.get_many(version_keys + [key])
+
+    def compute():
+        # the value holds for any time between the boundaries either side of current_datetime, and is never served
+        # outside them, even stale
+        lower, upper = _visibility_window(current_datetime)
+        return lower, upper, build()
+
+    # versions are read first, so a change committed while building makes the entry stale at once
+    _lower, _upper, value = get_or_compute(
+        cache,
+        name,
+        key,
+        compute,
+        version=[cached[k] if k in cached else _get_cache_version(cache, k) for k in version_keys],
+        timeout=lambda window: min(
+            getattr(settings, 'ANNOUNCEMENTS_VISIBLE_CACHE_TIMEOUT', 300),
+            (window[1] - current_datetime).total_seconds()
+        ),
+        valid=lambda window: window[0] < current_datetime < window[1],
+        entry=cached.get(key)
+    )
+    return value
+
+
+def invalidate_announcements_cache():
+    _bump_cache_version(announcements_version_cache_key)
+
+
+def invalidate_announcements_cache_for_user(user_id):
+    _bump_cache_version(_user_version_cache_key(user_id))
+
+
+@traced(attributes=lambda announcement: {'announcement_id': announcement.pk})
+def get_announcement_readers(announcement):
+    # a bitmap of the ids of the users who have read the announcement, built from the read state when first needed
+    # and then brought up to date from the deltas marking it read and unread appends, unless they were lost
+    bitmap_class = get_bitmap_class()
+    # before the read state is read, so deltas past it are applied to a rebuilt bitmap next time
+    seq = _get_cache_version(caches['default'], _readers_log_cache_key(announcement.pk))
+    stored = AnnouncementReaders.objects.filter(announcement=announcement, format=bitmap_format()).first()
+    if stored is not None:
+        readers = _merge_readers_deltas(announcement, stored, seq)
+        if readers is not None:
+            return readers
+
+    if readstate.uses_watermarks():
+        reader_ids = readstate.get_reader_ids(announcement, _get_recipient_ids(announcement))
+    else:
+        reader_ids = UserAnnouncement.objects.filter(announcement=announcement).values_list('user_id', flat=True)
+    readers = bitmap_class(reader_ids)
+    AnnouncementReaders.objects.update_or_create(
+        announcement=announcement,
+        defaults={'format': bitmap_format(), 'bitmap': readers.serialize(), 'version': seq}
+    )
+    return readers
+
+
+@traced(attributes=lambda announcement: {'announcement_id': announcement.pk})
+def get_announcement_read_stats(announcement):
+    recipients = get_bitmap_class()(_get_recipient_ids(announcement))
+    readers = get_announcement_readers(announcement)
+    read = len(recipients & readers)
+    return {
+        'recipients': len(recipients),
+        'read': read,
+        'unread': len(recipients) - read,
+        # users who read it before leaving its audience
+        'other_readers': len(readers) - read,
+    }
+
+
+def get_unread_recipients(announcement):
+    # the recipients yet to read the announcement, for reminders
+    unread = get_bitmap_class()(_get_recipient_ids(announcement)) - get_announcement_readers(announcement)
+    return get_user_model().objects.filter(id__in=list(unread)).order_by('id')
+
+
+def count_announcement_recipients(announcement):
+    return get_announcement_recipients(announcement).values('id').distinct().count()
+
+
+@traced(attributes=lambda announcement: {'announcement_id': announcement.pk})
 def get_announcement_recipients(announcement):
 
     # all active users
@@ -300,49 +951,598 @@ def get_announcement_recipients(announcement):
     return queryset
 
 
-def _audience(announcement, user):
+def _search_announcements(order_by, q, include_archived):
+    # create a Q object from the query string
+    q_object = reduce(lambda acc, _q: acc & _get_q_filter(_q), q.split(' '), Q())
+
+    announcements = _annotate_announcements(Announcement.objects.filter(q_object, deleted__isnull=True), archived=False)
+
+    # archived announcements are opted in to, as a union over the same columns
+    if include_archived:
+        archived = ArchivedAnnouncement.objects.filter(q_object).only(*archived_announcement_fields)
+        announcements = announcements \
+            .only(*archived_announcement_fields) \
+            .union(_annotate_announcements(archived, archived=True), all=True)
+
+    announcements = announcements.order_by(*order_by)
+    return announcements, announcements.count()
+
+
+def _get_announcements_in_order(ids, include_archived):
+    found = _annotate_announcements(Announcement.objects.filter(id__in=ids, deleted__isnull=True), archived=False)
+    by_id = dict((a.id, a) for a in found)
+    if include_archived:
+        archived = _annotate_announcements(
+            ArchivedAnnouncement.objects.filter(id__in=ids).only(*archived_announcement_fields),
+            archived=True
+        )
+        by_id.update((a.id, a) for a in archived if a.id not in by_id)
+    return [by_id[pk] for pk in ids if pk in by_id]
+
+
+def _page_bounds(limitfrom, limitnum, total):
+    start = int(limitfrom) if limitfrom else 0
+    end = int(limitnum) + start if limitnum else total
+    return start, end
+
+
+def _annotate_announcements(queryset, archived):
+    return queryset \
+        .select_related('programme') \
+        .annotate(
+            recipient=Case(
+                *_get_recipient_as_conditional_expressions(),
+                default='audience'
+            ),
+            display_id=Concat(Value(announcement_id_prefix), 'id', output_field=CharField()),
+            is_archived=Value(archived, output_field=BooleanField())
+        )
+
+
+def _count_announcement_reach(announcement):
+    users = get_user_model().objects.filter(is_active=True)
+    audience = _audience_users(announcement, users)
+    recipients = _programme_users(announcement, audience)
+
+    counts = recipients.aggregate(
+        recipients=Count('id', distinct=True),
+        with_email=Count('id', distinct=True, filter=~Q(email=''))
+    )
+    group_names = audience_group_names(announcement.audience) or \
+        sorted(set(g for a, _label in AUDIENCES for g in audience_group_names(a)))
+    groups = dict((name, 0) for name in group_names)
+    groups.update(
+        users
+        .filter(id__in=recipients.values('id'), groups__name__in=group_names)
+        .order_by()
+        .values_list('groups__name')
+        .annotate(Count('id', distinct=True))
+    )
+    return {
+        'recipients': counts['recipients'],
+        'with_email': counts['with_email'],
+        'groups': groups,
+        'programme': None if announcement.programme is None else {
+            'id': announcement.programme.id,
+            'display_name': announcement.programme.display_name,
+            'audience': audience.aggregate(c=Count('id', distinct=True))['c'],
+            'recipients': counts['recipients'],
+        },
+    }
+
+
+def _archive_user_announcements(announcement_ids):
+    # copy then delete read receipts with INSERT ... SELECT, so they are never loaded into memory
+    qn = connection.ops.quote_name
+    placeholders = ', '.join(['%s'] * len(announcement_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'INSERT INTO %s (user_id, announcement_id, created) SELECT user_id, announcement_id, created FROM %s '
+            'WHERE announcement_id IN (%s)' % (
+                qn(ArchivedUserAnnouncement._meta.db_table),
+                qn(UserAnnouncement._meta.db_table),
+                placeholders
+            ),
+            announcement_ids
+        )
+        cursor.execute(
+            'DELETE FROM %s WHERE announcement_id IN (%s)' % (qn(UserAnnouncement._meta.db_table), placeholders),
+            announcement_ids
+        )
+        return cursor.rowcount
+
+
+def _marked_read_dict(announcement, marked_read):
+    return {
+        'id': announcement.id,
+        'subject': announcement.subject,
+        'body': announcement.body,
+        'visible_from': announcement.visible_from,
+        'is_urgent': announcement.is_urgent,
+        'modified': announcement.modified,
+        'marked_read': marked_read
+    }
+
+
+def _buffer_read_state(read_buffer, announcement_id, user, marked_read):
+    size = read_buffer.add(user.pk, announcement_id, marked_read)
+    read_buffer.start(flush_read_buffer)
+    invalidate_announcements_cache_for_user(user.pk)
+    publish(user_channel(user.pk), {'type': 'unread' if marked_read is None else 'read', 'announcement_id': announcement_id})
+    if size >= read_buffer.flush_size:
+        flush_read_buffer()
+
+
+def _apply_read_states(states):
+    if readstate.uses_watermarks():
+        _apply_read_states_to_watermarks(states)
+    else:
+        _apply_read_states_to_rows(states)
+    # the bulk writes send no signals, so the users' cached lists are invalidated here, once they are committed
+    for user_id in set(u for u, _a, _m in states):
+        transaction.on_commit(partial(invalidate_announcements_cache_for_user, user_id))
+
+
+def _apply_read_states_to_rows(states):
+    # one bulk insert for the reads and a delete per chunk of users for the unreads, then exact read counts
+    reads = [(u, a) for u, a, marked_read in states if marked_read is not None]
+    unreads = defaultdict(list)
+    for u, a, marked_read in states:
+        if marked_read is None:
+            unreads[u].append(a)
+    announcement_ids = set(a for _u, a, _m in states)
+    read_by = defaultdict(list)
+    for u, a in reads:
+        read_by[a].append(u)
+    unread_by = defaultdict(list)
+
+    with transaction.atomic():
+        existing = set(Announcement.objects.filter(id__in=announcement_ids).values_list('id', flat=True))
+        UserAnnouncement.objects.bulk_create(
+            (UserAnnouncement(user_id=u, announcement_id=a) for u, a in reads if a in existing),
+            batch_size=1000,
+            ignore_conflicts=True
+        )
+        user_ids = list(unreads)
+        for i in range(0, len(user_ids), 100):
+            q = reduce(lambda acc, u: acc | Q(user_id=u, announcement_id__in=unreads[u]), user_ids[i:i + 100], Q(pk__in=[]))
+            deleted = list(UserAnnouncement.objects.filter(q).values_list('id', 'user_id', 'announcement_id'))
+            _delete_user_announcements([pk for pk, _u, _a in deleted])
+            AnnouncementTombstone.objects.bulk_create(
+                AnnouncementTombstone(announcement_id=a, user_id=u) for _pk, u, a in deleted
+            )
+            for _pk, u, a in deleted:
+                unread_by[a].append(u)
+        Announcement.objects.filter(id__in=existing).update(read_count=_read_count_subquery())
+        for a in (set(read_by) | set(unread_by)) & existing:
+            _announcement_readers_changed(a, read=read_by[a], unread=unread_by[a])
+    current_span().set(rows=len(states))
+
+
+def _apply_read_states_to_watermarks(states):
+    # each user's watermark depends on what they can see, so these are applied one at a time
+    users = get_user_model().objects.in_bulk(set(u for u, _a, _m in states))
+    announcements = Announcement.objects.in_bulk(set(a for _u, a, _m in states))
+    with transaction.atomic():
+        for u, a, marked_read in states:
+            if u not in users or a not in announcements:
+                continue
+            if marked_read is not None:
+                if readstate.mark_read(users[u], announcements[a], _visible_for(users[u])):
+                    Announcement.objects.filter(pk=a).update(read_count=F('read_count') + 1)
+                    _announcement_readers_changed(a, read=[u])
+            elif readstate.mark_unread(users[u], announcements[a], _visible_for(users[u])):
+                Announcement.objects.filter(pk=a, read_count__gt=0).update(read_count=F('read_count') - 1)
+                AnnouncementTombstone.objects.create(announcement_id=a, user_id=u)
+                _announcement_readers_changed(a, unread=[u])
+    current_span().set(rows=len(states))
+
+
+def _add_subject_and_body(user_announcements, visible_announcements):
+    # one query for those announcements loaded without them
+    texts = dict(
+        (a.id, (a.subject, a.body)) for a in visible_announcements
+        if not {'subject', 'body'} & a.get_deferred_fields()
+    )
+    missing = [ua['id'] for ua in user_announcements if ua['id'] not in texts]
+    if missing:
+        texts.update((pk, (subject, body)) for pk, subject, body in Announcement.objects
+                     .filter(id__in=missing)
+                     .values_list('id', 'subject', 'body'))
+    for user_announcement in user_announcements:
+        user_announcement['subject'], user_announcement['body'] = texts.get(user_announcement['id'], ('', ''))
+
+
+def _visible_for(user, context=None):
+    return _VisibleFor(user, context)
+
+
+class _VisibleFor:
+
+    # for readstate: the announcements the user can see now, and the groups and programmes choosing them, which
+    # readstate compares with those its watermark was moved under
+    def __init__(self, user, context=None):
+        self.user = user
+        self.context = context
+
+    def __call__(self):
+        return get_visible_announcements_for_user(self.user, now(), context=self.context)
+
+    @property
+    def audience(self):
+        self.context = self.context or get_user_context(self.user)
+        return _audience_signature(self.context.group_names, self.context.programme_ids)
+
+    @staticmethod
+    def addressed_to(announcement, audience):
+        return _visible_to_audience(announcement, *_parse_audience_signature(audience))
+
+
+def _read_state_changed(user, announcement_id, event_type):
+    # watermarks and exceptions send no user announcement signals, so this does what their receivers would
+    invalidate_announcements_cache_for_user(user.pk)
+    transaction.on_commit(partial(publish, user_channel(user.pk), {'type': event_type, 'announcement_id': announcement_id}))
+
+
+def _get_recipient_ids(announcement):
+    return get_announcement_recipients(announcement).order_by().values_list('id', flat=True).distinct()
+
+
+def _announcement_readers_changed(announcement_id, read=(), unread=()):
+    # appended to the announcement's readers delta log in the cache rather than written to its bitmap, so readers do
+    # not queue on its row, once committed, so a rescan that reads the log position first sees every change before it
+    transaction.on_commit(partial(_append_readers_delta, announcement_id, list(read), list(unread)))
+
+
+def _append_readers_delta(announcement_id, read, unread):
+    # each entry is added at the first free position past the log's end before the end is moved on, so every
+    # position up to the end holds an entry unless it was evicted
+    cache = caches['default']
+    key = _readers_log_cache_key(announcement_id)
+    seq = _get_cache_version(cache, key) + 1
+    timeout = getattr(settings, 'ANNOUNCEMENTS_READERS_DELTA_TIMEOUT', 86400)
+    while not cache.add('%s.%d' % (key, seq), (read, unread), timeout):
+        seq += 1
+    try:
+        cache.incr(key)
+    except ValueError:
+        # the log was evicted meanwhile, and restarts past every position used, so stored bitmaps are rebuilt
+        pass
+
+
+def _merge_readers_deltas(announcement, stored, seq):
+    # the stored bitmap with the deltas after the position it was built at applied, or None if any were lost
+    if stored.version > seq or seq - stored.version > getattr(settings, 'ANNOUNCEMENTS_READERS_MAX_DELTAS', 1000):
+        return None
+    readers = get_bitmap_class().deserialize(bytes(stored.bitmap))
+    if stored.version == seq:
+        return readers
+    key = _readers_log_cache_key(announcement.pk)
+    keys = ['%s.%d' % (key, i) for i in range(stored.version + 1, seq + 1)]
+    deltas = caches['default'].get_many(keys)
+    if len(deltas) < len(keys):
+        return None
+    for k in keys:
+        read, unread = deltas[k]
+        for user_id in read:
+            readers.add(user_id)
+        for user_id in unread:
+            readers.discard(user_id)
+    # compacted without a lock: only if no one else has moved it on meanwhile
+    AnnouncementReaders.objects \
+        .filter(announcement=announcement, version=stored.version) \
+        .update(bitmap=readers.serialize(), version=seq, modified=now())
+    return readers
+
+
+def _read_count_subquery():
+    return Coalesce(Subquery(
+        UserAnnouncement.objects
+        .filter(announcement_id=OuterRef('pk'))
+        .order_by()
+        .values('announcement_id')
+        .annotate(c=Count('id'))
+        .values('c')
+    ), 0)
+
+
+def _user_version_cache_key(user_id):
+    return 'announcements.version.%d' % user_id
+
+
+def _readers_log_cache_key(announcement_id):
+    return 'announcements.readers.log.%s' % announcement_id
+
+
+def _get_cache_version(cache, key):
+    # versions start from the clock, so one that was evicted never comes back with a value already used
+    cache.add(key, int(now().timestamp() * 1000), None)
+    return cache.get(key)
+
+
+def _bump_cache_version(key):
+    cache = caches['default']
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, int(now().timestamp() * 1000), None)
+
+
+def _visibility_window(current_datetime):
+    # the nearest visible_from or visible_to either side of current_datetime, between which nothing changes
+    boundaries = Announcement.objects \
+        .filter(deleted__isnull=True) \
+        .aggregate(
+            last_from=Max('visible_from', filter=Q(visible_from__lte=current_datetime)),
+            last_to=Max('visible_to', filter=Q(visible_to__lt=current_datetime)),
+            next_from=Min('visible_from', filter=Q(visible_from__gt=current_datetime)),
+            next_to=Min('visible_to', filter=Q(visible_to__gte=current_datetime))
+        )
+    lower = [b for b in (boundaries['last_from'], boundaries['last_to']) if b is not None]
+    upper = [b for b in (boundaries['next_from'], boundaries['next_to']) if b is not None]
+    return (
+        max(lower) if lower else datetime.min.replace(tzinfo=timezone.utc),
+        min(upper) if upper else datetime.max.replace(tzinfo=timezone.utc)
+    )
+
+
+def _load_audience_inputs(user):
+    # only the groups announcements are addressed to matter, in a canonical order
+    audience_groups = set(g for a, _label in AUDIENCES for g in audience_group_names(a))
+    group_names = sorted(set(user.groups.filter(name__in=audience_groups).values_list('name', flat=True)))
+    programme_ids = sorted(set(UserProgramme.objects.filter(user=user).values_list('programme_id', flat=True)))
+    return group_names, programme_ids
+
+
+def _visible_to_audience_q(group_names, programme_ids):
+    # _visible_to_audience as a filter
+    audiences = [
+        a for a, _label in AUDIENCES
+        if not audience_group_names(a) or set(audience_group_names(a)) & set(group_names)
+    ]
+    return Q(audience__in=audiences) & (Q(programme__isnull=True) | Q(programme_id__in=programme_ids))
+
+
+def _is_read_expression(user, context=None):
+    # whether the user has read each announcement, from the same sources as get_announcements_marked_read_for_user
+    whens = []
+    read_buffer = get_read_buffer()
+    if read_buffer is not None:
+        pending = read_buffer.pending_for_user(user.pk)
+        read = [a for a, marked_read in pending.items() if marked_read is not None]
+        unread = [a for a, marked_read in pending.items() if marked_read is None]
+        if read:
+            whens.append(When(id__in=read, then=Value(True)))
+        if unread:
+            whens.append(When(id__in=unread, then=Value(False)))
+    if readstate.uses_watermarks():
+        whens.extend(readstate.get_read_conditions(user, _visible_for(user, context)))
+    else:
+        whens.append(When(
+            Exists(UserAnnouncement.objects.filter(user=user, announcement=OuterRef('pk'))),
+            then=Value(True)
+        ))
+    return Case(*whens, default=Value(False), output_field=BooleanField())
+
+
+def _parse_visible_cursor(cursor):
+    try:
+        visible_from, pk = signing.loads(cursor, salt=visible_cursor_salt)
+        # from the newest read announcement, when the first page had no room for any
+        if visible_from is None:
+            return None, None
+        return datetime.fromisoformat(visible_from), int(pk)
+    except (signing.BadSignature, TypeError, ValueError):
+        raise ValidationError(_('Invalid cursor'))
+
+
+def _visible_to_audience(announcement, group_names, programme_ids):
+    groups = audience_group_names(announcement.audience)
+    if groups and not set(groups) & set(group_names):
+        return False
+    return announcement.programme_id is None or announcement.programme_id in programme_ids
+
+
+def _get_thread_pool():
+    global _thread_pool
+    with _thread_pool_lock:
+        if _thread_pool is None:
+            _thread_pool = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'ANNOUNCEMENTS_ASYNC_THREADS', 10),
+                thread_name_prefix='announcements'
+            )
+        return _thread_pool
+
+
+def _call_with_connection(func, *args):
+    # pool threads live outside the request cycle, so expire their connections the way it would
+    close_old_connections()
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+
+def _purge_announcement_in_thread(announcement_id):
+    try:
+        purge_announcement(announcement_id)
+    except Exception:
+        # left tombstoned, purge_deleted_announcements picks it up later
+        getLogger(__name__).exception('Failed to purge announcement %d', announcement_id)
+    finally:
+        connections.close_all()
+
+
+def _delete_user_announcements_batch(announcement_id, batch_size):
+    ids = list(
+        UserAnnouncement.objects
+        .filter(announcement_id=announcement_id)
+        .values_list('id', flat=True)[:batch_size]
+    )
+    _delete_user_announcements(ids)
+    return len(ids)
+
+
+def _delete_user_announcements(ids):
+    # raw, so no per-object signals are sent
+    if not ids:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'DELETE FROM %s WHERE id IN (%s)' % (
+                connection.ops.quote_name(UserAnnouncement._meta.db_table),
+                ', '.join(['%s'] * len(ids))
+            ),
+            ids
+        )
+
+
+def _addressed_to(context, announcement_ids):
+    # of announcements no longer visible, those addressed to the user as they are now or were before their audience
+    # changed or they were removed, going by the audiences recorded in their tombstones
+    addressed = set()
+    if not announcement_ids:
+        return addressed
+    for announcement in Announcement.objects.filter(id__in=announcement_ids).only('id', 'audience', 'programme_id'):
+        if _visible_to_audience(announcement, context.group_names, context.programme_ids):
+            addressed.add(announcement.id)
+    for tombstone in AnnouncementTombstone.objects.filter(user__isnull=True, announcement_id__in=announcement_ids):
+        if not tombstone.audience or _visible_to_audience(tombstone, context.group_names, context.programme_ids):
+            addressed.add(tombstone.announcement_id)
+    return addressed
+
+
+def tombstone_audience_change(announcement):
+    # a tombstone with the audience an announcement is leaving, so delta sync and events tell the users it was
+    # addressed to that they can no longer see it
+    if announcement.pk is None:
+        return
+    previous = Announcement.objects.filter(pk=announcement.pk).values('audience', 'programme_id').first()
+    if previous is not None and (previous['audience'], previous['programme_id']) != \
+            (announcement.audience, announcement.programme_id):
+        AnnouncementTombstone.objects.create(announcement_id=announcement.pk, **previous)
+
+
+def keep_readdressed_announcement_unread(announcement):
+    # users an announcement is readdressed to have not read it, but their watermark may have passed it already
+    if announcement.pk is None or not readstate.uses_watermarks():
+        return
+    previous = Announcement.objects \
+        .filter(pk=announcement.pk) \
+        .values('audience', 'programme_id', 'published') \
+        .first()
+    if previous is None or (previous['audience'], previous['programme_id']) == \
+            (announcement.audience, announcement.programme_id):
+        return
+    before = Announcement(pk=announcement.pk, audience=previous['audience'], programme_id=previous['programme_id'])
+    addressed = get_announcement_recipients(announcement) \
+        .exclude(id__in=get_announcement_recipients(before).values('id')) \
+        .values('id')
+    readstate.keep_unread(Announcement(pk=announcement.pk, published=previous['published']), addressed)
+
+
+def set_announcement_published(announcement):
+    # published follows visible_from while it is in the future, and then stays put, so an announcement backdated on
+    # creation or moved into the past is published when that happens, not when visible_from says
+    current_datetime = now()
+    if announcement.visible_from > current_datetime:
+        announcement.published = announcement.visible_from
+        return
+    previous = None
+    if announcement.pk is not None:
+        previous = Announcement.objects.filter(pk=announcement.pk).values_list('published', flat=True).first()
+    announcement.published = previous if previous is not None and previous <= current_datetime else current_datetime
+
+
+def _filter_visible_to_user(queryset, context, current_datetime):
+    announcements = queryset \
+        .filter(visible_from__lte=current_datetime, visible_to__gte=current_datetime, deleted__isnull=True) \
+        .order_by('-is_urgent', '-visible_from')
+    return filter(partial(_programme, context=context), filter(partial(_audience, context=context), announcements))
+
+
+def _parse_sync_token(token):
+    # (when it was issued, the user's audience signature then), tokens from before signatures were kept being reset
+    try:
+        timestamp, audience = signing.loads(token, salt=sync_token_salt)
+        return datetime.fromtimestamp(timestamp, timezone.utc), audience
+    except (signing.BadSignature, TypeError, ValueError):
+        return None, None
+
+
+def _audience_change(user, since_audience, context, current_datetime):
+    # the announcements visible now that the user's previous audience could not see, and the ids of those it could
+    # that the user no longer can
+    group_names, programme_ids = _parse_audience_signature(since_audience)
+    joined = [
+        a for a in get_visible_announcements_for_user(user, current_datetime, context=context)
+        if not _visible_to_audience(a, group_names, programme_ids)
+    ]
+    left = set(
+        a.id for a in Announcement.objects
+        .filter(visible_from__lte=current_datetime, visible_to__gte=current_datetime, deleted__isnull=True)
+        .only(*visible_announcement_fields)
+        if _visible_to_audience(a, group_names, programme_ids)
+        and not _visible_to_audience(a, context.group_names, context.programme_ids)
+    )
+    return joined, left
+
+
+def _audience_signature(group_names, programme_ids):
+    # what a user's visible announcements depend on, as 'group,group|programme id,programme id'
+    return '%s|%s' % (','.join(sorted(group_names)), ','.join(map(str, sorted(programme_ids))))
+
+
+def _parse_audience_signature(audience):
+    group_names, programme_ids = audience.split('|')
+    return (
+        group_names.split(',') if group_names else [],
+        [int(p) for p in programme_ids.split(',')] if programme_ids else []
+    )
+
+
+def audience_group_names(audience):
+    # the group names an audience is made of, none meaning everyone
+    if audience == 'all':
+        return []
+    return list(filter(lambda a: a != 'and', audience.split('_')))
+
+
+def _audience(announcement, context):
     if announcement.audience == 'all':
         return True
 
-    group_names = user.groups.values_list('name', flat=True)
-    audiences = filter(lambda audience: audience != 'and', announcement.audience.split('_'))
-    return any(map(lambda audience: audience in group_names, audiences))
+    audiences = audience_group_names(announcement.audience)
+    return any(map(lambda audience: audience in context.group_names, audiences))
 
 
-def _programme(announcement, user):
-    return True if announcement.programme is None else announcement \
-        .programme \
-        .userprogramme_set \
-        .filter(user=user) \
-        .exists()
+def _programme(announcement, context):
+    return announcement.programme_id is None or announcement.programme_id in context.programme_ids
 
 
-def _course(announcement, user, memberships):
+def _course(announcement, context):
     if announcement.scheduled_course is None:
         return True
 
-    c = announcement.scheduled_course.vle_course_id
-    cache = caches['default']
-    data = cache.get(course_and_group_memberships_cache_key)
-    return False if data is None or c not in data or 'members' not in data[c] or user.username not in data[c]['members'] else True
+    course_ids, _groups = context.memberships
+    return announcement.scheduled_course.vle_course_id in course_ids
 
 
-def _group(announcement, user, memberships):
+def _group(announcement, context):
     if announcement.group is None:
         return True
 
-    c = announcement.scheduled_course.vle_course_id
-    v = announcement.group.vle_group_id
-    cache = caches['default']
-    data = cache.get(course_and_group_memberships_cache_key)
-    return False if data is None or c not in data or 'groups' not in data[c] or v not in data[c]['groups'] or user.username not in data[c]['groups'][v] else True
+    _course_ids, groups = context.memberships
+    return (announcement.scheduled_course.vle_course_id, announcement.group.vle_group_id) in groups
 
 
 def _get_order_by(column, order=None):
     orderable = {
         'announcement_id': 'id',
         'recipient': 'recipient',
-        'visible_from': 'visible_from'
+        'visible_from': 'visible_from',
+        'read_count': 'read_count',
+        'recipient_count': 'recipient_count'
     }
     column = column if column in orderable else 'announcement_id'
     order = '-' if order == 'desc' else ''
@@ -353,23 +1553,39 @@ def _get_order_by(column, order=None):
 
 
 def _get_q_filter(q):
-    query = Q()
-
-    # visible from date
-    dt = _parse_q_date(q)
-    if dt:
-        query |= Q(visible_from__range=(
-            make_aware(datetime.combine(dt.date(), time.min)),
-            make_aware(datetime.combine(dt.date(), time.max))
+    # each token is matched one way only, so ids and dates use their indexes and only free text scans the text columns
+    kind, value = _classify_q_token(q)
+    if kind == 'empty':
+        return Q()
+    if kind == 'date':
+        return Q(visible_from__range=(
+            make_aware(datetime.combine(value.date(), time.min)),
+            make_aware(datetime.combine(value.date(), time.max))
         ))
+    if kind == 'id':
+        return _id_prefix_filter(value)
+    return Q(subject__icontains=value) | Q(body__icontains=value)
 
-    # announcement id
-    if q.lower().startswith(announcement_id_prefix.lower()):
-        query |= Q(id__istartswith=q[len(announcement_id_prefix):])
-
-    # subject and body
-    query |= Q(subject__icontains=q) | Q(body__icontains=q)
 
+def _classify_q_token(q):
+    if not q or q.lower() == announcement_id_prefix.lower():
+        return 'empty', q
+    dt = _parse_q_date(q)
+    if dt:
+        return 'date', dt
+    if q.lower().startswith(announcement_id_prefix.lower()) and q[len(announcement_id_prefix):].isdigit():
+        return 'id', q[len(announcement_id_prefix):]
+    return 'text', q
+
+
+def _id_prefix_filter(digits):
+    # ids whose decimal form starts with digits, as one range per length: 12 is 12, 120-129, 1200-1299, ...
+    if digits.startswith('0'):
+        return Q(pk__in=[])
+    prefix = int(digits)
+    query = Q(id=prefix)
+    for width in range(1, id_max_digits - len(digits) + 1):
+        query |= Q(id__range=(prefix * 10 ** width, (prefix + 1) * 10 ** width - 1))
     return query
 
 
@@ -399,7 +1615,7 @@ def _audience_users(announcement, queryset):
     if announcement.audience == 'all':
         return queryset
 
-    groups = filter(lambda audience: audience != 'and', announcement.audience.split('_'))
+    groups = audience_group_names(announcement.audience)
     return queryset.filter(groups__name__in=groups, is_active=True)
 
 
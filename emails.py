@@ -0,0 +1,272 @@
+from datetime import timedelta
+from logging import getLogger
+from random import randrange
+from smtplib import SMTPException
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.mail import EmailMessage, get_connection
+from django.db import connection, transaction
+from django.db.models import Count, F
+from django.template import loader
+from django.urls import reverse
+from django.utils.timezone import now
+
+from .domain import get_announcement_recipients
+from .models import OUTBOX_STATUSES, Announcement, DigestWatermark, EmailOutbox, ScheduledDispatch
+from .tracing import traced, span, current_span
+from .visibility import get_visible_announcement_ids_for_users
+
+
+def recipient_name(user):
+    name = ' '.join([user.first_name, user.last_name]).strip()
+    return user.username if name == '' else name
+
+
+def hub_url():
+    return settings.WWWROOT + reverse('my_hub')
+
+
+@traced(attributes=lambda announcement: {'announcement_id': announcement.pk})
+def enqueue_announcement_emails(announcement):
+    # one outbox row per recipient, written in bulk; rerunning never duplicates a recipient
+    user_ids = get_announcement_recipients(announcement).exclude(email='').values_list('id', flat=True).distinct()
+    rows = EmailOutbox.objects.bulk_create(
+        (EmailOutbox(announcement_id=announcement.pk, user_id=user_id) for user_id in user_ids),
+        batch_size=1000,
+        ignore_conflicts=True
+    )
+    current_span().set(rows=len(rows))
+    return len(rows)
+
+
+@traced(attributes=lambda batch_size=100: {'batch_size': batch_size})
+def send_outbox_emails(batch_size=100):
+    rows = _claim_outbox_rows(batch_size)
+    if not rows:
+        return 0, 0
+
+    subject = ''.join(loader.get_template('announcements/email/announcement_email_subject.txt').render().splitlines())
+    body = loader.get_template('announcements/email/announcement_email.txt')
+    url = hub_url()
+
+    sent_ids = []
+    failed = 0
+    connection = get_connection()
+    try:
+        connection.open()
+        with span('emails.send_mail_batch', rows=len(rows)) as s:
+            for row in rows:
+                try:
+                    if row.user.email == '':
+                        raise ValueError('%s has no email address' % row.user.username)
+                    connection.send_messages([EmailMessage(
+                        subject,
+                        body.render({'recipient_name': recipient_name(row.user), 'hub_url': url}),
+                        None,
+                        [row.user.email],
+                        connection=connection
+                    )])
+                    sent_ids.append(row.id)
+                except (SMTPException, OSError, ValueError) as e:
+                    failed += 1
+                    getLogger(__name__).error(e)
+                    _retry_outbox_row(row, e)
+            s.set(failed=failed)
+    except (SMTPException, OSError) as e:
+        # the connection itself failed, leave the unsent rows to be claimed again when their lease expires
+        getLogger(__name__).error(e)
+    finally:
+        connection.close()
+        EmailOutbox.objects.filter(id__in=sent_ids).update(status='sent', sent=now(), error='')
+
+    current_span().set(rows=len(sent_ids), failed=failed)
+    return len(sent_ids), failed
+
+
+def get_email_outbox_progress(announcement_id):
+    progress = dict((status, 0) for status, _label in OUTBOX_STATUSES)
+    progress.update(
+        EmailOutbox.objects
+        .filter(announcement_id=announcement_id)
+        .order_by()
+        .values_list('status')
+        .annotate(Count('id'))
+    )
+    return progress
+
+
+def schedule_announcement_emails(announcement):
+    # queue, reschedule or cancel the urgent email for an announcement, returning when it is due
+    if announcement.is_urgent and announcement.deleted is None:
+        dispatch, created = ScheduledDispatch.objects.get_or_create(
+            announcement=announcement,
+            defaults={'due': announcement.visible_from}
+        )
+        if dispatch.dispatched is not None:
+            return None
+        if dispatch.due != announcement.visible_from:
+            ScheduledDispatch.objects \
+                .filter(pk=dispatch.pk, dispatched__isnull=True) \
+                .update(due=announcement.visible_from)
+        return announcement.visible_from
+
+    ScheduledDispatch.objects.filter(announcement=announcement, dispatched__isnull=True).delete()
+    return None
+
+
+@traced(attributes=lambda current_datetime=None, batch_size=100: {'batch_size': batch_size})
+def dispatch_due_announcement_emails(current_datetime=None, batch_size=100):
+    current_datetime = current_datetime or now()
+    due = list(
+        ScheduledDispatch.objects
+        .filter(dispatched__isnull=True, due__lte=current_datetime)
+        .order_by('due')
+        .values_list('id', 'announcement_id')[:batch_size]
+    )
+
+    dispatched = 0
+    for dispatch_id, announcement_id in due:
+        # claiming the row first means concurrent workers never send the same announcement twice, and the claim
+        # commits with the outbox rows, so a failure in between leaves the dispatch due rather than done
+        with transaction.atomic():
+            claimed = ScheduledDispatch.objects \
+                .filter(pk=dispatch_id, dispatched__isnull=True) \
+                .update(dispatched=current_datetime)
+            if not claimed:
+                continue
+
+            # recipients are resolved now, so edits to audience or programme since scheduling apply
+            announcement = Announcement.objects.filter(
+                pk=announcement_id,
+                is_urgent=True,
+                visible_to__gte=current_datetime,
+                deleted__isnull=True
+            ).first()
+            if announcement is not None:
+                enqueue_announcement_emails(announcement)
+                dispatched += 1
+
+    current_span().set(rows=dispatched)
+    return dispatched
+
+
+@traced(attributes=lambda current_datetime=None, chunk_size=100: {'chunk_size': chunk_size})
+def send_announcement_digests(current_datetime=None, chunk_size=100):
+    current_datetime = current_datetime or now()
+    default_since = current_datetime - timedelta(days=getattr(settings, 'ANNOUNCEMENTS_DIGEST_INTERVAL_DAYS', 1))
+    watermarks = dict(DigestWatermark.objects.values_list('user_id', 'sent'))
+
+    # non-urgent announcements published since the oldest watermark, which unlike visible_from includes those
+    # backdated or moved into the past since
+    announcements = Announcement \
+        .objects \
+        .filter(
+            is_urgent=False,
+            published__gt=min([default_since] + list(watermarks.values())),
+            published__lte=current_datetime,
+            visible_to__gte=current_datetime,
+            deleted__isnull=True
+        ) \
+        .only('id', 'subject', 'visible_from', 'published') \
+        .in_bulk()
+    if not announcements:
+        return 0
+
+    user_ids = get_user_model().objects.filter(is_active=True).exclude(email='').values_list('id', flat=True)
+    visible = get_visible_announcement_ids_for_users(user_ids, current_datetime)
+
+    # each user's announcements that became visible since their own last digest
+    digests = []
+    for user_id, announcement_ids in visible.items():
+        since = watermarks.get(user_id, default_since)
+        user_announcements = [
+            announcements[a] for a in announcement_ids
+            if a in announcements and announcements[a].published > since
+        ]
+        if user_announcements:
+            digests.append((user_id, user_announcements))
+
+    subject = ''.join(loader.get_template('announcements/email/announcement_digest_email_subject.txt').render().splitlines())
+    body = loader.get_template('announcements/email/announcement_digest_email.txt')
+    url = hub_url()
+
+    # one connection for the whole run, watermarks advancing with each chunk that is sent
+    sent = 0
+    connection = get_connection()
+    connection.open()
+    try:
+        for i in range(0, len(digests), chunk_size):
+            chunk = digests[i:i + chunk_size]
+            users = get_user_model().objects.in_bulk([user_id for user_id, _a in chunk])
+            with span('emails.send_digest_chunk', rows=len(chunk)):
+                messages = [
+                    EmailMessage(
+                        subject,
+                        body.render({
+                            'recipient_name': recipient_name(users[user_id]),
+                            'announcements': user_announcements,
+                            'hub_url': url,
+                        }),
+                        None,
+                        [users[user_id].email],
+                        connection=connection
+                    )
+                    for user_id, user_announcements in chunk
+                ]
+                try:
+                    connection.send_messages(messages)
+                except SMTPException as e:
+                    getLogger(__name__).error(e.args[0])
+                    continue
+            _advance_digest_watermarks([user_id for user_id, _a in chunk], watermarks, current_datetime)
+            sent += len(chunk)
+    finally:
+        connection.close()
+
+    current_span().set(rows=sent)
+    return sent
+
+
+def _claim_outbox_rows(batch_size):
+    # lock the due rows where the database allows it, skipping those other workers hold, and lease them. Without
+    # skip_locked two workers can select the same rows, so each returns only those leased until its own lease end,
+    # made apart from any other worker's by a random number of microseconds
+    current_datetime = now()
+    lease = timedelta(seconds=getattr(settings, 'ANNOUNCEMENTS_OUTBOX_LEASE', 300), microseconds=randrange(1000000))
+    with transaction.atomic():
+        ids = list(
+            EmailOutbox.objects
+            .select_for_update(skip_locked=connection.features.has_select_for_update_skip_locked)
+            .filter(status='pending', available__lte=current_datetime)
+            .order_by('available')
+            .values_list('id', flat=True)[:batch_size]
+        )
+        EmailOutbox.objects \
+            .filter(id__in=ids, status='pending', available__lte=current_datetime) \
+            .update(available=current_datetime + lease, attempts=F('attempts') + 1)
+    return list(
+        EmailOutbox.objects
+        .filter(id__in=ids, available=current_datetime + lease)
+        .select_related('user')
+        .order_by('id')
+    )
+
+
+def _retry_outbox_row(row, error):
+    # exponential backoff until the attempts run out
+    max_attempts = getattr(settings, 'ANNOUNCEMENTS_OUTBOX_MAX_ATTEMPTS', 5)
+    backoff = getattr(settings, 'ANNOUNCEMENTS_OUTBOX_BACKOFF', 60) * 2 ** (row.attempts - 1)
+    EmailOutbox.objects.filter(pk=row.pk).update(
+        status='failed' if row.attempts >= max_attempts else 'pending',
+        available=now() + timedelta(seconds=min(backoff, 86400)),
+        error=str(error)
+    )
+
+
+def _advance_digest_watermarks(user_ids, watermarks, current_datetime):
+    with transaction.atomic():
+        DigestWatermark.objects.filter(user_id__in=[u for u in user_ids if u in watermarks]).update(sent=current_datetime)
+        DigestWatermark.objects.bulk_create(
+            DigestWatermark(user_id=u, sent=current_datetime) for u in user_ids if u not in watermarks
+        )
@@ -0,0 +1,26 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+
+from announcements.domain import archive_expired_announcements, prune_announcement_tombstones
+
+
+class Command(BaseCommand):
+    help = 'Move expired announcements and their read receipts into the archive tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=0, help='only archive announcements expired this many days ago')
+        parser.add_argument('--chunk-size', type=int, default=500, help='announcements moved per transaction')
+
+    def handle(self, *args, **options):
+        announcements, user_announcements = archive_expired_announcements(
+            before=now() - timedelta(days=options['days']),
+            chunk_size=options['chunk_size']
+        )
+        self.stdout.write('Archived %d announcements and %d read receipts' % (announcements, user_announcements))
+
+        # tombstones are only needed for as long as a delta sync token is accepted
+        retention = timedelta(days=getattr(settings, 'ANNOUNCEMENTS_SYNC_RETENTION_DAYS', 30))
+        self.stdout.write('Pruned %d sync tombstones' % prune_announcement_tombstones(now() - retention))
@@ -0,0 +1,77 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from announcements import views_async, views_json_api
+
+
+class Command(BaseCommand):
+    help = 'Compare the sync and async visible and count_unread views under concurrent load'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500, help='requests per view and variant')
+        parser.add_argument('--concurrency', type=int, default=50, help='requests in flight at once')
+        parser.add_argument('--users', type=int, default=50, help='distinct active users to request as')
+
+    def handle(self, *args, **options):
+        users = list(get_user_model().objects.filter(is_active=True).order_by('?')[:options['users']])
+        if not users:
+            self.stderr.write('No active users to request as')
+            return
+
+        factory = APIRequestFactory()
+        requests = []
+        for i in range(options['requests']):
+            request = factory.get('/')
+            force_authenticate(request, users[i % len(users)])
+            requests.append(request)
+
+        for name in ('visible', 'count_unread'):
+            for variant, views, run in (('sync', views_json_api, self._run_sync), ('async', views_async, self._run_async)):
+                elapsed, latencies = run(getattr(views, name), requests, options['concurrency'])
+                latencies.sort()
+                self.stdout.write('%-12s %-5s %8.1f req/s  p50 %6.1fms  p95 %6.1fms' % (
+                    name,
+                    variant,
+                    len(latencies) / elapsed,
+                    latencies[len(latencies) // 2] * 1000,
+                    latencies[int(len(latencies) * 0.95)] * 1000,
+                ))
+
+    @staticmethod
+    def _run_sync(view, requests, concurrency):
+        # one worker thread per request in flight, as a threaded WSGI server would use
+        def call(request):
+            close_old_connections()
+            started = perf_counter()
+            view(request).render()
+            close_old_connections()
+            return perf_counter() - started
+
+        started = perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            latencies = list(executor.map(call, requests))
+        return perf_counter() - started, latencies
+
+    @staticmethod
+    def _run_async(view, requests, concurrency):
+        async def run():
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def call(request):
+                async with semaphore:
+                    started = perf_counter()
+                    await view(request)
+                    return perf_counter() - started
+
+            return await asyncio.gather(*(call(request) for request in requests))
+
+        started = perf_counter()
+        latencies = asyncio.run(run())
+        return perf_counter() - started, list(latencies)
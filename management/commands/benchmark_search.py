@@ -0,0 +1,64 @@
+from datetime import datetime, time
+from functools import reduce
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils.timezone import make_aware
+
+from announcements.domain import _get_q_filter, _parse_q_date, announcement_id_prefix
+from announcements.models import Announcement
+
+
+def _get_q_filter_unplanned(q):
+    # the filter before tokens were classified: every interpretation of every token ORed together
+    query = Q()
+    dt = _parse_q_date(q)
+    if dt:
+        query |= Q(visible_from__range=(
+            make_aware(datetime.combine(dt.date(), time.min)),
+            make_aware(datetime.combine(dt.date(), time.max))
+        ))
+    if q.lower().startswith(announcement_id_prefix.lower()):
+        query |= Q(id__istartswith=q[len(announcement_id_prefix):])
+    return query | Q(subject__icontains=q) | Q(body__icontains=q)
+
+
+class Command(BaseCommand):
+    help = 'Compare admin search with and without the token planner, for each shape of query'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=50, help='times each query is run per variant')
+        parser.add_argument('--text', default='exam', help='free text to search for')
+
+    def handle(self, *args, **options):
+        latest = Announcement.objects.order_by('-id').first()
+        if latest is None:
+            self.stderr.write('No announcements to search')
+            return
+
+        date = latest.visible_from.strftime('%d/%m/%Y')
+        shapes = (
+            ('exact id', '%s%d' % (announcement_id_prefix, latest.id)),
+            ('id prefix', '%s%s' % (announcement_id_prefix, str(latest.id)[:1])),
+            ('date', date),
+            ('text', options['text']),
+            ('mixed', '%s %s' % (date, options['text'])),
+        )
+        for shape, q in shapes:
+            for variant, q_filter in (('before', _get_q_filter_unplanned), ('planned', _get_q_filter)):
+                queryset = Announcement.objects.filter(
+                    reduce(lambda acc, token: acc & q_filter(token), q.split(' '), Q()),
+                    deleted__isnull=True
+                )
+                started = perf_counter()
+                for _i in range(options['repeat']):
+                    total = queryset.count()
+                    list(queryset.order_by('-visible_from').values_list('id', flat=True)[:10])
+                elapsed = perf_counter() - started
+                self.stdout.write('%-10s %-8s %6d rows %8.2fms/query' % (
+                    shape,
+                    variant,
+                    total,
+                    elapsed / options['repeat'] * 1000,
+                ))
@@ -0,0 +1,22 @@
+from time import sleep
+
+from django.core.management.base import BaseCommand
+
+from announcements.emails import dispatch_due_announcement_emails
+
+
+class Command(BaseCommand):
+    help = 'Send the urgent announcement emails that have fallen due'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='announcements dispatched per batch')
+        parser.add_argument('--interval', type=int, default=None, help='keep running, polling every this many seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            dispatched = dispatch_due_announcement_emails(batch_size=options['batch_size'])
+            self.stdout.write('Dispatched emails for %d announcements' % dispatched)
+            if options['interval'] is None:
+                break
+            if dispatched < options['batch_size']:
+                sleep(options['interval'])
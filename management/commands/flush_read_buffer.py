@@ -0,0 +1,19 @@
+from time import sleep
+
+from django.core.management.base import BaseCommand
+
+from announcements.domain import flush_read_buffer
+
+
+class Command(BaseCommand):
+    help = 'Write buffered mark read and unread events to the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=None, help='keep running, flushing every this many seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            flush_read_buffer()
+            if options['interval'] is None:
+                break
+            sleep(options['interval'])
@@ -0,0 +1,36 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+
+from announcements.models import Announcement, ReadWatermark
+from announcements.readstate import migrate_read_state
+from announcements.visibility import get_visible_announcement_ids_for_users
+
+
+class Command(BaseCommand):
+    help = 'Move read receipts to per-user watermarks and exceptions, for ANNOUNCEMENTS_READ_STATE = "watermark"'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='users migrated per transaction')
+        parser.add_argument('--delete-rows', action='store_true', help='delete the read receipts once migrated')
+
+    def handle(self, *args, **options):
+        current_datetime = now()
+        user_ids = list(
+            get_user_model().objects
+            .exclude(id__in=ReadWatermark.objects.values('user_id'))
+            .order_by('id')
+            .values_list('id', flat=True)
+        )
+        watermarks = exceptions = 0
+        for i in range(0, len(user_ids), options['chunk_size']):
+            chunk = user_ids[i:i + options['chunk_size']]
+            visible_ids = get_visible_announcement_ids_for_users(chunk, current_datetime)
+            announcements = Announcement.objects.in_bulk(set(a for ids in visible_ids.values() for a in ids))
+            w, e = migrate_read_state(
+                {u: [announcements[a] for a in visible_ids.get(u, [])] for u in chunk},
+                delete_rows=options['delete_rows']
+            )
+            watermarks += w
+            exceptions += e
+        self.stdout.write('Migrated %d users with %d exceptions' % (watermarks, exceptions))
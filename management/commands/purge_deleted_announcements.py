@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from announcements.domain import purge_deleted_announcements
+
+
+class Command(BaseCommand):
+    help = 'Purge tombstoned announcements and their read receipts in bounded batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help='read receipts deleted per transaction')
+
+    def handle(self, *args, **options):
+        purged = purge_deleted_announcements(options['batch_size'])
+        self.stdout.write('Purged %d announcements' % purged)
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from announcements.domain import reconcile_announcement_counters
+
+
+class Command(BaseCommand):
+    help = 'Recompute the read and recipient counters of every announcement'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='announcements loaded per query')
+
+    def handle(self, *args, **options):
+        corrected = reconcile_announcement_counters(chunk_size=options['chunk_size'])
+        self.stdout.write('Corrected the counters of %d announcements' % corrected)
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from announcements.emails import send_announcement_digests
+
+
+class Command(BaseCommand):
+    help = 'Email each user a digest of the non-urgent announcements that became visible since their last digest'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=100, help='messages sent per chunk')
+
+    def handle(self, *args, **options):
+        sent = send_announcement_digests(chunk_size=options['chunk_size'])
+        self.stdout.write('Sent %d digests' % sent)
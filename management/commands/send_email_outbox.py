@@ -0,0 +1,22 @@
+from time import sleep
+
+from django.core.management.base import BaseCommand
+
+from announcements.emails import send_outbox_emails
+
+
+class Command(BaseCommand):
+    help = 'Send the pending emails in the outbox, retrying failures with backoff'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='emails claimed per batch')
+        parser.add_argument('--interval', type=int, default=None, help='keep running, polling every this many seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = send_outbox_emails(batch_size=options['batch_size'])
+            self.stdout.write('Sent %d emails, %d failed' % (sent, failed))
+            if sent + failed < options['batch_size']:
+                if options['interval'] is None:
+                    break
+                sleep(options['interval'])
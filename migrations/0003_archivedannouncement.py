@@ -0,0 +1,46 @@
+# Generated by Django 3.0.14 on 2026-10-19 15:36
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('programmes', '0001_initial'),
+        ('announcements', '0002_auto_20200609_1458'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedAnnouncement',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('subject', models.CharField(max_length=100)),
+                ('body', models.TextField()),
+                ('visible_from', models.DateTimeField(db_index=True)),
+                ('visible_to', models.DateTimeField(db_index=True)),
+                ('is_urgent', models.BooleanField(default=False)),
+                ('audience', models.CharField(choices=[('all', 'All'), ('students', 'All students'), ('tutors', 'All tutors'), ('students_and_tutors', 'All students and tutors')], max_length=20)),
+                ('created', models.DateTimeField()),
+                ('modified', models.DateTimeField()),
+                ('archived', models.DateTimeField(auto_now_add=True)),
+                ('programme', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='programmes.Programme')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedUserAnnouncement',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField()),
+                ('announcement', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='announcements.ArchivedAnnouncement')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'announcement')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-19 15:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('announcements', '0003_archivedannouncement'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='announcement',
+            name='deleted',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.0.14 on 2026-10-19 15:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def mark_existing_urgent_announcements_dispatched(apps, schema_editor):
+    # urgent announcements created before the dispatch queue were emailed on creation
+    Announcement = apps.get_model('announcements', 'Announcement')
+    ScheduledDispatch = apps.get_model('announcements', 'ScheduledDispatch')
+    ScheduledDispatch.objects.bulk_create(
+        ScheduledDispatch(announcement_id=pk, due=visible_from, dispatched=created)
+        for pk, visible_from, created in Announcement.objects.filter(is_urgent=True).values_list('id', 'visible_from', 'created')
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('announcements', '0006_digestwatermark'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduledDispatch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('due', models.DateTimeField()),
+                ('dispatched', models.DateTimeField(blank=True, null=True)),
+                ('announcement', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='announcements.Announcement')),
+            ],
+            options={
+                'index_together': {('dispatched', 'due')},
+            },
+        ),
+        migrations.RunPython(mark_existing_urgent_announcements_dispatched, migrations.RunPython.noop),
+    ]
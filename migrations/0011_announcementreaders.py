@@ -0,0 +1,23 @@
+# Generated by Django 3.0.14 on 2026-10-19 16:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('announcements', '0010_readwatermark'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnnouncementReaders',
+            fields=[
+                ('announcement', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to='announcements.Announcement')),
+                ('format', models.CharField(max_length=16)),
+                ('bitmap', models.BinaryField()),
+                ('modified', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.0.14 on 2026-10-19 16:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('announcements', '0011_announcementreaders'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='announcementtombstone',
+            name='audience',
+            field=models.CharField(blank=True, default='', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='announcementtombstone',
+            name='programme_id',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.0.14 on 2026-10-19 16:48
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def publish_existing_announcements(apps, schema_editor):
+    # existing watermarks were moved on visible_from, so keeping it keeps every user's read state as it was
+    Announcement = apps.get_model('announcements', 'Announcement')
+    Announcement.objects.update(published=models.F('visible_from'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('announcements', '0012_announcementtombstone_audience'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='announcement',
+            name='published',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.AddField(
+            model_name='readwatermark',
+            name='audience',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.RunPython(publish_existing_announcements, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-19 16:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('announcements', '0013_announcement_published'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='announcementreaders',
+            name='version',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -15,6 +15,13 @@ AUDIENCES = (
 )
 
 
+OUTBOX_STATUSES = (
+    ('pending', 'Pending'),
+    ('sent', 'Sent'),
+    ('failed', 'Failed'),
+)
+
+
 def _plus_one_week():
     return now() + timedelta(weeks=1)
 
@@ -30,6 +37,13 @@ class Announcement(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True)
     created = models.DateTimeField(auto_now_add=True)
     modified = models.DateTimeField(auto_now=True)
+    deleted = models.DateTimeField(null=True, blank=True, db_index=True)
+    # when it became visible, or will: visible_from, or the time it was saved if that is already past. Set by
+    # set_announcement_published, and unlike visible_from never moved back once reached
+    published = models.DateTimeField(default=now, db_index=True, editable=False)
+    # maintained as receipts are added and removed, and recomputed by reconcile_announcement_counters
+    read_count = models.PositiveIntegerField(default=0, editable=False)
+    recipient_count = models.PositiveIntegerField(default=0, editable=False)
 
     def __str__(self):
         return self.subject
@@ -47,3 +61,107 @@ class UserAnnouncement(models.Model):
 
     class Meta:
         unique_together = ('user', 'announcement',)
+
+
+class ArchivedAnnouncement(models.Model):
+    id = models.IntegerField(primary_key=True)
+    subject = models.CharField(max_length=100)
+    body = models.TextField()
+    visible_from = models.DateTimeField(db_index=True)
+    visible_to = models.DateTimeField(db_index=True)
+    is_urgent = models.BooleanField(default=False)
+    audience = models.CharField(choices=AUDIENCES, max_length=20)
+    programme = models.ForeignKey(Programme, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True, related_name='+')
+    created = models.DateTimeField()
+    modified = models.DateTimeField()
+    read_count = models.PositiveIntegerField(default=0)
+    recipient_count = models.PositiveIntegerField(default=0)
+    archived = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.subject
+
+
+class ArchivedUserAnnouncement(models.Model):
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+')
+    announcement = models.ForeignKey(ArchivedAnnouncement, on_delete=models.CASCADE)
+    created = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('user', 'announcement',)
+
+
+class AnnouncementTombstone(models.Model):
+    # records removals for delta sync: a user's read receipt, or an announcement for everyone when user is null,
+    # with the audience and programme it had so only users it was addressed to are told. Blank for rows kept from
+    # before the audience was recorded, which are reported to everyone
+    announcement_id = models.IntegerField()
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True, related_name='+')
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    audience = models.CharField(max_length=20, blank=True, default='')
+    programme_id = models.IntegerField(null=True, blank=True)
+
+    class Meta:
+        index_together = ('user', 'created')
+
+
+class DigestWatermark(models.Model):
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+')
+    sent = models.DateTimeField()
+
+
+class ScheduledDispatch(models.Model):
+    # urgent announcement emails, due at visible_from
+    announcement = models.OneToOneField(Announcement, on_delete=models.CASCADE)
+    due = models.DateTimeField()
+    dispatched = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        index_together = ('dispatched', 'due')
+
+
+class EmailOutbox(models.Model):
+    # one urgent announcement email per recipient, claimed and sent by the outbox worker
+    announcement = models.ForeignKey(Announcement, on_delete=models.CASCADE)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+')
+    status = models.CharField(choices=OUTBOX_STATUSES, max_length=10, default='pending')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    available = models.DateTimeField(default=now)
+    sent = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('announcement', 'user',)
+        index_together = ('status', 'available')
+
+
+class ReadWatermark(models.Model):
+    # announcements published at read_until or earlier are read, unless a ReadStateException says otherwise
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True, related_name='+')
+    read_until = models.DateTimeField()
+    # the groups and programmes the user had when the watermark was last moved or rebased, blank if not yet known
+    audience = models.TextField(blank=True, default='')
+    modified = models.DateTimeField(auto_now=True)
+
+
+class ReadStateException(models.Model):
+    # an unread announcement below the user's watermark, or a read one above it
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+')
+    announcement = models.ForeignKey(Announcement, on_delete=models.CASCADE)
+    is_read = models.BooleanField()
+    created = models.DateTimeField(default=now)
+
+    class Meta:
+        unique_together = ('user', 'announcement',)
+
+
+class AnnouncementReaders(models.Model):
+    # the ids of the users who have read the announcement, as a serialized compressed bitmap
+    announcement = models.OneToOneField(Announcement, on_delete=models.CASCADE, primary_key=True, related_name='+')
+    format = models.CharField(max_length=16)
+    bitmap = models.BinaryField()
+    # the position in the announcement's readers delta log it is up to date with
+    version = models.BigIntegerField(default=0)
+    modified = models.DateTimeField(auto_now=True)
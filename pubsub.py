@@ -0,0 +1,158 @@
+import threading
+from collections import defaultdict, deque
+from time import sleep, monotonic, time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.utils.module_loading import import_string
+
+
+announcements_channel = 'announcements'
+
+_broker = None
+
+
+def user_channel(user_id):
+    return 'user:%d' % user_id
+
+
+class MemoryBroker:
+
+    # in-process only, for tests and single-process development servers
+    def __init__(self, backlog=1000, **options):
+        self._events = defaultdict(lambda: deque(maxlen=backlog))
+        self._seq = defaultdict(int)
+        self._condition = threading.Condition()
+
+    def publish(self, channel, event):
+        with self._condition:
+            self._seq[channel] += 1
+            self._events[channel].append((self._seq[channel], event))
+            self._condition.notify_all()
+            return self._seq[channel]
+
+    def cursors(self, channels):
+        with self._condition:
+            return {channel: self._seq[channel] for channel in channels}
+
+    def read(self, cursors):
+        with self._condition:
+            return self._read(cursors)
+
+    def wait(self, cursors, timeout):
+        with self._condition:
+            self._condition.wait_for(lambda: any(self._seq[c] > s for c, s in cursors.items()), timeout)
+            return self._read(cursors)
+
+    def _read(self, cursors):
+        events = [
+            (channel, seq, event)
+            for channel, since in cursors.items()
+            for seq, event in self._events[channel]
+            if seq > since
+        ]
+        return events, {channel: self._seq[channel] for channel in cursors}
+
+
+class CacheBroker:
+
+    # shared between processes through the cache, a stand-in for a Redis pub/sub backend. A seq is taken before its
+    # event is stored, so readers stop at a missing event until gap_timeout has passed since a later one was published
+    def __init__(self, cache='default', timeout=300, backlog=1000, poll_interval=1.0, gap_timeout=5, **options):
+        self.cache = caches[cache]
+        self.timeout = timeout
+        self.backlog = backlog
+        self.poll_interval = poll_interval
+        self.gap_timeout = gap_timeout
+
+    def _seq_key(self, channel):
+        return 'announcements:pubsub:%s' % channel
+
+    def publish(self, channel, event):
+        key = self._seq_key(channel)
+        self.cache.add(key, 0, None)
+        seq = self.cache.incr(key)
+        self.cache.set('%s:%d' % (key, seq), (time(), event), self.timeout)
+        return seq
+
+    def cursors(self, channels):
+        seqs = self.cache.get_many([self._seq_key(c) for c in channels])
+        return {c: seqs.get(self._seq_key(c), 0) for c in channels}
+
+    def read(self, cursors):
+        latest = self.cursors(cursors.keys())
+        seqs = {
+            channel: range(max(since + 1, latest[channel] - self.backlog + 1), latest[channel] + 1)
+            for channel, since in cursors.items()
+        }
+        keys = ['%s:%d' % (self._seq_key(c), seq) for c, channel_seqs in seqs.items() for seq in channel_seqs]
+        found = self.cache.get_many(keys) if keys else {}
+
+        events = []
+        read_to = {}
+        for channel, channel_seqs in seqs.items():
+            entries = [found.get('%s:%d' % (self._seq_key(channel), seq)) for seq in channel_seqs]
+            read_to[channel] = channel_seqs.start - 1
+            for i, (seq, entry) in enumerate(zip(channel_seqs, entries)):
+                if entry is None and not self._gap_expired(entries[i + 1:]):
+                    break
+                if entry is not None:
+                    events.append((channel, seq, entry[1]))
+                read_to[channel] = seq
+        return events, read_to
+
+    def _gap_expired(self, later):
+        # the publisher of a missing event has had gap_timeout since a later one was stored, or it has expired
+        published = [entry[0] for entry in later if entry is not None]
+        return bool(published) and min(published) <= time() - self.gap_timeout
+
+    def wait(self, cursors, timeout):
+        deadline = monotonic() + timeout
+        while True:
+            events, latest = self.read(cursors)
+            if events or monotonic() >= deadline:
+                return events, latest
+            sleep(min(self.poll_interval, max(0, deadline - monotonic())))
+
+
+BROKERS = {
+    'memory': MemoryBroker,
+    'cache': CacheBroker,
+}
+
+
+def get_broker():
+    # ANNOUNCEMENTS_PUBSUB = {'BACKEND': 'memory' | 'cache' | dotted path, ...options}
+    global _broker
+    if _broker is None:
+        config = dict(getattr(settings, 'ANNOUNCEMENTS_PUBSUB', None) or {})
+        name = config.pop('BACKEND', 'cache')
+        cls = BROKERS[name] if name in BROKERS else import_string(name)
+        _broker = cls(**{k.lower(): v for k, v in config.items()})
+    return _broker
+
+
+def _reset_broker(setting, **kwargs):
+    global _broker
+    if setting == 'ANNOUNCEMENTS_PUBSUB':
+        _broker = None
+
+
+setting_changed.connect(_reset_broker)
+
+
+def publish(channel, event):
+    return get_broker().publish(channel, event)
+
+
+def encode_cursor(cursors, channels):
+    return '.'.join(str(cursors[c]) for c in channels)
+
+
+def decode_cursor(cursor, channels):
+    try:
+        seqs = [int(s) for s in cursor.split('.')]
+    except (AttributeError, ValueError):
+        return None
+    return dict(zip(channels, seqs)) if len(seqs) == len(channels) else None
@@ -0,0 +1,176 @@
+import atexit
+import threading
+from collections import defaultdict
+from logging import getLogger
+from time import sleep, time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import close_old_connections
+from django.utils.module_loading import import_string
+
+
+_buffer = None
+
+
+class MemoryReadBuffer:
+
+    # per worker process, flushed by a background thread; whatever is buffered is lost if the process is killed, and
+    # only this process reads its own buffered state, so use it only where there is a single worker process
+    def __init__(self, flush_interval=5, flush_size=500, **options):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._pending = defaultdict(dict)
+        self._lock = threading.Lock()
+        self._flusher = None
+
+    def add(self, user_id, announcement_id, marked_read):
+        with self._lock:
+            self._pending[user_id][announcement_id] = marked_read
+            return sum(map(len, self._pending.values()))
+
+    def pending_for_user(self, user_id):
+        with self._lock:
+            return dict(self._pending.get(user_id, {}))
+
+    def flush(self, apply):
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(dict)
+        try:
+            apply([(u, a, m) for u, states in pending.items() for a, m in states.items()])
+        except Exception:
+            # put them back, behind anything buffered since
+            with self._lock:
+                for user_id, states in pending.items():
+                    for announcement_id, marked_read in states.items():
+                        self._pending[user_id].setdefault(announcement_id, marked_read)
+            raise
+
+    def start(self, flush):
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run, args=(flush,), daemon=True)
+                self._flusher.start()
+                atexit.register(flush)
+
+    def _run(self, flush):
+        while True:
+            sleep(self.flush_interval)
+            close_old_connections()
+            try:
+                flush()
+            except Exception:
+                getLogger(__name__).exception('Failed to flush the read buffer')
+            finally:
+                close_old_connections()
+
+
+class CacheReadBuffer:
+
+    # shared between processes through the cache, flushed by ./manage.py flush_read_buffer; each user's states
+    # are a log of sequence-numbered keys, and a global log records which users have something to flush. A seq is
+    # taken before its entry is stored, so a missing entry is waited for until gap_timeout has passed since a later
+    # one was stored, and skipped after that as lost
+    def __init__(self, cache='default', timeout=86400, flush_size=500, gap_timeout=30, **options):
+        self.cache = caches[cache]
+        self.timeout = timeout
+        self.flush_size = flush_size
+        self.gap_timeout = gap_timeout
+
+    def _key(self, user_id=None):
+        return 'announcements:readbuffer' if user_id is None else 'announcements:readbuffer:user:%d' % user_id
+
+    def _append(self, key, value):
+        self.cache.add(key, 0, None)
+        seq = self.cache.incr(key)
+        self.cache.set('%s:%d' % (key, seq), (time(), value), self.timeout)
+        return seq
+
+    def add(self, user_id, announcement_id, marked_read):
+        self._append(self._key(user_id), (announcement_id, marked_read))
+        seq = self._append(self._key(), user_id)
+        return seq - (self.cache.get('%s:flushed' % self._key()) or 0)
+
+    def pending_for_user(self, user_id):
+        entries, _stalled = self._read(self._key(user_id))
+        return dict(state for _seq, state in entries if state is not None)
+
+    def flush(self, apply):
+        lock = '%s:lock' % self._key()
+        if not self.cache.add(lock, 1, 60):
+            return
+        try:
+            dirty, _stalled = self._read(self._key())
+            states = []
+            flushed = {}
+            stalled = []
+            for user_id in set(user_id for _seq, user_id in dirty if user_id is not None):
+                log, user_stalled = self._read(self._key(user_id))
+                states.extend(
+                    (user_id, a, m) for a, m in dict(state for _seq, state in log if state is not None).items()
+                )
+                if log:
+                    flushed[user_id] = log[-1][0]
+                if user_stalled:
+                    stalled.append(user_id)
+            apply(states)
+            for user_id, seq in flushed.items():
+                self.cache.set('%s:flushed' % self._key(user_id), seq, None)
+            if dirty:
+                self.cache.set('%s:flushed' % self._key(), dirty[-1][0], None)
+            # users whose log stopped at a gap stay dirty, so the rest of it is flushed next time
+            for user_id in stalled:
+                self._append(self._key(), user_id)
+        finally:
+            self.cache.delete(lock)
+
+    def start(self, flush):
+        pass
+
+    def _read(self, key):
+        # entries after the flushed cursor and whether they stop at a gap, so one still being written is not
+        # skipped. Lost entries are returned as None, so the cursor moves past them
+        cursors = self.cache.get_many([key, '%s:flushed' % key])
+        latest, flushed = cursors.get(key, 0), cursors.get('%s:flushed' % key, 0)
+        keys = ['%s:%d' % (key, seq) for seq in range(flushed + 1, latest + 1)]
+        found = self.cache.get_many(keys) if keys else {}
+        stored = [found.get(k) for k in keys]
+        entries = []
+        for i, seq in enumerate(range(flushed + 1, latest + 1)):
+            if stored[i] is None and not self._gap_expired(stored[i + 1:]):
+                break
+            entries.append((seq, stored[i][1] if stored[i] is not None else None))
+        return entries, len(entries) < len(stored)
+
+    def _gap_expired(self, later):
+        written = [entry[0] for entry in later if entry is not None]
+        return bool(written) and min(written) <= time() - self.gap_timeout
+
+
+BUFFERS = {
+    'memory': MemoryReadBuffer,
+    'cache': CacheReadBuffer,
+}
+
+
+def get_read_buffer():
+    # ANNOUNCEMENTS_READ_BUFFER = {'BACKEND': 'memory' | 'cache' | dotted path, ...options}, unset to write through
+    global _buffer
+    if _buffer is None:
+        config = dict(getattr(settings, 'ANNOUNCEMENTS_READ_BUFFER', None) or {})
+        if not config:
+            return None
+        name = config.pop('BACKEND', 'cache')
+        cls = BUFFERS[name] if name in BUFFERS else import_string(name)
+        _buffer = cls(**{k.lower(): v for k, v in config.items()})
+    return _buffer
+
+
+def _reset_buffer(setting, **kwargs):
+    global _buffer
+    if setting == 'ANNOUNCEMENTS_READ_BUFFER':
+        _buffer = None
+
+
+setting_changed.connect(_reset_buffer)
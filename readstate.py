@@ -0,0 +1,253 @@
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.db import connection, router, transaction
+from django.db.models import Exists, OuterRef, Value, When
+from django.utils.timezone import now
+
+from .models import UserAnnouncement, ReadWatermark, ReadStateException
+from .routers import pin_to_primary
+
+
+# read state as a per-user watermark plus exceptions, instead of a UserAnnouncement row per read announcement.
+# The watermark is on Announcement.published, which only moves forward, so an announcement backdated below it is
+# still unread. visible is a function returning the announcements the user can see now, only called when it is
+# needed. If it also has an audience, and an addressed_to(announcement, audience) saying whether an announcement was
+# addressed to an earlier one, announcements below the watermark the user only sees since their audience changed
+# are kept unread
+
+# the watermark of a user who has read nothing
+epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def uses_watermarks():
+    # ANNOUNCEMENTS_READ_STATE = 'rows' | 'watermark'
+    return getattr(settings, 'ANNOUNCEMENTS_READ_STATE', 'rows') == 'watermark'
+
+
+def get_watermark(user, visible):
+    # read from the replica when reads are routed to one, and from the primary when the replica does not have it yet
+    # or it has just been written. Exceptions are read from wherever the watermark was
+    watermark = ReadWatermark.objects.filter(user=user).first()
+    primary = ReadWatermark.objects.db_manager(router.db_for_write(ReadWatermark))
+    if watermark is None:
+        watermark = primary.filter(user=user).first()
+    if watermark is None:
+        # users are migrated from their read receipts the first time they are needed
+        migrate_read_state({user.pk: visible()})
+        watermark = primary.get(user=user)
+        pin_to_primary(user)
+    audience = getattr(visible, 'audience', None)
+    if audience is not None and watermark.audience != audience:
+        _rebase_watermark(user, watermark, visible, audience)
+        watermark = primary.get(user=user)
+        pin_to_primary(user)
+    return watermark
+
+
+def get_marked_read(user, announcements, visible):
+    # {announcement id: when it was marked read} for those of the announcements that are read
+    watermark = get_watermark(user, visible)
+    exceptions = {
+        a: (is_read, created) for a, is_read, created in ReadStateException.objects
+        .using(watermark._state.db)
+        .filter(user=user, announcement_id__in=[a.id for a in announcements])
+        .values_list('announcement_id', 'is_read', 'created')
+    }
+    marked_read = {}
+    for announcement in announcements:
+        if announcement.id in exceptions:
+            is_read, created = exceptions[announcement.id]
+            if is_read:
+                marked_read[announcement.id] = created
+        elif announcement.published <= watermark.read_until:
+            marked_read[announcement.id] = watermark.modified
+    return marked_read
+
+
+def get_read_conditions(user, visible):
+    # When clauses for a Case annotating whether the user has read each announcement
+    watermark = get_watermark(user, visible)
+    exceptions = ReadStateException.objects.filter(user=user, announcement=OuterRef('pk'))
+    return [
+        When(Exists(exceptions.filter(is_read=True)), then=Value(True)),
+        When(Exists(exceptions.filter(is_read=False)), then=Value(False)),
+        When(published__lte=watermark.read_until, then=Value(True)),
+    ]
+
+
+def get_read_since(user, since, visible):
+    # [(when, announcement id)] for announcements marked read since, including those the watermark passed
+    watermark = get_watermark(user, visible)
+    read = list(
+        ReadStateException.objects
+        .using(watermark._state.db)
+        .filter(user=user, is_read=True, created__gt=since)
+        .values_list('created', 'announcement_id')
+    )
+    if watermark.modified > since:
+        unread = set(
+            ReadStateException.objects
+            .using(watermark._state.db)
+            .filter(user=user, is_read=False)
+            .values_list('announcement_id', flat=True)
+        )
+        read.extend(
+            (watermark.modified, a.id) for a in visible()
+            if a.published <= watermark.read_until and a.id not in unread
+        )
+    return read
+
+
+def get_reader_ids(announcement, user_ids):
+    # of the given users, those who have read the announcement, by read receipt for those not yet migrated
+    exceptions = dict(
+        ReadStateException.objects
+        .filter(announcement=announcement)
+        .values_list('user_id', 'is_read')
+    )
+    below = set(
+        ReadWatermark.objects
+        .filter(read_until__gte=announcement.published)
+        .values_list('user_id', flat=True)
+    )
+    unmigrated = set(
+        UserAnnouncement.objects
+        .filter(announcement=announcement)
+        .exclude(user_id__in=ReadWatermark.objects.values('user_id'))
+        .values_list('user_id', flat=True)
+    )
+    return [u for u in user_ids if exceptions.get(u, u in below) or u in unmigrated]
+
+
+def mark_read(user, announcement, visible):
+    # returns whether the announcement was unread
+    watermark = get_watermark(user, visible)
+    with transaction.atomic():
+        if announcement.published <= watermark.read_until:
+            changed, _rows = ReadStateException.objects \
+                .filter(user=user, announcement=announcement, is_read=False) \
+                .delete()
+        else:
+            exception, created = ReadStateException.objects.get_or_create(
+                user=user,
+                announcement=announcement,
+                defaults={'is_read': True}
+            )
+            changed = created or not exception.is_read
+            if not created:
+                exception.is_read = True
+                exception.created = now()
+                exception.save()
+        _advance_watermark(user, watermark, visible())
+    return bool(changed)
+
+
+def mark_unread(user, announcement, visible):
+    # returns whether the announcement was read
+    watermark = get_watermark(user, visible)
+    if announcement.published > watermark.read_until:
+        changed, _rows = ReadStateException.objects \
+            .filter(user=user, announcement=announcement, is_read=True) \
+            .delete()
+        return bool(changed)
+
+    exception, created = ReadStateException.objects.get_or_create(
+        user=user,
+        announcement=announcement,
+        defaults={'is_read': False}
+    )
+    if not created and exception.is_read:
+        exception.is_read = False
+        exception.created = now()
+        exception.save()
+        return True
+    return created
+
+
+def keep_unread(announcement, user_ids):
+    # of the given users, those whose watermark has passed the announcement get it as an unread exception, for an
+    # announcement readdressed to them after they had read up to it
+    readers = ReadWatermark.objects \
+        .filter(read_until__gte=announcement.published, user_id__in=user_ids) \
+        .values_list('user_id', flat=True)
+    ReadStateException.objects.bulk_create(
+        (ReadStateException(user_id=u, announcement=announcement, is_read=False) for u in readers),
+        batch_size=1000,
+        ignore_conflicts=True
+    )
+
+
+def migrate_read_state(visible_by_user, delete_rows=False):
+    # {user id: announcements visible to them now}. Each watermark is the newest announcement the user has read,
+    # with the visible announcements before it they have not read kept as exceptions
+    user_ids = list(visible_by_user)
+    read = {}
+    for user_id, announcement_id, published in UserAnnouncement.objects \
+            .filter(user_id__in=user_ids, announcement__published__lte=now()) \
+            .values_list('user_id', 'announcement_id', 'announcement__published'):
+        read.setdefault(user_id, {})[announcement_id] = published
+
+    watermarks = []
+    exceptions = []
+    for user_id in user_ids:
+        user_read = read.get(user_id, {})
+        read_until = max(user_read.values()) if user_read else epoch
+        watermarks.append(ReadWatermark(user_id=user_id, read_until=read_until))
+        exceptions.extend(
+            ReadStateException(user_id=user_id, announcement_id=a.id, is_read=False)
+            for a in visible_by_user[user_id]
+            if a.published <= read_until and a.id not in user_read
+        )
+
+    with transaction.atomic():
+        ReadWatermark.objects.bulk_create(watermarks, batch_size=1000, ignore_conflicts=True)
+        ReadStateException.objects.bulk_create(exceptions, batch_size=1000, ignore_conflicts=True)
+        if delete_rows and user_ids:
+            # raw, so no per-object signals are sent
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'DELETE FROM %s WHERE user_id IN (%s)' % (
+                        connection.ops.quote_name(UserAnnouncement._meta.db_table),
+                        ', '.join(['%s'] * len(user_ids))
+                    ),
+                    user_ids
+                )
+    return len(watermarks), len(exceptions)
+
+
+def _advance_watermark(user, watermark, visible_announcements):
+    # past every visible announcement above it that has been read, so their exceptions can go
+    read = set(
+        ReadStateException.objects
+        .filter(user=user, is_read=True, announcement__published__gt=watermark.read_until)
+        .values_list('announcement_id', flat=True)
+    )
+    read_until = watermark.read_until
+    for announcement in sorted(visible_announcements, key=lambda a: a.published):
+        if announcement.published <= watermark.read_until:
+            continue
+        if announcement.id not in read:
+            break
+        read_until = announcement.published
+
+    if read_until > watermark.read_until:
+        watermark.read_until = read_until
+        watermark.save()
+        ReadStateException.objects \
+            .filter(user=user, is_read=True, announcement__published__lte=read_until) \
+            .delete()
+
+
+def _rebase_watermark(user, watermark, visible, audience):
+    # announcements below the watermark that were not addressed to the user's previous audience have not been seen
+    # by them, so are kept unread. Watermarks from before audiences were recorded just take the current one
+    if watermark.audience:
+        ReadStateException.objects.bulk_create([
+            ReadStateException(user=user, announcement_id=a.id, is_read=False)
+            for a in visible()
+            if a.published <= watermark.read_until and not visible.addressed_to(a, watermark.audience)
+        ], ignore_conflicts=True)
+    # not save(), which would move modified and look like a read to get_read_since
+    ReadWatermark.objects.filter(pk=watermark.pk).update(audience=audience)
+    watermark.audience = audience
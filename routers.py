@@ -0,0 +1,92 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+
+
+# the database reads go to in the current context, None for the router to leave them on the primary
+_read_database = ContextVar('announcements_read_database', default=None)
+
+
+class ReplicaRouter:
+
+    # DATABASE_ROUTERS = ['announcements.routers.ReplicaRouter'], with ANNOUNCEMENTS_REPLICA_DATABASE naming the replica.
+    # Reads go to it only inside reads_from_replica, so commands, the admin and writes stay on the primary
+    route_app_labels = ('announcements', 'programmes')
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label in self.route_app_labels:
+            return _read_database.get()
+        return None
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replica holds the same rows as the primary
+        databases = {DEFAULT_DB_ALIAS, _replica_database()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return None
+
+
+@contextmanager
+def reads_from_replica(user):
+    # unless the user has written recently, so they always read their own writes
+    replica = _replica_database()
+    pinned = replica is None or (user.is_authenticated and caches['default'].get(_pinned_cache_key(user.pk)))
+    token = _read_database.set(None if pinned else replica)
+    try:
+        yield
+    finally:
+        _read_database.reset(token)
+
+
+@contextmanager
+def reads_from_primary():
+    token = _read_database.set(None)
+    try:
+        yield
+    finally:
+        _read_database.reset(token)
+
+
+def pin_to_primary(user):
+    if user.is_authenticated and _replica_database() is not None:
+        caches['default'].set(
+            _pinned_cache_key(user.pk),
+            True,
+            getattr(settings, 'ANNOUNCEMENTS_REPLICA_PIN_SECONDS', 15)
+        )
+
+
+def replica_reads(view):
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        with reads_from_replica(request.user):
+            return view(request, *args, **kwargs)
+    return wrapper
+
+
+def pins_to_primary(view):
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            pin_to_primary(request.user)
+    return wrapper
+
+
+def _replica_database():
+    return getattr(settings, 'ANNOUNCEMENTS_REPLICA_DATABASE', None)
+
+
+def _pinned_cache_key(user_id):
+    return 'announcements.primary.%d' % user_id
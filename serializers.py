@@ -7,9 +7,28 @@ from rest_framework import serializers
 
 from .models import Announcement
 from .domain import announcement_chars_truncate
+from .tracing import span
 
 
-class AnnouncementSerializer(serializers.ModelSerializer):
+class TracedSerializerMixin:
+
+    @property
+    def data(self):
+        with span('serializers.%s.data' % type(self).__name__):
+            return super().data
+
+
+class TracedListSerializer(serializers.ListSerializer):
+
+    @property
+    def data(self):
+        with span('serializers.%s.data' % type(self.child).__name__) as s:
+            data = super().data
+            s.set(rows=len(data))
+            return data
+
+
+class AnnouncementSerializer(TracedSerializerMixin, serializers.ModelSerializer):
 
     programme_name = serializers.SlugRelatedField(
         source='programme',
@@ -21,6 +40,8 @@ class AnnouncementSerializer(serializers.ModelSerializer):
 
     display_id = serializers.SerializerMethodField()
 
+    is_archived = serializers.SerializerMethodField()
+
     @staticmethod
     def get_recipient(obj):
         return getattr(obj, 'recipient', '')
@@ -29,6 +50,10 @@ class AnnouncementSerializer(serializers.ModelSerializer):
     def get_display_id(obj):
         return getattr(obj, 'display_id', obj.id)
 
+    @staticmethod
+    def get_is_archived(obj):
+        return getattr(obj, 'is_archived', False)
+
     def create(self, validated_data):
         validated_data['user'] = self.context['request'].user if self.context['request'].user.is_authenticated else None
         return Announcement.objects.create(**validated_data)
@@ -42,6 +67,7 @@ class AnnouncementSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Announcement
+        list_serializer_class = TracedListSerializer
         fields = (
             'id',
             'subject',
@@ -54,12 +80,16 @@ class AnnouncementSerializer(serializers.ModelSerializer):
             'programme_name',
             'recipient',
             'display_id',
+            'is_archived',
+            'read_count',
+            'recipient_count',
             'modified',
             'created'
         )
+        read_only_fields = ('read_count', 'recipient_count')
 
 
-class UserAnnouncementSerializer(serializers.Serializer):
+class UserAnnouncementSerializer(TracedSerializerMixin, serializers.Serializer):
 
     @staticmethod
     def get_body(obj):
@@ -76,3 +106,6 @@ class UserAnnouncementSerializer(serializers.Serializer):
     marked_read = serializers.DateTimeField(allow_null=True)
     modified = serializers.DateTimeField(allow_null=True, read_only=True)
     body = serializers.SerializerMethodField()
+
+    class Meta:
+        list_serializer_class = TracedListSerializer
@@ -1,49 +1,131 @@
 from functools import partial
-from logging import getLogger
-from smtplib import SMTPException
 
 from django.conf import settings
-from django.core.mail import send_mail
-from django.urls import reverse
+from django.contrib.auth import get_user_model
+from django.db import transaction
 from django.db.models import signals
-from django.template import loader
-
-from .models import Announcement
-from .domain import get_announcement_recipients
-
-
-def send_announcement_emails(sender, **kwargs):
-    announcement = kwargs.get('instance')
-    if kwargs.get('created') and announcement.is_urgent:
-        recipients = get_announcement_recipients(announcement)
-        subject = loader.get_template('announcements/email/announcement_email_subject.txt')
-        body = loader.get_template('announcements/email/announcement_email.txt')
-
-        # get emails as a data-tuples (subject, message, from_email, recipient_list)
-        emails = map(
-            partial(_get_email_datatuple, subject=subject, body=body),
-            [r for r in recipients if r.email != '']
-        )
-
-        for email in emails:
-            try:
-                send_mail(*email)
-            except SMTPException as e:
-                logger = getLogger(__name__)
-                logger.error(e.args[0])
-
-
-def _get_email_datatuple(user, subject, body):
-    name = ' '.join([user.first_name, user.last_name]).strip()
-    return (
-        ''.join(subject.render().splitlines()),
-        body.render({
-            'recipient_name': user.username if name == '' else name,
-            'hub_url': settings.WWWROOT + reverse('my_hub')
-        }),
-        None,
-        [user.email]
-    )
-
-
-signals.post_save.connect(send_announcement_emails, sender=Announcement)
+from django.utils.timezone import now
+
+from .models import Announcement, UserAnnouncement
+from programmes.models import UserProgramme
+from .domain import (count_announcement_recipients, invalidate_announcement_reach, invalidate_announcements_cache,
+                     invalidate_announcements_cache_for_user, keep_readdressed_announcement_unread,
+                     set_announcement_published, tombstone_audience_change)
+from .emails import schedule_announcement_emails, dispatch_due_announcement_emails, send_outbox_emails
+from .pubsub import publish, announcements_channel, user_channel
+
+
+def schedule_urgent_announcement_emails(sender, instance, **kwargs):
+    due = schedule_announcement_emails(instance)
+    if due is not None and due <= now():
+        transaction.on_commit(_dispatch_announcement_emails)
+
+
+def tombstone_previous_audience(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or {'audience', 'programme'} & set(update_fields):
+        tombstone_audience_change(instance)
+
+
+def keep_readdressed_announcement_unread_on_save(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or {'audience', 'programme'} & set(update_fields):
+        keep_readdressed_announcement_unread(instance)
+
+
+def update_announcement_published(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or 'visible_from' in update_fields:
+        set_announcement_published(instance)
+        if update_fields is not None:
+            Announcement.objects.filter(pk=instance.pk).update(published=instance.published)
+
+
+def update_announcement_recipient_count(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not {'audience', 'programme'} & set(update_fields):
+        return
+    instance.recipient_count = count_announcement_recipients(instance)
+    Announcement.objects.filter(pk=instance.pk).update(recipient_count=instance.recipient_count)
+
+
+def invalidate_announcements_cache_on_change(sender, **kwargs):
+    _invalidate_on_commit(invalidate_announcements_cache)
+
+
+def invalidate_reach_on_user_saved(sender, instance, update_fields=None, **kwargs):
+    # logins save last_login only, which does not change who is reached
+    if update_fields is None or {'is_active', 'email'} & set(update_fields):
+        invalidate_announcement_reach()
+
+
+def invalidate_reach_on_user_deleted(sender, instance, **kwargs):
+    invalidate_announcement_reach()
+
+
+def invalidate_on_groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    invalidate_announcement_reach()
+    if not reverse:
+        _invalidate_on_commit(invalidate_announcements_cache_for_user, instance.pk)
+    elif pk_set is None:
+        _invalidate_on_commit(invalidate_announcements_cache)
+    else:
+        for user_id in pk_set:
+            _invalidate_on_commit(invalidate_announcements_cache_for_user, user_id)
+
+
+def invalidate_on_programmes_changed(sender, instance, **kwargs):
+    invalidate_announcement_reach()
+    _invalidate_on_commit(invalidate_announcements_cache_for_user, instance.user_id)
+
+
+def publish_announcement_saved(sender, instance, created=False, **kwargs):
+    _publish_on_commit(announcements_channel, {'type': 'created' if created else 'updated', 'announcement_id': instance.pk})
+
+
+def publish_announcement_deleted(sender, instance, **kwargs):
+    _publish_on_commit(announcements_channel, {'type': 'deleted', 'announcement_id': instance.pk})
+
+
+def publish_user_announcement_saved(sender, instance, **kwargs):
+    _publish_on_commit(user_channel(instance.user_id), {'type': 'read', 'announcement_id': instance.announcement_id})
+
+
+def publish_user_announcement_deleted(sender, instance, **kwargs):
+    _publish_on_commit(user_channel(instance.user_id), {'type': 'unread', 'announcement_id': instance.announcement_id})
+
+
+def _dispatch_announcement_emails():
+    dispatch_due_announcement_emails()
+    # without a worker running send_email_outbox, the outbox is drained here
+    if getattr(settings, 'ANNOUNCEMENTS_OUTBOX_SEND_INLINE', True):
+        while sum(send_outbox_emails()) > 0:
+            pass
+
+
+def _invalidate_on_commit(invalidate, *args):
+    # now for this transaction's own reads, and again after the commit so that a list built by another
+    # request from the old rows in the meantime is never served under the new version
+    invalidate(*args)
+    transaction.on_commit(partial(invalidate, *args))
+
+
+def _publish_on_commit(channel, event):
+    # subscribers re-read the database, so only publish what has been committed
+    transaction.on_commit(partial(publish, channel, event))
+
+
+signals.pre_save.connect(tombstone_previous_audience, sender=Announcement)
+signals.pre_save.connect(keep_readdressed_announcement_unread_on_save, sender=Announcement)
+signals.pre_save.connect(update_announcement_published, sender=Announcement)
+signals.post_save.connect(update_announcement_recipient_count, sender=Announcement)
+signals.post_save.connect(schedule_urgent_announcement_emails, sender=Announcement)
+signals.post_save.connect(publish_announcement_saved, sender=Announcement)
+signals.post_delete.connect(publish_announcement_deleted, sender=Announcement)
+signals.post_save.connect(publish_user_announcement_saved, sender=UserAnnouncement)
+signals.post_delete.connect(publish_user_announcement_deleted, sender=UserAnnouncement)
+signals.post_save.connect(invalidate_announcements_cache_on_change, sender=Announcement)
+signals.post_delete.connect(invalidate_announcements_cache_on_change, sender=Announcement)
+signals.post_save.connect(invalidate_reach_on_user_saved, sender=get_user_model())
+signals.post_delete.connect(invalidate_reach_on_user_deleted, sender=get_user_model())
+signals.m2m_changed.connect(invalidate_on_groups_changed, sender=get_user_model().groups.through)
+signals.post_save.connect(invalidate_on_programmes_changed, sender=UserProgramme)
+signals.post_delete.connect(invalidate_on_programmes_changed, sender=UserProgramme)
@@ -0,0 +1,290 @@
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.utils.timezone import now
+from django.utils.translation import gettext as _
+
+import pytest
+
+from programmes.models import Programme, UserProgramme, MasterCourse, ProgrammeMasterCourse, ScheduledCourse, ScheduledCourseGroup
+from announcements.models import AUDIENCES
+from announcements.models import Announcement, UserAnnouncement
+
+
+@pytest.fixture
+def tnow():
+    return now()
+
+
+@pytest.fixture
+def programmes():
+    p1 = Programme.objects.create(display_name='Programme 1')
+    p2 = Programme.objects.create(display_name='Programme 2')
+    p3 = Programme.objects.create(display_name='Programme 3')
+    p4 = Programme.objects.create(display_name='Programme 4')
+    return [p1, p2, p3, p4]
+
+
+@pytest.fixture
+def master_courses():
+    mc1 = MasterCourse.objects.create(display_name='Master A', vle_course_id='A')
+    mc2 = MasterCourse.objects.create(display_name='Master B', vle_course_id='B')
+    mc3 = MasterCourse.objects.create(display_name='Master C', vle_course_id='C')
+    mc4 = MasterCourse.objects.create(display_name='Master D', vle_course_id='D')
+    mc5 = MasterCourse.objects.create(display_name='Master E', vle_course_id='E')
+    return [mc1, mc2, mc3, mc4, mc5]
+
+
+@pytest.fixture
+def programme_master_courses(programmes, master_courses):
+    pmc1a = ProgrammeMasterCourse.objects.create(programme=programmes[0], master_course=master_courses[0], available=True)
+    pmc1b = ProgrammeMasterCourse.objects.create(programme=programmes[0], master_course=master_courses[1], available=True)
+    pmc1c = ProgrammeMasterCourse.objects.create(programme=programmes[0], master_course=master_courses[2], available=True)
+    pmc2b = ProgrammeMasterCourse.objects.create(programme=programmes[1], master_course=master_courses[1], available=True)
+    pmc2c = ProgrammeMasterCourse.objects.create(programme=programmes[1], master_course=master_courses[2], available=True)
+    pmc2d = ProgrammeMasterCourse.objects.create(programme=programmes[1], master_course=master_courses[3], available=False)
+    pmc3e = ProgrammeMasterCourse.objects.create(programme=programmes[2], master_course=master_courses[4], available=True)
+    return [pmc1a, pmc1b, pmc1c, pmc2b, pmc2c, pmc2d, pmc3e]
+
+
+@pytest.fixture
+def scheduled_courses(master_courses):
+    sc1a = ScheduledCourse.objects.create(master_course=master_courses[0], display_name='A001', vle_course_id='A001')
+    sc1b = ScheduledCourse.objects.create(master_course=master_courses[0], display_name='A002', vle_course_id='A002')
+    sc1c = ScheduledCourse.objects.create(master_course=master_courses[0], display_name='A003', vle_course_id='A003')
+    sc2a = ScheduledCourse.objects.create(master_course=master_courses[1], display_name='B001', vle_course_id='B001')
+    sc2b = ScheduledCourse.objects.create(master_course=master_courses[1], display_name='B002', vle_course_id='B002')
+    sc3a = ScheduledCourse.objects.create(master_course=master_courses[2], display_name='C001', vle_course_id='C001')
+    return [sc1a, sc1b, sc1c, sc2a, sc2b, sc3a]
+
+
+@pytest.fixture
+def scheduled_course_groups(scheduled_courses):
+    scg1aa = ScheduledCourseGroup.objects.create(scheduled_course=scheduled_courses[0], display_name='A001/A', vle_group_id='A001/A')
+    scg1ab = ScheduledCourseGroup.objects.create(scheduled_course=scheduled_courses[0], display_name='A001/B', vle_group_id='A001/B')
+    scg1ac = ScheduledCourseGroup.objects.create(scheduled_course=scheduled_courses[0], display_name='A001/C', vle_group_id='A001/C')
+    scg1ba = ScheduledCourseGroup.objects.create(scheduled_course=scheduled_courses[1], display_name='A002/A', vle_group_id='A002/A')
+    scg1bb = ScheduledCourseGroup.objects.create(scheduled_course=scheduled_courses[1], display_name='A002/B', vle_group_id='A002/B')
+    scg1bc = ScheduledCourseGroup.objects.create(scheduled_course=scheduled_courses[1], display_name='A002/C', vle_group_id='A002/C')
+    scg1ca = ScheduledCourseGroup.objects.create(scheduled_course=scheduled_courses[2], display_name='A003/A', vle_group_id='A003/A')
+    return [scg1aa, scg1ab, scg1ac, scg1ba, scg1bb, scg1bc, scg1ca]
+
+
+@pytest.fixture
+def groups():
+    students = Group.objects.create(name='students')
+    tutors = Group.objects.create(name='tutors')
+    return [students, tutors]
+
+
+@pytest.fixture
+def users(groups, programmes):
+    students = groups[0]
+    tutors = groups[1]
+
+    admin = get_user_model().objects.create(
+        username='admin',
+        first_name='The',
+        last_name='Boss',
+        is_superuser=True,
+        is_staff=True
+    )
+
+    tyrion = get_user_model().objects.create(
+        username='tyrion.lannister',
+        first_name='Tyrion',
+        last_name='Lannister',
+    )
+
+    sansa = get_user_model().objects.create(
+        username='sansa.stark',
+        first_name='Sansa',
+        last_name='Stark',
+    )
+
+    arya = get_user_model().objects.create(
+        username='arya.stark',
+        first_name='Arya',
+        last_name='Stark',
+    )
+
+    student_a = get_user_model().objects.create(
+        username='student.a',
+        first_name='Student',
+        last_name='A',
+    )
+    student_a.groups.add(students)
+
+    student_b = get_user_model().objects.create(
+        username='student.b',
+        first_name='Student',
+        last_name='B',
+    )
+    student_b.groups.add(students)
+    UserProgramme.objects.create(programme=programmes[0], user=student_b)
+    UserProgramme.objects.create(programme=programmes[2], user=student_b)
+
+    student_c = get_user_model().objects.create(
+        username='student.c',
+        first_name='Student',
+        last_name='C',
+    )
+    student_c.groups.add(students)
+    UserProgramme.objects.create(programme=programmes[0], user=student_c)
+
+    student_d = get_user_model().objects.create(
+        username='student.d',
+        first_name='Student',
+        last_name='D',
+    )
+    student_d.groups.add(students)
+    UserProgramme.objects.create(programme=programmes[0], user=student_d)
+
+    tutor_a = get_user_model().objects.create(
+        username='tutor.a',
+        first_name='Tutor',
+        last_name='A',
+    )
+    tutor_a.groups.add(tutors)
+
+    tutor_b = get_user_model().objects.create(
+        username='tutor.b',
+        first_name='Tutor',
+        last_name='B',
+    )
+    tutor_b.groups.add(tutors)
+    UserProgramme.objects.create(programme=programmes[1], user=tutor_b)
+    UserProgramme.objects.create(programme=programmes[2], user=tutor_b)
+
+    inactive = get_user_model().objects.create(
+        username='inactive',
+        first_name='In',
+        last_name='Active',
+        is_active=False
+    )
+
+    return [admin, tyrion, sansa, arya, student_a, tutor_a, student_b, tutor_b, student_c, student_d, inactive]
+
+
+@pytest.fixture
+def announcements(users, programmes, scheduled_courses, scheduled_course_groups, tnow):
+    admin = users[0]
+    a1 = Announcement.objects.create(
+        subject='subject 01 (to all)',
+        body='body 1',
+        audience='all',
+        visible_from=tnow - timedelta(seconds=1),
+        visible_to=tnow + timedelta(days=1),
+        user=admin
+    )
+    a2 = Announcement.objects.create(
+        subject='subject 02 (Urgent! - to all)',
+        body='body 2',
+        audience='all',
+        is_urgent=True,
+        visible_from=tnow - timedelta(seconds=3),
+        visible_to=tnow + timedelta(days=1),
+        user=admin
+    )
+    a3 = Announcement.objects.create(
+        subject='subject 03 (to students)',
+        body='body 3',
+        audience='students',
+        visible_from=tnow - timedelta(seconds=2),
+        visible_to=tnow + timedelta(days=1),
+        user=admin
+    )
+    a4 = Announcement.objects.create(
+        subject='subject 04 (to students and tutors)',
+        body='body 4',
+        audience='students_and_tutors',
+        visible_from=tnow - timedelta(seconds=5),
+        visible_to=tnow + timedelta(days=1),
+        user=admin
+    )
+    a5 = Announcement.objects.create(
+        subject='subject 05 (to tutors)',
+        body='body 5',
+        audience='tutors',
+        visible_from=tnow - timedelta(seconds=4),
+        visible_to=tnow + timedelta(days=1),
+        user=admin
+    )
+    a6 = Announcement.objects.create(
+        subject='subject 06 (to students on programme 1)',
+        body='body 6',
+        audience='students',
+        programme=programmes[0],
+        visible_from=tnow - timedelta(seconds=7),
+        visible_to=tnow + timedelta(days=1),
+        user=admin
+    )
+    a7 = Announcement.objects.create(
+        subject='subject 07 (to tutors on programme 2)',
+        body='body 7',
+        audience='tutors',
+        programme=programmes[1],
+        visible_from=tnow - timedelta(seconds=6),
+        visible_to=tnow + timedelta(days=1),
+        user=admin
+    )
+    a8 = Announcement.objects.create(
+        subject='subject 08 (to students and tutors on programme 3)',
+        body='body 8',
+        audience='students_and_tutors',
+        programme=programmes[2],
+        visible_from=tnow - timedelta(seconds=9),
+        visible_to=tnow + timedelta(days=1),
+        user=admin
+    )
+    a9 = Announcement.objects.create(
+        subject='subject 09 (visible from yesterday)',
+        body='body 9',
+        audience='students',
+        visible_from=tnow - timedelta(days=1),
+        visible_to=tnow + timedelta(days=1),
+        user=admin
+    )
+    a10 = Announcement.objects.create(
+        subject='subject 10 (visible from yesterday)',
+        body='body 10',
+        audience='students',
+        visible_from=tnow - timedelta(days=1, seconds=1),
+        visible_to=tnow + timedelta(days=1),
+        user=admin
+    )
+    return [a1, a2, a3, a4, a5, a6, a7, a8, a9, a10]
+
+
+@pytest.fixture
+def user_announcements(users, announcements):
+    tyrion = users[1]
+    sansa = users[2]
+    ua1a = UserAnnouncement.objects.create(
+        announcement=announcements[0],
+        user=tyrion
+    )
+    ua1b = UserAnnouncement.objects.create(
+        announcement=announcements[1],
+        user=tyrion
+    )
+    ua1c = UserAnnouncement.objects.create(
+        announcement=announcements[2],
+        user=tyrion
+    )
+    ua2a = UserAnnouncement.objects.create(
+        announcement=announcements[0],
+        user=sansa
+    )
+    return [ua1a, ua1b, ua1c, ua2a]
+
+
+@pytest.fixture
+def announcements_with_recipients(announcements):
+    def recipient(a):
+        if a.programme is not None:
+            return '\n'.join([_('Programme'), a.programme.display_name])
+        return dict(AUDIENCES).get(a.audience, None)
+
+    return map(lambda a: (a, recipient(a)), announcements)
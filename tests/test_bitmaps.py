@@ -0,0 +1,81 @@
+import random
+
+from django.core.cache import caches
+
+import pytest
+
+from announcements.bitmaps import RoaringBitmap
+from announcements.domain import (get_announcement_readers, get_announcement_read_stats, get_unread_recipients,
+                                  get_announcement_recipients, mark_announcement_read_for_user,
+                                  mark_announcement_unread_for_user)
+from announcements.models import AnnouncementReaders, UserAnnouncement
+
+
+def test_roaring_bitmap_matches_set():
+    rng = random.Random(42)
+    # sparse and dense containers, either side of the array/bitset threshold
+    a = set(rng.sample(range(200000), 3000)) | set(range(70000, 80000))
+    b = set(rng.sample(range(200000), 20000))
+    ba, bb = RoaringBitmap(a), RoaringBitmap(b)
+
+    assert len(ba) == len(a) and list(ba) == sorted(a)
+    assert set(ba & bb) == a & b
+    assert set(ba - bb) == a - b
+    assert set(ba | bb) == a | b
+    assert 70001 in ba and 200001 not in ba
+    assert RoaringBitmap.deserialize(ba.serialize()) == ba
+
+    for value in range(70000, 79000):
+        ba.discard(value)
+    a -= set(range(70000, 79000))
+    assert list(ba) == sorted(a)
+    assert list(RoaringBitmap.deserialize(ba.serialize())) == sorted(a)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_announcement_readers_are_kept_up_to_date(users, user_announcements, announcements):
+    caches['default'].clear()
+    tyrion, sansa = users[1], users[2]
+    assert set(get_announcement_readers(announcements[0])) == {tyrion.pk, sansa.pk}
+    assert AnnouncementReaders.objects.filter(announcement=announcements[0]).exists()
+
+    mark_announcement_unread_for_user(announcements[0].pk, tyrion)
+    mark_announcement_read_for_user(announcements[0].pk, users[3])
+    assert set(get_announcement_readers(announcements[0])) == {sansa.pk, users[3].pk}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_readers_deltas_are_merged_without_a_rescan_unless_lost(users, user_announcements, announcements):
+    caches['default'].clear()
+    tyrion, sansa = users[1], users[2]
+    get_announcement_readers(announcements[0])
+    stored = AnnouncementReaders.objects.get(announcement=announcements[0])
+
+    mark_announcement_unread_for_user(announcements[0].pk, tyrion)
+    mark_announcement_read_for_user(announcements[0].pk, users[3])
+    assert AnnouncementReaders.objects.get(announcement=announcements[0]).bitmap == stored.bitmap
+
+    # the read receipts are gone, so only the deltas can say who has read it
+    UserAnnouncement.objects.filter(announcement=announcements[0]).exclude(user=users[3]).delete()
+    assert set(get_announcement_readers(announcements[0])) == {sansa.pk, users[3].pk}
+    merged = AnnouncementReaders.objects.get(announcement=announcements[0])
+    assert merged.version == stored.version + 2
+
+    # a lost delta means a rescan
+    mark_announcement_read_for_user(announcements[0].pk, tyrion)
+    caches['default'].delete('announcements.readers.log.%d.%d' % (announcements[0].pk, merged.version + 1))
+    assert set(get_announcement_readers(announcements[0])) == {tyrion.pk, users[3].pk}
+
+
+@pytest.mark.django_db
+def test_unread_recipients_and_read_stats(users, user_announcements, announcements):
+    recipients = set(get_announcement_recipients(announcements[0]).values_list('id', flat=True))
+    read = {users[1].pk, users[2].pk} & recipients
+
+    assert set(get_unread_recipients(announcements[0]).values_list('id', flat=True)) == recipients - read
+    assert get_announcement_read_stats(announcements[0]) == {
+        'recipients': len(recipients),
+        'read': len(read),
+        'unread': len(recipients - read),
+        'other_readers': 0,
+    }
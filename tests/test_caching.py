@@ -0,0 +1,82 @@
+from threading import Thread
+from time import sleep, time
+
+from django.core.cache import caches
+
+import pytest
+
+from announcements import caching
+from announcements.caching import get_or_compute, memoised, request_memo
+
+
+@pytest.fixture
+def cache():
+    cache = caches['default']
+    cache.clear()
+    caching.stats.clear()
+    return cache
+
+
+def test_get_or_compute_hits_and_refreshes(cache):
+    assert get_or_compute(cache, 'test', 'k', lambda: 1, version=1) == 1
+    assert get_or_compute(cache, 'test', 'k', lambda: 2, version=1) == 1
+    assert get_or_compute(cache, 'test', 'k', lambda: 3, version=2) == 3
+    assert get_or_compute(cache, 'test', 'k', lambda: 4, version=2, valid=lambda value: value > 3) == 4
+    assert caching.stats == {('test', 'misses'): 1, ('test', 'hits'): 1, ('test', 'refreshes'): 2}
+
+
+def test_get_or_compute_serves_stale_while_another_process_refreshes(cache):
+    get_or_compute(cache, 'test', 'k', lambda: 1, version=1)
+    cache.add('k.lock', 1)
+    assert get_or_compute(cache, 'test', 'k', lambda: 2, version=2) == 1
+    assert caching.stats['test', 'stale'] == 1
+
+    cache.delete('k.lock')
+    assert get_or_compute(cache, 'test', 'k', lambda: 2, version=2) == 2
+
+
+def test_get_or_compute_computes_once_when_nothing_is_cached(cache):
+    computed = []
+
+    def compute():
+        computed.append(1)
+        sleep(0.2)
+        return 'value'
+
+    results = []
+    threads = [Thread(target=lambda: results.append(get_or_compute(cache, 'test', 'k', compute))) for _i in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ['value'] * 5
+    assert len(computed) == 1
+
+
+def test_get_or_compute_stops_waiting_for_another_process_without_taking_its_lock(settings, cache):
+    settings.ANNOUNCEMENTS_CACHE_LOCK_WAIT = 0.1
+    cache.add('k.lock', 1)
+    assert get_or_compute(cache, 'test', 'k', lambda: 1) == 1
+    assert cache.get('k.lock') == 1
+
+
+def test_get_or_compute_jitters_the_timeout(settings, cache):
+    settings.ANNOUNCEMENTS_CACHE_JITTER = 0.5
+    get_or_compute(cache, 'test', 'k', lambda: 1, timeout=100)
+    assert 50 <= cache.get('k')['fresh_until'] - time() <= 100
+    get_or_compute(cache, 'test', 'j', lambda: 1, timeout=lambda value: 0)
+    assert cache.get('j') is None
+
+
+def test_memoised_only_inside_a_request_memo():
+    computed = []
+
+    def compute():
+        computed.append(1)
+        return len(computed)
+
+    assert memoised('k', compute) == 1
+    with request_memo():
+        assert memoised('k', compute) == 2
+        assert memoised('k', compute) == 2
+    assert memoised('k', compute) == 3
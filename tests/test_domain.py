@@ -1,24 +1,33 @@
 from datetime import timedelta
+from time import time
+from types import SimpleNamespace
 
+from django.core import signing
 from django.core.cache import caches
-from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
 from django.utils.timezone import now
-from django.utils.translation import gettext as _
 
 import pytest
 from mock import patch
-from rest_framework.exceptions import PermissionDenied
+from rest_framework.exceptions import PermissionDenied, ValidationError
+from rest_framework.test import APIRequestFactory, force_authenticate
 
-from programmes.models import Programme, UserProgramme, MasterCourse, ProgrammeMasterCourse, ScheduledCourse, ScheduledCourseGroup
+from programmes.models import ScheduledCourse, ScheduledCourseGroup
 from announcements.models import AUDIENCES
-from announcements.models import Announcement, UserAnnouncement
+from announcements.models import (Announcement, UserAnnouncement, ArchivedAnnouncement, ArchivedUserAnnouncement,
+                                  AnnouncementTombstone)
 from announcements.domain import (get_audiences_and_programmes, get_master_courses, get_scheduled_courses, get_scheduled_course_groups,
                                   get_visible_announcements_for_user, get_announcements_marked_read_for_user, get_announcements,
-                                  get_announcement, get_announcement_options, add_announcement, update_announcement,
-                                  delete_announcement, get_announcement_recipients)
-from announcements.domain import course_and_group_memberships_cache_key
-from announcements.serializers import AnnouncementSerializer
+                                  get_announcement, get_announcement_options, delete_announcement, get_announcement_recipients,
+                                  archive_expired_announcements,
+                                  purge_announcement, purge_deleted_announcements, announcement_purged,
+                                  get_announcement_changes_for_user, mark_announcement_read_for_user,
+                                  mark_announcement_unread_for_user, reconcile_announcement_counters,
+                                  get_announcement_reach, get_cached_for_user, _search_cache,
+                                  get_visible_announcements_page_for_user, get_user_context, sync_token_salt)
+from announcements.domain import course_and_group_memberships_cache_key, _classify_q_token, _course, _group
+from announcements import views_json_api
+from announcements.caching import request_memo
 
 
 def fst(list):
@@ -29,284 +38,6 @@ def snd(list):
     return list[1]
 
 
-@pytest.fixture
-def tnow():
-    return now()
-
-
-@pytest.fixture
-def programmes():
-    p1 = Programme.objects.create(display_name='Programme 1')
-    p2 = Programme.objects.create(display_name='Programme 2')
-    p3 = Programme.objects.create(display_name='Programme 3')
-    p4 = Programme.objects.create(display_name='Programme 4')
-    return [p1, p2, p3, p4]
-
-
-@pytest.fixture
-def master_courses():
-    mc1 = MasterCourse.objects.create(display_name='Master A', vle_course_id='A')
-    mc2 = MasterCourse.objects.create(display_name='Master B', vle_course_id='B')
-    mc3 = MasterCourse.objects.create(display_name='Master C', vle_course_id='C')
-    mc4 = MasterCourse.objects.create(display_name='Master D', vle_course_id='D')
-    mc5 = MasterCourse.objects.create(display_name='Master E', vle_course_id='E')
-    return [mc1, mc2, mc3, mc4, mc5]
-
-
-@pytest.fixture
-def programme_master_courses(programmes, master_courses):
-    pmc1a = ProgrammeMasterCourse.objects.create(programme=programmes[0], master_course=master_courses[0], available=True)
-    pmc1b = ProgrammeMasterCourse.objects.create(programme=programmes[0], master_course=master_courses[1], available=True)
-    pmc1c = ProgrammeMasterCourse.objects.create(programme=programmes[0], master_course=master_courses[2], available=True)
-    pmc2b = ProgrammeMasterCourse.objects.create(programme=programmes[1], master_course=master_courses[1], available=True)
-    pmc2c = ProgrammeMasterCourse.objects.create(programme=programmes[1], master_course=master_courses[2], available=True)
-    pmc2d = ProgrammeMasterCourse.objects.create(programme=programmes[1], master_course=master_courses[3], available=False)
-    pmc3e = ProgrammeMasterCourse.objects.create(programme=programmes[2], master_course=master_courses[4], available=True)
-    return [pmc1a, pmc1b, pmc1c, pmc2b, pmc2c, pmc2d, pmc3e]
-
-
-@pytest.fixture
-def scheduled_courses(master_courses):
-    sc1a = ScheduledCourse.objects.create(master_course=master_courses[0], display_name='A001', vle_course_id='A001')
-    sc1b = ScheduledCourse.objects.create(master_course=master_courses[0], display_name='A002', vle_course_id='A002')
-    sc1c = ScheduledCourse.objects.create(master_course=master_courses[0], display_name='A003', vle_course_id='A003')
-    sc2a = ScheduledCourse.objects.create(master_course=master_courses[1], display_name='B001', vle_course_id='B001')
-    sc2b = ScheduledCourse.objects.create(master_course=master_courses[1], display_name='B002', vle_course_id='B002')
-    sc3a = ScheduledCourse.objects.create(master_course=master_courses[2], display_name='C001', vle_course_id='C001')
-    return [sc1a, sc1b, sc1c, sc2a, sc2b, sc3a]
-
-
-@pytest.fixture
-def scheduled_course_groups(scheduled_courses):
-    scg1aa = ScheduledCourseGroup.objects.create(scheduled_course=scheduled_courses[0], display_name='A001/A', vle_group_id='A001/A')
-    scg1ab = ScheduledCourseGroup.objects.create(scheduled_course=scheduled_courses[0], display_name='A001/B', vle_group_id='A001/B')
-    scg1ac = ScheduledCourseGroup.objects.create(scheduled_course=scheduled_courses[0], display_name='A001/C', vle_group_id='A001/C')
-    scg1ba = ScheduledCourseGroup.objects.create(scheduled_course=scheduled_courses[1], display_name='A002/A', vle_group_id='A002/A')
-    scg1bb = ScheduledCourseGroup.objects.create(scheduled_course=scheduled_courses[1], display_name='A002/B', vle_group_id='A002/B')
-    scg1bc = ScheduledCourseGroup.objects.create(scheduled_course=scheduled_courses[1], display_name='A002/C', vle_group_id='A002/C')
-    scg1ca = ScheduledCourseGroup.objects.create(scheduled_course=scheduled_courses[2], display_name='A003/A', vle_group_id='A003/A')
-    return [scg1aa, scg1ab, scg1ac, scg1ba, scg1bb, scg1bc, scg1ca]
-
-
-@pytest.fixture
-def groups():
-    students = Group.objects.create(name='students')
-    tutors = Group.objects.create(name='tutors')
-    return [students, tutors]
-
-
-@pytest.fixture
-def users(groups, programmes):
-    students = groups[0]
-    tutors = groups[1]
-
-    admin = get_user_model().objects.create(
-        username='admin',
-        first_name='The',
-        last_name='Boss',
-        is_superuser=True,
-        is_staff=True
-    )
-
-    tyrion = get_user_model().objects.create(
-        username='tyrion.lannister',
-        first_name='Tyrion',
-        last_name='Lannister',
-    )
-
-    sansa = get_user_model().objects.create(
-        username='sansa.stark',
-        first_name='Sansa',
-        last_name='Stark',
-    )
-
-    arya = get_user_model().objects.create(
-        username='arya.stark',
-        first_name='Arya',
-        last_name='Stark',
-    )
-
-    student_a = get_user_model().objects.create(
-        username='student.a',
-        first_name='Student',
-        last_name='A',
-    )
-    student_a.groups.add(students)
-
-    student_b = get_user_model().objects.create(
-        username='student.b',
-        first_name='Student',
-        last_name='B',
-    )
-    student_b.groups.add(students)
-    UserProgramme.objects.create(programme=programmes[0], user=student_b)
-    UserProgramme.objects.create(programme=programmes[2], user=student_b)
-
-    student_c = get_user_model().objects.create(
-        username='student.c',
-        first_name='Student',
-        last_name='C',
-    )
-    student_c.groups.add(students)
-    UserProgramme.objects.create(programme=programmes[0], user=student_c)
-
-    student_d = get_user_model().objects.create(
-        username='student.d',
-        first_name='Student',
-        last_name='D',
-    )
-    student_d.groups.add(students)
-    UserProgramme.objects.create(programme=programmes[0], user=student_d)
-
-    tutor_a = get_user_model().objects.create(
-        username='tutor.a',
-        first_name='Tutor',
-        last_name='A',
-    )
-    tutor_a.groups.add(tutors)
-
-    tutor_b = get_user_model().objects.create(
-        username='tutor.b',
-        first_name='Tutor',
-        last_name='B',
-    )
-    tutor_b.groups.add(tutors)
-    UserProgramme.objects.create(programme=programmes[1], user=tutor_b)
-    UserProgramme.objects.create(programme=programmes[2], user=tutor_b)
-
-    inactive = get_user_model().objects.create(
-        username='inactive',
-        first_name='In',
-        last_name='Active',
-        is_active=False
-    )
-
-    return [admin, tyrion, sansa, arya, student_a, tutor_a, student_b, tutor_b, student_c, student_d, inactive]
-
-
-@pytest.fixture
-def announcements(users, programmes, scheduled_courses, scheduled_course_groups, tnow):
-    admin = users[0]
-    a1 = Announcement.objects.create(
-        subject='subject 01 (to all)',
-        body='body 1',
-        audience='all',
-        visible_from=tnow - timedelta(seconds=1),
-        visible_to=tnow + timedelta(days=1),
-        user=admin
-    )
-    a2 = Announcement.objects.create(
-        subject='subject 02 (Urgent! - to all)',
-        body='body 2',
-        audience='all',
-        is_urgent=True,
-        visible_from=tnow - timedelta(seconds=3),
-        visible_to=tnow + timedelta(days=1),
-        user=admin
-    )
-    a3 = Announcement.objects.create(
-        subject='subject 03 (to students)',
-        body='body 3',
-        audience='students',
-        visible_from=tnow - timedelta(seconds=2),
-        visible_to=tnow + timedelta(days=1),
-        user=admin
-    )
-    a4 = Announcement.objects.create(
-        subject='subject 04 (to students and tutors)',
-        body='body 4',
-        audience='students_and_tutors',
-        visible_from=tnow - timedelta(seconds=5),
-        visible_to=tnow + timedelta(days=1),
-        user=admin
-    )
-    a5 = Announcement.objects.create(
-        subject='subject 05 (to tutors)',
-        body='body 5',
-        audience='tutors',
-        visible_from=tnow - timedelta(seconds=4),
-        visible_to=tnow + timedelta(days=1),
-        user=admin
-    )
-    a6 = Announcement.objects.create(
-        subject='subject 06 (to students on programme 1)',
-        body='body 6',
-        audience='students',
-        programme=programmes[0],
-        visible_from=tnow - timedelta(seconds=7),
-        visible_to=tnow + timedelta(days=1),
-        user=admin
-    )
-    a7 = Announcement.objects.create(
-        subject='subject 07 (to tutors on programme 2)',
-        body='body 7',
-        audience='tutors',
-        programme=programmes[1],
-        visible_from=tnow - timedelta(seconds=6),
-        visible_to=tnow + timedelta(days=1),
-        user=admin
-    )
-    a8 = Announcement.objects.create(
-        subject='subject 08 (to students and tutors on programme 3)',
-        body='body 8',
-        audience='students_and_tutors',
-        programme=programmes[2],
-        visible_from=tnow - timedelta(seconds=9),
-        visible_to=tnow + timedelta(days=1),
-        user=admin
-    )
-    a9 = Announcement.objects.create(
-        subject='subject 09 (visible from yesterday)',
-        body='body 9',
-        audience='students',
-        visible_from=tnow - timedelta(days=1),
-        visible_to=tnow + timedelta(days=1),
-        user=admin
-    )
-    a10 = Announcement.objects.create(
-        subject='subject 10 (visible from yesterday)',
-        body='body 10',
-        audience='students',
-        visible_from=tnow - timedelta(days=1, seconds=1),
-        visible_to=tnow + timedelta(days=1),
-        user=admin
-    )
-    return [a1, a2, a3, a4, a5, a6, a7, a8, a9, a10]
-
-
-@pytest.fixture
-def user_announcements(users, announcements):
-    tyrion = users[1]
-    sansa = users[2]
-    ua1a = UserAnnouncement.objects.create(
-        announcement=announcements[0],
-        user=tyrion
-    )
-    ua1b = UserAnnouncement.objects.create(
-        announcement=announcements[1],
-        user=tyrion
-    )
-    ua1c = UserAnnouncement.objects.create(
-        announcement=announcements[2],
-        user=tyrion
-    )
-    ua2a = UserAnnouncement.objects.create(
-        announcement=announcements[0],
-        user=sansa
-    )
-    return [ua1a, ua1b, ua1c, ua2a]
-
-
-@pytest.fixture
-def announcements_with_recipients(announcements):
-    def recipient(a):
-        if a.programme is not None:
-            return '\n'.join([_('Programme'), a.programme.display_name])
-        return dict(AUDIENCES).get(a.audience, None)
-
-    return map(lambda a: (a, recipient(a)), announcements)
-
-
 @pytest.mark.django_db
 def test_get_announcement(announcements):
     pk = announcements[3].pk
@@ -923,3 +654,448 @@ def test_get_announcement_recipients_students_and_tutors_on_programme_3(announce
     recipients = get_announcement_recipients(students_and_tutors_p3)
     usernames = sorted(['student.b', 'tutor.b'])
     assert usernames == sorted([r.username for r in recipients])
+
+
+@pytest.mark.django_db
+def test_archive_expired_announcements(announcements, user_announcements, tnow):
+    Announcement.objects.filter(pk__in=[announcements[0].pk, announcements[2].pk]).update(visible_to=tnow - timedelta(days=1))
+
+    archived, archived_user_announcements = archive_expired_announcements(before=tnow, chunk_size=1)
+    assert archived == 2
+    assert archived_user_announcements == 3
+
+    assert not Announcement.objects.filter(pk__in=[announcements[0].pk, announcements[2].pk]).exists()
+    assert sorted(ArchivedAnnouncement.objects.values_list('id', flat=True)) == [announcements[0].pk, announcements[2].pk]
+    assert ArchivedAnnouncement.objects.get(pk=announcements[0].pk).subject == announcements[0].subject
+    assert ArchivedUserAnnouncement.objects.filter(announcement_id=announcements[0].pk).count() == 2
+    assert UserAnnouncement.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_archive_expired_announcements_nothing_expired(announcements, tnow):
+    assert archive_expired_announcements(before=tnow) == (0, 0)
+    assert Announcement.objects.count() == len(announcements)
+
+
+@pytest.mark.django_db
+def test_get_announcements_including_archived(announcements, tnow):
+    Announcement.objects.filter(pk=announcements[5].pk).update(visible_to=tnow - timedelta(days=1))
+    archive_expired_announcements(before=tnow)
+
+    o_announcements, total = get_announcements()
+    assert total == len(announcements) - 1
+
+    o_announcements, total = get_announcements(column='recipient', order='desc', limitnum=3, include_archived=True)
+    assert total == len(announcements)
+    assert [(a.id, a.is_archived) for a in o_announcements] == [
+        (announcements[7].id, False),
+        (announcements[6].id, False),
+        (announcements[5].id, True),
+    ]
+
+
+@pytest.mark.django_db
+def test_delete_announcement(announcements, user_announcements, users):
+    received = []
+
+    def receiver(sender, **kwargs):
+        received.append(kwargs)
+
+    announcement_purged.connect(receiver)
+    try:
+        delete_announcement(announcements[0], users[0], asynchronous=False)
+    finally:
+        announcement_purged.disconnect(receiver)
+
+    assert not Announcement.objects.filter(pk=announcements[0].pk).exists()
+    assert not UserAnnouncement.objects.filter(announcement_id=announcements[0].pk).exists()
+    assert UserAnnouncement.objects.count() == 2
+    assert len(received) == 1
+    assert received[0]['announcement_id'] == announcements[0].pk
+    assert received[0]['user_announcements'] == 2
+
+
+@pytest.mark.django_db
+def test_purge_announcement_in_batches(announcements, user_announcements, users):
+    for user in users[3:]:
+        UserAnnouncement.objects.create(announcement=announcements[0], user=user)
+
+    assert purge_announcement(announcements[0].pk, batch_size=3) == 10
+    assert not UserAnnouncement.objects.filter(announcement_id=announcements[0].pk).exists()
+
+
+@pytest.mark.django_db
+def test_delete_announcement_asynchronously_leaves_a_tombstone(announcements, user_announcements, users, tnow):
+    delete_announcement(announcements[0], users[0], asynchronous=True)
+
+    assert Announcement.objects.get(pk=announcements[0].pk).deleted is not None
+    assert get_announcement(announcements[0].pk) is None
+    assert announcements[0].pk not in [a.id for a in get_visible_announcements_for_user(users[1], tnow)]
+    assert announcements[0].pk not in [a.id for a in get_announcements()[0]]
+
+    assert purge_deleted_announcements() == 1
+    assert not Announcement.objects.filter(pk=announcements[0].pk).exists()
+    assert not UserAnnouncement.objects.filter(announcement_id=announcements[0].pk).exists()
+
+
+@pytest.mark.django_db
+def test_get_announcement_changes_for_user_without_token(users, user_announcements):
+    tyrion = users[1]
+    changes = get_announcement_changes_for_user(tyrion, None, now())
+    assert changes['reset']
+    assert sorted(a['id'] for a in changes['announcements']) == sorted(a.id for a in get_visible_announcements_for_user(tyrion, now()))
+    assert changes['token']
+
+
+@pytest.mark.django_db
+def test_get_announcement_changes_for_user_with_invalid_token(users, user_announcements):
+    assert get_announcement_changes_for_user(users[1], 'tampered', now())['reset']
+
+
+@pytest.mark.django_db
+def test_get_announcement_changes_for_user(users, announcements, user_announcements, tnow):
+    tyrion = users[1]
+    doomed = Announcement.objects.create(subject='doomed', body='body', audience='all', user=users[0])
+    Announcement.objects.update(created=tnow - timedelta(hours=1), modified=tnow - timedelta(hours=1))
+    UserAnnouncement.objects.update(created=tnow - timedelta(hours=1))
+    token = get_announcement_changes_for_user(tyrion, None, tnow + timedelta(seconds=10))['token']
+
+    # nothing changed
+    changes = get_announcement_changes_for_user(tyrion, token, tnow + timedelta(seconds=15))
+    assert not changes['reset']
+    assert changes['announcements'] == changes['removed'] == changes['read'] == []
+
+    # an edit, an expiry, a deletion, a scheduled announcement and read state changes
+    Announcement.objects.filter(pk=announcements[0].pk).update(subject='edited', modified=tnow + timedelta(seconds=20))
+    Announcement.objects.filter(pk=announcements[1].pk).update(visible_to=tnow + timedelta(seconds=20))
+    purge_announcement(doomed.pk)
+    purge_announcement(announcements[3].pk)
+    scheduled = Announcement.objects.create(subject='scheduled', body='body', audience='all',
+                                            visible_from=tnow + timedelta(seconds=25), user=users[0])
+    mark_announcement_unread_for_user(announcements[2].pk, tyrion)
+    mark_announcement_read_for_user(announcements[4].pk, tyrion)
+    AnnouncementTombstone.objects.update(created=tnow + timedelta(seconds=20))
+    UserAnnouncement.objects.filter(announcement=announcements[4]).update(created=tnow + timedelta(seconds=20))
+
+    changes = get_announcement_changes_for_user(tyrion, token, tnow + timedelta(seconds=30))
+    assert not changes['reset']
+    assert [(a['id'], a['subject']) for a in changes['announcements']] == [
+        (scheduled.id, 'scheduled'),
+        (announcements[0].id, 'edited'),
+    ]
+    # announcement 4 was never addressed to tyrion
+    assert changes['removed'] == [announcements[1].id, doomed.id]
+    assert [(r['id'], r['marked_read'] is None) for r in changes['read']] == [
+        (announcements[2].id, True),
+        (announcements[4].id, False),
+    ]
+
+
+@pytest.mark.django_db
+def test_get_announcement_changes_for_user_after_an_audience_change(users, announcements, tnow):
+    tyrion, student = users[1], users[4]
+    Announcement.objects.update(created=tnow - timedelta(hours=1), modified=tnow - timedelta(hours=1))
+    token = get_announcement_changes_for_user(tyrion, None, tnow)['token']
+    student_token = get_announcement_changes_for_user(student, None, tnow)['token']
+
+    announcements[0].audience = 'students'
+    announcements[0].save()
+    AnnouncementTombstone.objects.update(created=tnow + timedelta(seconds=20))
+    Announcement.objects.filter(pk=announcements[0].pk).update(modified=tnow + timedelta(seconds=20))
+
+    assert get_announcement_changes_for_user(tyrion, token, tnow + timedelta(seconds=30))['removed'] == [
+        announcements[0].id
+    ]
+    assert get_announcement_changes_for_user(student, student_token, tnow + timedelta(seconds=30))['removed'] == []
+
+
+@pytest.mark.django_db
+def test_get_announcement_changes_for_user_after_joining_and_leaving_a_group(users, groups, announcements, tnow):
+    tyrion = users[1]
+    Announcement.objects.update(created=tnow - timedelta(hours=1), modified=tnow - timedelta(hours=1))
+    before = {a.id for a in get_visible_announcements_for_user(tyrion, tnow)}
+    token = get_announcement_changes_for_user(tyrion, None, tnow + timedelta(seconds=10))['token']
+
+    tyrion.groups.add(groups[0])
+    caches['default'].clear()
+    changes = get_announcement_changes_for_user(tyrion, token, tnow + timedelta(seconds=30))
+    joined = {a.id for a in get_visible_announcements_for_user(tyrion, tnow)} - before
+    assert joined
+    assert not changes['reset']
+    assert {a['id'] for a in changes['announcements']} == joined
+    assert changes['removed'] == []
+
+    tyrion.groups.remove(groups[0])
+    caches['default'].clear()
+    changes = get_announcement_changes_for_user(tyrion, changes['token'], tnow + timedelta(seconds=40))
+    assert changes['announcements'] == []
+    assert changes['removed'] == sorted(joined)
+
+
+@pytest.mark.django_db
+def test_get_announcement_changes_for_user_with_a_token_without_an_audience(users, tnow):
+    token = signing.dumps(tnow.timestamp(), salt=sync_token_salt)
+    assert get_announcement_changes_for_user(users[1], token, tnow)['reset']
+
+
+@pytest.mark.django_db
+def test_announcement_counters_are_maintained(announcements, users):
+    students = announcements[2]
+    assert students.recipient_count == 4
+    assert Announcement.objects.get(pk=students.pk).recipient_count == 4
+
+    mark_announcement_read_for_user(students.pk, users[4])
+    mark_announcement_read_for_user(students.pk, users[4])
+    mark_announcement_read_for_user(students.pk, users[5])
+    assert Announcement.objects.get(pk=students.pk).read_count == 2
+
+    mark_announcement_unread_for_user(students.pk, users[4])
+    mark_announcement_unread_for_user(students.pk, users[4])
+    assert Announcement.objects.get(pk=students.pk).read_count == 1
+
+    students.audience = 'all'
+    students.save()
+    assert Announcement.objects.get(pk=students.pk).recipient_count == len(users) - 1
+
+
+@pytest.mark.django_db
+def test_reconcile_announcement_counters(announcements, user_announcements):
+    Announcement.objects.filter(pk=announcements[0].pk).update(recipient_count=0)
+
+    assert reconcile_announcement_counters(chunk_size=2) > 0
+    for a in Announcement.objects.all():
+        assert a.read_count == UserAnnouncement.objects.filter(announcement=a).count()
+    assert Announcement.objects.get(pk=announcements[0].pk).recipient_count == announcements[0].recipient_count
+    assert reconcile_announcement_counters() == 0
+
+
+@pytest.mark.django_db
+def test_get_announcement_reach(users, programmes, django_assert_num_queries):
+    assert get_announcement_reach('all') == {
+        'recipients': len(users) - 1,
+        'with_email': 0,
+        'groups': {'students': 4, 'tutors': 2},
+        'programme': None,
+    }
+
+    reach = get_announcement_reach('students_and_tutors', programmes[2].id)
+    assert reach['recipients'] == 2
+    assert reach['groups'] == {'students': 1, 'tutors': 1}
+    assert reach['programme'] == {'id': programmes[2].id, 'display_name': 'Programme 3', 'audience': 6, 'recipients': 2}
+
+    # cached, only the programme is looked up
+    with django_assert_num_queries(1):
+        assert get_announcement_reach('students_and_tutors', programmes[2].id) == reach
+
+    # until memberships change
+    users[6].email = 'student.b@example.com'
+    users[6].save()
+    assert get_announcement_reach('students_and_tutors', programmes[2].id)['with_email'] == 1
+    users[7].groups.clear()
+    assert get_announcement_reach('students_and_tutors', programmes[2].id)['groups'] == {'students': 1, 'tutors': 0}
+
+
+@pytest.mark.django_db
+def test_get_announcement_reach_validates_its_arguments(programmes):
+    with pytest.raises(ValidationError):
+        get_announcement_reach('everyone')
+    with pytest.raises(ValidationError):
+        get_announcement_reach('all', programmes[-1].id + 1)
+    with pytest.raises(ValidationError):
+        get_announcement_reach('all', 'first')
+    assert get_announcement_reach('all', str(programmes[0].id))['programme']['id'] == programmes[0].id
+
+
+@pytest.mark.django_db
+def test_preview_rejects_an_invalid_programme(users, programmes):
+    request = APIRequestFactory().post('/', {'audience': 'all', 'programme': 'first'}, format='json')
+    force_authenticate(request, users[0])
+    assert views_json_api.preview(request).status_code == 400
+
+
+@pytest.mark.django_db(transaction=True)
+def test_get_cached_for_user(users, announcements, tnow, django_assert_num_queries):
+    tyrion = users[1]
+
+    def build():
+        build.calls += 1
+        return [a.id for a in get_visible_announcements_for_user(tyrion, tnow)]
+    build.calls = 0
+
+    visible = get_cached_for_user(tyrion, 'test', tnow, build)
+    with django_assert_num_queries(0):
+        assert get_cached_for_user(tyrion, 'test', tnow, build) == visible
+    assert build.calls == 1
+
+    # read state, memberships and announcements each invalidate it
+    mark_announcement_read_for_user(announcements[0].pk, tyrion)
+    get_cached_for_user(tyrion, 'test', tnow, build)
+    assert build.calls == 2
+    tyrion.groups.add(Group.objects.get(name='students'))
+    assert announcements[2].id not in visible
+    assert announcements[2].id in get_cached_for_user(tyrion, 'test', tnow, build)
+    announcements[2].audience = 'tutors'
+    announcements[2].save()
+    assert announcements[2].id not in get_cached_for_user(tyrion, 'test', tnow, build)
+
+
+@pytest.mark.django_db
+def test_get_cached_for_user_expires_at_the_next_visibility_boundary(settings, users, announcements, tnow):
+    Announcement.objects.create(subject='scheduled', body='body', audience='all', user=users[0],
+                                visible_from=tnow + timedelta(seconds=30), visible_to=tnow + timedelta(days=2))
+    get_cached_for_user(users[1], 'test', tnow, lambda: [])
+    assert 0 < caches['default'].get('announcements.test.%d' % users[1].pk)['fresh_until'] - time() <= 30
+
+    # not served stale past the boundary while another process holds the lock either
+    settings.ANNOUNCEMENTS_CACHE_LOCK_WAIT = 0
+    caches['default'].set('announcements.test.%d.lock' % users[1].pk, 1)
+    assert get_cached_for_user(users[1], 'test', tnow + timedelta(seconds=10), lambda: ['stale']) == []
+    assert get_cached_for_user(users[1], 'test', tnow + timedelta(seconds=31), lambda: ['scheduled']) == ['scheduled']
+
+
+@pytest.mark.django_db
+def test_get_visible_announcements_for_user_is_shared_by_cohort(users, announcements, tnow, django_assert_num_queries):
+    student_c, student_d = users[8], users[9]
+    visible = [a.id for a in get_visible_announcements_for_user(student_c, tnow)]
+
+    # same groups and programmes, only their memberships are looked up
+    with django_assert_num_queries(2):
+        assert [a.id for a in get_visible_announcements_for_user(student_d, tnow)] == visible
+
+    # but not outside the window it was computed for
+    assert get_visible_announcements_for_user(student_d, tnow + timedelta(days=2)) == []
+
+
+@pytest.mark.django_db(transaction=True)
+def test_get_user_context(users, announcements, tnow, django_assert_num_queries):
+    caches['default'].clear()
+    tyrion = users[1]
+    context = get_user_context(tyrion)
+    visible = list(get_visible_announcements_for_user(tyrion, tnow, context=context))
+
+    # loaded once, then shared by the calls made with it
+    with django_assert_num_queries(0):
+        assert get_user_context(tyrion).group_names == context.group_names
+        assert list(get_visible_announcements_for_user(tyrion, tnow, context=context)) == visible
+    with django_assert_num_queries(1):
+        get_announcements_marked_read_for_user(visible, tyrion, with_text=False, context=context)
+    with request_memo():
+        assert get_user_context(tyrion) is get_user_context(tyrion)
+
+    # the cached context goes with a change to the user's groups
+    tyrion.groups.add(Group.objects.get(name='students'))
+    assert 'students' in get_user_context(tyrion).group_names
+
+
+@pytest.mark.django_db
+def test_get_user_context_without_caching(settings, users, django_assert_num_queries):
+    settings.ANNOUNCEMENTS_USER_CONTEXT_TIMEOUT = 0
+    get_user_context(users[1])
+    with django_assert_num_queries(2):
+        get_user_context(users[1])
+
+
+@pytest.mark.django_db
+def test_course_and_group_from_user_context(users):
+    caches['default'].set(course_and_group_memberships_cache_key, {
+        'c1': {'members': ['tyrion.lannister'], 'groups': {'g1': ['tyrion.lannister'], 'g2': []}},
+        'c2': {'members': []},
+    })
+    context = get_user_context(users[1])
+
+    def announcement(course=None, group=None):
+        return SimpleNamespace(
+            scheduled_course=ScheduledCourse(vle_course_id=course) if course else None,
+            group=ScheduledCourseGroup(vle_group_id=group) if group else None
+        )
+
+    assert _course(announcement(), context)
+    assert _course(announcement('c1'), context)
+    assert not _course(announcement('c2'), context)
+    assert _group(announcement('c1', 'g1'), context)
+    assert not _group(announcement('c1', 'g2'), context)
+    caches['default'].delete(course_and_group_memberships_cache_key)
+
+
+@pytest.mark.django_db
+def test_get_announcements_with_id_prefix_query(announcements):
+    prefix = str(announcements[-1].id)[:-1] or str(announcements[-1].id)
+    q_announcements, total = get_announcements(q='AN-%s' % prefix)
+    assert sorted(a.id for a in q_announcements) == sorted(a.id for a in announcements if str(a.id).startswith(prefix))
+    assert get_announcements(q='AN-0')[1] == 0
+    assert get_announcements(q='AN-')[1] == len(announcements)
+
+
+def test_classify_q_token():
+    assert _classify_q_token('') == ('empty', '')
+    assert _classify_q_token('an-12') == ('id', '12')
+    assert _classify_q_token('AN-12x') == ('text', 'AN-12x')
+    assert _classify_q_token('01/02/2020')[0] == 'date'
+    assert _classify_q_token('exam') == ('text', 'exam')
+
+
+@pytest.mark.django_db
+def test_get_announcements_pages_through_cached_search(django_assert_num_queries, announcements, users):
+    _search_cache.clear()
+    first, total = get_announcements(column='visible_from', order='desc', q='subject', limitnum=4)
+    assert total == len(announcements)
+
+    # only the rows on the page are loaded
+    with django_assert_num_queries(1):
+        second, total = get_announcements(column='visible_from', order='desc', q='  Subject ', limitfrom=4, limitnum=4)
+    expected = sorted(announcements, key=lambda a: (a.visible_from, a.id), reverse=True)
+    assert [a.id for a in list(first) + second] == [a.id for a in expected[:8]]
+
+    Announcement.objects.create(subject='subject 11', body='body 11', audience='all', user=users[0])
+    assert get_announcements(column='visible_from', order='desc', q='subject', limitnum=4)[1] == len(announcements) + 1
+
+
+@pytest.mark.django_db
+def test_visible_announcements_load_text_only_for_returned_rows(django_assert_num_queries, users, announcements, tnow):
+    user = max(users, key=lambda u: len(get_visible_announcements_for_user(u, tnow)))
+    visible_announcements = get_visible_announcements_for_user(user, tnow)
+    assert all({'subject', 'body'} <= a.get_deferred_fields() for a in visible_announcements)
+    for announcement in visible_announcements:
+        mark_announcement_read_for_user(announcement.pk, user)
+
+    with django_assert_num_queries(2):
+        user_announcements = list(get_announcements_marked_read_for_user(visible_announcements, user, limit=3))
+    subjects = dict((a.id, a.subject) for a in announcements)
+    assert len(user_announcements) == 3 < len(visible_announcements)
+    assert all(ua['subject'] == subjects[ua['id']] for ua in user_announcements)
+
+
+@pytest.mark.django_db
+def test_visible_announcements_page_matches_the_full_list(users, user_announcements, tnow):
+    for user in users[1:4]:
+        visible_announcements = get_visible_announcements_for_user(user, tnow)
+        expected = list(get_announcements_marked_read_for_user(visible_announcements, user, limit=1))
+        page = get_visible_announcements_page_for_user(user, tnow, limit=1)
+        assert sorted(page['announcements'], key=lambda a: a['id']) == sorted(expected, key=lambda a: a['id'])
+
+
+@pytest.mark.django_db
+def test_visible_announcements_pages_back_through_read_announcements(users, announcements, tnow):
+    user = users[0]
+    for i in range(7):
+        announcement = Announcement.objects.create(
+            subject='old %d' % i,
+            body='body',
+            audience='all',
+            visible_from=tnow - timedelta(days=2, hours=i),
+            visible_to=tnow + timedelta(days=1),
+            user=user
+        )
+        mark_announcement_read_for_user(announcement.pk, user)
+
+    page = get_visible_announcements_page_for_user(user, tnow, limit=3)
+    assert len(page['announcements']) == max(3, len([a for a in page['announcements'] if a['marked_read'] is None]))
+    seen = [a['subject'] for a in page['announcements'] if a['marked_read'] is not None]
+    while page['next']:
+        page = get_visible_announcements_page_for_user(user, tnow, cursor=page['next'], limit=3)
+        assert 0 < len(page['announcements']) <= 3
+        seen.extend(a['subject'] for a in page['announcements'])
+    assert seen == ['old %d' % i for i in range(7)]
+
+    with pytest.raises(ValidationError):
+        get_visible_announcements_page_for_user(user, tnow, cursor='nope')
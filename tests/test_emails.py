@@ -0,0 +1,200 @@
+from datetime import timedelta
+
+from django.core import mail
+from django.utils.timezone import now
+
+import pytest
+
+from smtplib import SMTPException
+
+from mock import MagicMock, patch
+
+from announcements.emails import send_announcement_digests, recipient_name, dispatch_due_announcement_emails
+from announcements.emails import send_outbox_emails, get_email_outbox_progress
+from announcements.models import Announcement, DigestWatermark, ScheduledDispatch, EmailOutbox
+
+
+@pytest.fixture
+def recipients(users):
+    for user in users[1:]:
+        user.email = '%s@example.com' % user.username
+        user.save()
+    return users
+
+
+@pytest.mark.django_db
+def test_recipient_name(users):
+    assert recipient_name(users[1]) == 'Tyrion Lannister'
+    users[1].first_name = users[1].last_name = ''
+    assert recipient_name(users[1]) == 'tyrion.lannister'
+
+
+@pytest.mark.django_db
+def test_send_announcement_digests(recipients, announcements):
+    tyrion = recipients[1]
+    student_b = recipients[6]
+    mail.outbox = []
+
+    # once the fixture announcements are published
+    tsent = now()
+    sent = send_announcement_digests(tsent, chunk_size=3)
+    # the inactive user and the admin without an email get nothing
+    assert sent == len(recipients) - 2
+    assert len(mail.outbox) == sent
+
+    tyrion_mail = next(m for m in mail.outbox if m.to == [tyrion.email])
+    assert tyrion_mail.subject == 'New Announcements from Newcastle University'
+    assert 'Dear Tyrion Lannister' in tyrion_mail.body
+    # urgent announcements are emailed when they are created, not in digests
+    assert 'subject 01 (to all)' in tyrion_mail.body
+    assert 'subject 02' not in tyrion_mail.body
+
+    student_b_mail = next(m for m in mail.outbox if m.to == [student_b.email])
+    assert 'subject 06 (to students on programme 1)' in student_b_mail.body
+    assert 'subject 07' not in student_b_mail.body
+
+    assert DigestWatermark.objects.get(user=tyrion).sent == tsent
+
+
+@pytest.mark.django_db
+def test_send_announcement_digests_is_incremental(recipients, announcements):
+    tsent = now()
+    send_announcement_digests(tsent)
+    mail.outbox = []
+
+    assert send_announcement_digests(tsent + timedelta(minutes=1)) == 0
+
+    Announcement.objects.create(subject='new', body='body', audience='tutors',
+                                visible_from=tsent + timedelta(minutes=1), user=recipients[0])
+    assert send_announcement_digests(tsent + timedelta(minutes=2)) == 2
+    assert sorted(m.to[0] for m in mail.outbox) == ['tutor.a@example.com', 'tutor.b@example.com']
+
+
+@pytest.mark.django_db
+def test_send_announcement_digests_includes_backdated_announcements(recipients, announcements):
+    tsent = now()
+    send_announcement_digests(tsent)
+    mail.outbox = []
+
+    Announcement.objects.create(subject='backdated', body='body', audience='tutors',
+                                visible_from=tsent - timedelta(days=1), user=recipients[0])
+    assert send_announcement_digests(now()) == 2
+    assert all('backdated' in m.body for m in mail.outbox)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_urgent_announcement_visible_now_is_emailed_on_commit(recipients, tnow):
+    mail.outbox = []
+    a = Announcement.objects.create(subject='urgent', body='body', audience='tutors', is_urgent=True, user=recipients[0])
+    assert sorted(m.to[0] for m in mail.outbox) == ['tutor.a@example.com', 'tutor.b@example.com']
+    assert ScheduledDispatch.objects.get(announcement=a).dispatched is not None
+
+    # edits after dispatch are not emailed again
+    a.audience = 'all'
+    a.save()
+    assert len(mail.outbox) == 2
+
+
+@pytest.mark.django_db
+def test_scheduled_urgent_announcement_is_emailed_when_due(recipients, tnow):
+    mail.outbox = []
+    a = Announcement.objects.create(subject='urgent', body='body', audience='tutors', is_urgent=True,
+                                    visible_from=tnow + timedelta(days=2), visible_to=tnow + timedelta(days=3),
+                                    user=recipients[0])
+    assert dispatch_due_announcement_emails(tnow) == 0
+
+    # rescheduled and re-targeted before it is due
+    a.visible_from = tnow + timedelta(days=1)
+    a.audience = 'students'
+    a.save()
+    assert ScheduledDispatch.objects.get(announcement=a).due == a.visible_from
+
+    assert dispatch_due_announcement_emails(tnow + timedelta(days=1)) == 1
+    assert send_outbox_emails() == (4, 0)
+    assert sorted(m.to[0] for m in mail.outbox) == [
+        'student.a@example.com', 'student.b@example.com', 'student.c@example.com', 'student.d@example.com'
+    ]
+    assert dispatch_due_announcement_emails(tnow + timedelta(days=1)) == 0
+
+
+@pytest.mark.django_db
+def test_scheduled_dispatch_stays_due_when_the_outbox_write_fails(recipients, tnow):
+    a = Announcement.objects.create(subject='urgent', body='body', audience='tutors', is_urgent=True,
+                                    visible_from=tnow + timedelta(days=1), user=recipients[0])
+    with patch('announcements.emails.enqueue_announcement_emails', side_effect=RuntimeError):
+        with pytest.raises(RuntimeError):
+            dispatch_due_announcement_emails(tnow + timedelta(days=1))
+    assert ScheduledDispatch.objects.get(announcement=a).dispatched is None
+
+    assert dispatch_due_announcement_emails(tnow + timedelta(days=1)) == 1
+    assert EmailOutbox.objects.filter(announcement=a).count() == 2
+
+
+@pytest.mark.django_db
+def test_scheduled_urgent_announcement_is_cancelled(recipients, tnow):
+    a = Announcement.objects.create(subject='urgent', body='body', audience='tutors', is_urgent=True,
+                                    visible_from=tnow + timedelta(days=1), user=recipients[0])
+    a.is_urgent = False
+    a.save()
+    assert not ScheduledDispatch.objects.filter(announcement=a).exists()
+
+    b = Announcement.objects.create(subject='urgent', body='body', audience='tutors', is_urgent=True,
+                                    visible_from=tnow + timedelta(days=1), user=recipients[0])
+    b.delete()
+    assert not ScheduledDispatch.objects.exists()
+
+
+@pytest.mark.django_db
+def test_outbox_emails_are_retried_with_backoff(settings, recipients, tnow):
+    settings.ANNOUNCEMENTS_OUTBOX_MAX_ATTEMPTS = 2
+    a = Announcement.objects.create(subject='urgent', body='body', audience='tutors', is_urgent=True,
+                                    visible_from=tnow + timedelta(days=1), user=recipients[0])
+    dispatch_due_announcement_emails(tnow + timedelta(days=1))
+    assert get_email_outbox_progress(a.pk) == {'pending': 2, 'sent': 0, 'failed': 0}
+
+    mail.outbox = []
+    with patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=SMTPException('down')):
+        assert send_outbox_emails() == (0, 2)
+    # backing off, nothing is due yet
+    assert send_outbox_emails() == (0, 0)
+
+    EmailOutbox.objects.update(available=tnow)
+    with patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=SMTPException('down')):
+        assert send_outbox_emails() == (0, 2)
+    assert get_email_outbox_progress(a.pk) == {'pending': 0, 'sent': 0, 'failed': 2}
+    assert EmailOutbox.objects.first().error == 'down'
+    assert len(mail.outbox) == 0
+
+
+@pytest.mark.django_db
+def test_outbox_emails_are_sent_once(recipients, tnow):
+    a = Announcement.objects.create(subject='urgent', body='body', audience='tutors', is_urgent=True,
+                                    visible_from=tnow + timedelta(days=1), user=recipients[0])
+    dispatch_due_announcement_emails(tnow + timedelta(days=1))
+    mail.outbox = []
+
+    assert send_outbox_emails(batch_size=1) == (1, 0)
+    assert send_outbox_emails(batch_size=1) == (1, 0)
+    assert send_outbox_emails(batch_size=1) == (0, 0)
+    assert len(mail.outbox) == 2
+    assert get_email_outbox_progress(a.pk) == {'pending': 0, 'sent': 2, 'failed': 0}
+
+
+@pytest.mark.django_db
+def test_outbox_rows_another_worker_leased_first_are_not_sent(recipients, tnow):
+    Announcement.objects.create(subject='urgent', body='body', audience='tutors', is_urgent=True,
+                                visible_from=tnow + timedelta(days=1), user=recipients[0])
+    dispatch_due_announcement_emails(tnow + timedelta(days=1))
+    mail.outbox = []
+    ids = list(EmailOutbox.objects.values_list('id', flat=True))
+
+    # without skip_locked, another worker selects the same rows and leases them before this one does
+    def select_for_update(**kwargs):
+        EmailOutbox.objects.update(available=now() + timedelta(minutes=5))
+        selected = MagicMock()
+        selected.filter.return_value.order_by.return_value.values_list.return_value.__getitem__.return_value = ids
+        return selected
+
+    with patch.object(EmailOutbox.objects, 'select_for_update', side_effect=select_for_update):
+        assert send_outbox_emails() == (0, 0)
+    assert len(mail.outbox) == 0
@@ -0,0 +1,185 @@
+import json
+from datetime import timedelta
+from threading import Timer
+
+from django.utils.timezone import now
+
+import pytest
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from announcements.models import Announcement, AnnouncementTombstone
+from announcements.domain import (get_announcement_events_for_user, mark_announcement_read_for_user,
+                                  mark_announcement_unread_for_user)
+from announcements.pubsub import (MemoryBroker, CacheBroker, get_broker, announcements_channel, user_channel,
+                                  encode_cursor, decode_cursor)
+from announcements.views_json_api import events, stream
+
+
+@pytest.fixture
+def broker(settings):
+    settings.ANNOUNCEMENTS_PUBSUB = {'BACKEND': 'memory'}
+    return get_broker()
+
+
+@pytest.mark.parametrize('broker_class', [MemoryBroker, CacheBroker])
+def test_broker_publish_and_read(broker_class):
+    broker = broker_class()
+    channels = ['a-%s' % broker_class.__name__, 'b-%s' % broker_class.__name__]
+    cursors = broker.cursors(channels)
+
+    broker.publish(channels[0], {'type': 'created', 'announcement_id': 1})
+    broker.publish(channels[1], {'type': 'read', 'announcement_id': 2})
+    events, new_cursors = broker.read(cursors)
+    assert [e[2] for e in events] == [
+        {'type': 'created', 'announcement_id': 1},
+        {'type': 'read', 'announcement_id': 2},
+    ]
+
+    assert broker.read(new_cursors)[0] == []
+
+
+def test_cache_broker_read_stops_at_an_event_not_yet_stored():
+    broker = CacheBroker(gap_timeout=60)
+    cursors = broker.cursors(['gap'])
+    broker.publish('gap', {'type': 'created', 'announcement_id': 1})
+    # a seq taken by a publisher that has not stored its event yet
+    broker.cache.incr(broker._seq_key('gap'))
+    broker.publish('gap', {'type': 'created', 'announcement_id': 3})
+
+    events, new_cursors = broker.read(cursors)
+    assert [e[2]['announcement_id'] for e in events] == [1]
+    assert new_cursors['gap'] == cursors['gap'] + 1
+
+    # and skips it once a later event has been stored for longer than gap_timeout
+    broker.gap_timeout = 0
+    events, new_cursors = broker.read(new_cursors)
+    assert [e[2]['announcement_id'] for e in events] == [3]
+    assert new_cursors['gap'] == cursors['gap'] + 3
+
+
+def test_memory_broker_wait_wakes_on_publish():
+    broker = MemoryBroker()
+    cursors = broker.cursors(['a'])
+    Timer(0.05, broker.publish, args=('a', {'type': 'deleted', 'announcement_id': 1})).start()
+    events, _ = broker.wait(cursors, timeout=5)
+    assert events == [('a', 1, {'type': 'deleted', 'announcement_id': 1})]
+
+
+def test_cursor_encoding():
+    channels = ['a', 'b']
+    assert decode_cursor(encode_cursor({'a': 3, 'b': 4}, channels), channels) == {'a': 3, 'b': 4}
+    assert decode_cursor('nonsense', channels) is None
+    assert decode_cursor(None, channels) is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_signals_publish_events(broker, users, announcements):
+    tyrion = users[1]
+    channels = [announcements_channel, user_channel(tyrion.pk)]
+    cursors = broker.cursors(channels)
+
+    announcements[0].subject = 'updated'
+    announcements[0].save()
+    mark_announcement_read_for_user(announcements[1].pk, tyrion)
+    mark_announcement_unread_for_user(announcements[1].pk, tyrion)
+
+    published, _ = broker.read(cursors)
+    assert sorted(e[2]['type'] for e in published) == ['read', 'unread', 'updated']
+
+
+@pytest.mark.django_db
+def test_get_announcement_events_for_user(users, announcements, tnow):
+    tyrion = users[1]
+    student = users[4]
+    scheduled = Announcement.objects.create(
+        subject='scheduled',
+        body='body',
+        audience='all',
+        visible_from=tnow + timedelta(minutes=1),
+        user=users[0]
+    )
+    published = [
+        (announcements_channel, 1, {'type': 'created', 'announcement_id': announcements[0].pk}),
+        (announcements_channel, 2, {'type': 'updated', 'announcement_id': announcements[2].pk}),
+        (announcements_channel, 3, {'type': 'deleted', 'announcement_id': 999}),
+        (user_channel(tyrion.pk), 1, {'type': 'read', 'announcement_id': announcements[0].pk}),
+    ]
+
+    # announcement 3 is for students only, and nothing is known of 999's audience
+    assert get_announcement_events_for_user(tyrion, published, tnow, tnow) == [
+        {'type': 'visible', 'announcement_id': announcements[0].pk},
+        {'type': 'read', 'announcement_id': announcements[0].pk},
+    ]
+    AnnouncementTombstone.objects.create(announcement_id=999, audience='all')
+    assert {'type': 'removed', 'announcement_id': 999} in get_announcement_events_for_user(tyrion, published, tnow, tnow)
+    assert {'type': 'updated', 'announcement_id': announcements[2].pk} in \
+        get_announcement_events_for_user(student, published, tnow, tnow)
+
+    # the scheduled announcement becomes visible once its visible_from has passed
+    assert get_announcement_events_for_user(tyrion, [], tnow, tnow + timedelta(minutes=2)) == [
+        {'type': 'visible', 'announcement_id': scheduled.pk},
+    ]
+
+
+@pytest.mark.django_db
+def test_events_long_poll(broker, settings, users, announcements):
+    settings.ANNOUNCEMENTS_LONG_POLL_TIMEOUT = 0
+    tyrion = users[1]
+    factory = APIRequestFactory()
+
+    def get(cursor=None):
+        request = factory.get('/events/', {'cursor': cursor} if cursor else {})
+        force_authenticate(request, user=tyrion)
+        return events(request).data
+
+    first = get()
+    assert first['events'] == []
+
+    broker.publish(user_channel(tyrion.pk), {'type': 'read', 'announcement_id': announcements[0].pk})
+    second = get(first['cursor'])
+    assert second['events'] == [{'type': 'read', 'announcement_id': announcements[0].pk}]
+    assert get(second['cursor'])['events'] == []
+
+
+@pytest.mark.django_db
+def test_stream(broker, settings, users, announcements):
+    settings.ANNOUNCEMENTS_STREAM_HEARTBEAT = 0
+    settings.ANNOUNCEMENTS_STREAM_TIMEOUT = 0.01
+    tyrion = users[1]
+    broker.publish(user_channel(tyrion.pk), {'type': 'read', 'announcement_id': announcements[0].pk})
+
+    request = APIRequestFactory().get('/stream/', HTTP_LAST_EVENT_ID='0.0-%d' % now().timestamp())
+    force_authenticate(request, user=tyrion)
+    response = stream(request)
+    assert response['Content-Type'] == 'text/event-stream'
+
+    body = b''.join(response.streaming_content).decode()
+    assert body.startswith('retry: 0\n\n')
+    assert 'event: read\ndata: {"type": "read", "announcement_id": %d}' % announcements[0].pk in body
+
+
+@pytest.mark.django_db
+def test_stream_errors_are_rendered_as_json(broker):
+    response = stream(APIRequestFactory().get('/stream/', HTTP_ACCEPT='text/event-stream'))
+    response.render()
+    assert response.status_code in (401, 403)
+    assert response['Content-Type'] == 'application/json'
+    assert 'detail' in json.loads(response.content)
+
+
+@pytest.mark.django_db
+def test_stream_connections_are_capped(broker, settings, users):
+    settings.ANNOUNCEMENTS_STREAM_MAX_CONNECTIONS = 1
+
+    def open_stream():
+        request = APIRequestFactory().get('/stream/')
+        force_authenticate(request, user=users[1])
+        return stream(request)
+
+    first = open_stream()
+    assert first.status_code == 200
+    assert open_stream().status_code == 503
+    first.close()
+    second = open_stream()
+    assert second.status_code == 200
+    second.close()
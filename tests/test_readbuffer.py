@@ -0,0 +1,82 @@
+from django.core.cache import caches
+
+import pytest
+
+from announcements.domain import (mark_announcement_read_for_user, mark_announcement_unread_for_user,
+                                  get_announcements_marked_read_for_user, get_visible_announcements_for_user,
+                                  flush_read_buffer, get_cached_for_user)
+from announcements.models import Announcement, AnnouncementTombstone, UserAnnouncement
+from announcements.readbuffer import CacheReadBuffer, get_read_buffer
+
+
+@pytest.fixture(params=['memory', 'cache'])
+def read_buffer(request, settings):
+    caches['default'].clear()
+    settings.ANNOUNCEMENTS_READ_BUFFER = {'BACKEND': request.param, 'FLUSH_SIZE': 100, 'FLUSH_INTERVAL': 3600}
+    return get_read_buffer()
+
+
+def marked_read(user, tnow):
+    visible = get_visible_announcements_for_user(user, tnow)
+    return {a['id']: a['marked_read'] is not None for a in get_announcements_marked_read_for_user(visible, user)}
+
+
+@pytest.mark.django_db
+def test_buffered_read_state_is_seen_before_it_is_flushed(read_buffer, users, user_announcements, announcements, tnow):
+    tyrion = users[1]
+    mark_announcement_unread_for_user(announcements[0].pk, tyrion)
+    assert mark_announcement_read_for_user(announcements[2].pk, tyrion)['id'] == announcements[2].pk
+    mark_announcement_read_for_user(announcements[3].pk, tyrion)
+
+    assert not UserAnnouncement.objects.filter(user=tyrion, announcement=announcements[3]).exists()
+    assert marked_read(tyrion, tnow) == {announcements[0].pk: False, announcements[1].pk: True}
+
+    flush_read_buffer()
+    assert sorted(UserAnnouncement.objects.filter(user=tyrion).values_list('announcement_id', flat=True)) == [
+        announcements[1].pk, announcements[2].pk, announcements[3].pk
+    ]
+    assert AnnouncementTombstone.objects.filter(user=tyrion, announcement_id=announcements[0].pk).exists()
+    assert Announcement.objects.get(pk=announcements[0].pk).read_count == 1
+    assert Announcement.objects.get(pk=announcements[3].pk).read_count == 1
+    assert read_buffer.pending_for_user(tyrion.pk) == {}
+    assert marked_read(tyrion, tnow) == {announcements[0].pk: False, announcements[1].pk: True}
+
+
+@pytest.mark.django_db
+def test_read_buffer_flushes_at_its_size_threshold(settings, read_buffer, users, announcements):
+    read_buffer.flush_size = 3
+    for user in users[1:3]:
+        mark_announcement_read_for_user(announcements[0].pk, user)
+    assert UserAnnouncement.objects.count() == 0
+
+    mark_announcement_read_for_user(announcements[1].pk, users[1])
+    assert UserAnnouncement.objects.count() == 3
+
+
+def test_cache_read_buffer_skips_a_lost_entry_after_the_gap_timeout():
+    caches['default'].clear()
+    read_buffer = CacheReadBuffer(gap_timeout=60)
+    read_buffer.add(1, 10, 'read')
+    # a seq taken by a process that died before storing its entry
+    read_buffer.cache.incr(read_buffer._key(1))
+    read_buffer.add(1, 12, 'read')
+
+    applied = []
+    read_buffer.flush(applied.extend)
+    assert applied == [(1, 10, 'read')]
+
+    read_buffer.gap_timeout = 0
+    applied = []
+    read_buffer.flush(applied.extend)
+    assert applied == [(1, 12, 'read')]
+    assert read_buffer.pending_for_user(1) == {}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_flushing_the_read_buffer_invalidates_the_users_cached_lists(read_buffer, users, announcements, tnow):
+    # a list cached by another worker while the read is buffered is not served once it is flushed
+    tyrion = users[1]
+    mark_announcement_read_for_user(announcements[0].pk, tyrion)
+    assert get_cached_for_user(tyrion, 'test', tnow, lambda: 'buffered') == 'buffered'
+    flush_read_buffer()
+    assert get_cached_for_user(tyrion, 'test', tnow, lambda: 'flushed') == 'flushed'
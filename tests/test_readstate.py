@@ -0,0 +1,169 @@
+from datetime import timedelta
+
+from django.core.cache import caches
+from django.core.management import call_command
+
+import pytest
+
+from announcements.domain import (mark_announcement_read_for_user, mark_announcement_unread_for_user,
+                                  get_announcements_marked_read_for_user, get_visible_announcements_for_user,
+                                  get_visible_announcements_page_for_user)
+from announcements.models import Announcement, AnnouncementTombstone, ReadStateException, ReadWatermark, UserAnnouncement
+
+
+@pytest.fixture
+def watermarks(settings):
+    caches['default'].clear()
+    settings.ANNOUNCEMENTS_READ_STATE = 'watermark'
+
+
+def marked_read(user, tnow):
+    visible = get_visible_announcements_for_user(user, tnow)
+    return {a['id']: a['marked_read'] is not None for a in get_announcements_marked_read_for_user(visible, user, 100)}
+
+
+@pytest.mark.django_db
+def test_watermarks_keep_the_read_state_of_read_receipts(settings, users, user_announcements, tnow):
+    expected = {user.pk: marked_read(user, tnow) for user in users[1:4]}
+
+    settings.ANNOUNCEMENTS_READ_STATE = 'watermark'
+    caches['default'].clear()
+    assert {user.pk: marked_read(user, tnow) for user in users[1:4]} == expected
+    assert ReadWatermark.objects.filter(user__in=users[1:4]).count() == 3
+
+
+@pytest.mark.django_db
+def test_watermark_advances_as_the_oldest_unread_announcement_is_read(watermarks, users, announcements, tnow):
+    tyrion = users[1]
+    visible = get_visible_announcements_for_user(tyrion, tnow)
+    for announcement in sorted(visible, key=lambda a: a.published):
+        mark_announcement_read_for_user(announcement.pk, tyrion)
+
+    assert not ReadStateException.objects.filter(user=tyrion).exists()
+    assert ReadWatermark.objects.get(user=tyrion).read_until == max(a.published for a in visible)
+    assert set(marked_read(tyrion, tnow).values()) == {True}
+    assert Announcement.objects.get(pk=announcements[0].pk).read_count == 1
+    assert not UserAnnouncement.objects.exists()
+
+
+@pytest.mark.django_db
+def test_watermark_mark_unread_below_and_above_the_watermark(watermarks, users, announcements, tnow):
+    tyrion = users[1]
+    visible = sorted(get_visible_announcements_for_user(tyrion, tnow), key=lambda a: a.published)
+    oldest, newest = visible[0], visible[-1]
+    mark_announcement_read_for_user(newest.pk, tyrion)
+    assert ReadStateException.objects.get(user=tyrion, announcement=newest).is_read
+    mark_announcement_unread_for_user(newest.pk, tyrion)
+    mark_announcement_unread_for_user(newest.pk, tyrion)
+    assert not ReadStateException.objects.filter(user=tyrion).exists()
+
+    mark_announcement_read_for_user(oldest.pk, tyrion)
+    assert ReadWatermark.objects.get(user=tyrion).read_until == oldest.published
+    mark_announcement_unread_for_user(oldest.pk, tyrion)
+    assert not ReadStateException.objects.get(user=tyrion, announcement=oldest).is_read
+    assert set(marked_read(tyrion, tnow).values()) == {False}
+    assert AnnouncementTombstone.objects.filter(user=tyrion).count() == 2
+    assert Announcement.objects.get(pk=newest.pk).read_count == 0
+
+    mark_announcement_read_for_user(oldest.pk, tyrion)
+    assert marked_read(tyrion, tnow)[oldest.pk]
+    assert not ReadStateException.objects.filter(user=tyrion, announcement=oldest).exists()
+
+
+@pytest.mark.django_db
+def test_backdated_announcement_is_unread_below_the_watermark(watermarks, users, announcements, tnow):
+    tyrion = users[1]
+    for announcement in get_visible_announcements_for_user(tyrion, tnow):
+        mark_announcement_read_for_user(announcement.pk, tyrion)
+    read_until = ReadWatermark.objects.get(user=tyrion).read_until
+
+    backdated = Announcement.objects.create(
+        subject='backdated', body='backdated', audience='all', visible_from=tnow - timedelta(days=2), user=users[0]
+    )
+    caches['default'].clear()
+    assert backdated.published > read_until
+    assert not marked_read(tyrion, tnow)[backdated.pk]
+
+    mark_announcement_read_for_user(backdated.pk, tyrion)
+    assert set(marked_read(tyrion, tnow).values()) == {True}
+    assert ReadWatermark.objects.get(user=tyrion).read_until == backdated.published
+
+
+@pytest.mark.django_db
+def test_announcement_moved_into_the_past_is_published_when_moved(users, announcements, tnow):
+    scheduled = Announcement.objects.create(
+        subject='scheduled', body='scheduled', audience='all', visible_from=tnow + timedelta(days=1), user=users[0]
+    )
+    assert scheduled.published == scheduled.visible_from
+
+    scheduled.visible_from = tnow - timedelta(days=1)
+    scheduled.save()
+    assert Announcement.objects.get(pk=scheduled.pk).published > tnow
+
+    published = scheduled.published
+    scheduled.visible_from = tnow - timedelta(days=2)
+    scheduled.save()
+    assert Announcement.objects.get(pk=scheduled.pk).published == published
+
+
+@pytest.mark.django_db
+def test_watermark_keeps_announcements_unread_that_a_group_change_makes_visible(watermarks, users, groups,
+                                                                                 announcements, tnow):
+    tyrion = users[1]
+    before = get_visible_announcements_for_user(tyrion, tnow)
+    for announcement in before:
+        mark_announcement_read_for_user(announcement.pk, tyrion)
+
+    tyrion.groups.add(*groups)
+    caches['default'].clear()
+    after = marked_read(tyrion, tnow)
+    newly_visible = set(after) - {a.pk for a in before}
+    assert newly_visible
+    assert after == {pk: pk not in newly_visible for pk in after}
+    assert ReadWatermark.objects.get(user=tyrion).audience == 'students,tutors|'
+
+    # rebased once, then read as usual
+    for pk in newly_visible:
+        mark_announcement_read_for_user(pk, tyrion)
+    assert set(marked_read(tyrion, tnow).values()) == {True}
+
+
+@pytest.mark.django_db
+def test_readdressed_announcement_is_unread_in_both_modes(settings, users, announcements, tnow):
+    rows_student, watermark_student = users[8], users[9]
+    tutors_only = announcements[4]
+    caches['default'].clear()
+    for announcement in get_visible_announcements_for_user(rows_student, tnow):
+        mark_announcement_read_for_user(announcement.pk, rows_student)
+    settings.ANNOUNCEMENTS_READ_STATE = 'watermark'
+    for announcement in get_visible_announcements_for_user(watermark_student, tnow):
+        mark_announcement_read_for_user(announcement.pk, watermark_student)
+    assert ReadWatermark.objects.get(user=watermark_student).read_until > tutors_only.published
+
+    tutors_only.audience = 'all'
+    tutors_only.save()
+    caches['default'].clear()
+    in_watermarks = marked_read(watermark_student, tnow)
+    settings.ANNOUNCEMENTS_READ_STATE = 'rows'
+    in_rows = marked_read(rows_student, tnow)
+    assert in_watermarks[tutors_only.pk] is in_rows[tutors_only.pk] is False
+    assert in_watermarks == in_rows
+
+
+@pytest.mark.django_db
+def test_migrate_read_state_command(settings, users, user_announcements, tnow):
+    expected = marked_read(users[1], tnow)
+    call_command('migrate_read_state', '--delete-rows', '--chunk-size', '2')
+
+    assert ReadWatermark.objects.count() == len(users)
+    assert not UserAnnouncement.objects.exists()
+    settings.ANNOUNCEMENTS_READ_STATE = 'watermark'
+    caches['default'].clear()
+    assert marked_read(users[1], tnow) == expected
+
+
+@pytest.mark.django_db
+def test_visible_page_reads_watermarks(watermarks, users, user_announcements, tnow):
+    for user in users[1:4]:
+        page = get_visible_announcements_page_for_user(user, tnow, limit=100)
+        assert {a['id']: a['marked_read'] is not None for a in page['announcements']} == marked_read(user, tnow)
@@ -0,0 +1,81 @@
+from django.conf import settings as django_settings
+from django.core.cache import caches
+from django.contrib.auth import get_user_model
+
+import pytest
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from announcements import views_json_api
+from announcements.models import Announcement, ReadWatermark
+from announcements.routers import ReplicaRouter, reads_from_replica, reads_from_primary
+from programmes.models import Programme
+
+
+@pytest.fixture
+def replica(settings):
+    caches['default'].clear()
+    settings.ANNOUNCEMENTS_REPLICA_DATABASE = 'replica'
+    return ReplicaRouter()
+
+
+@pytest.mark.django_db
+def test_reads_go_to_the_replica_until_the_user_writes(replica, users, announcements):
+    tyrion = users[1]
+    assert replica.db_for_read(Announcement) is None
+    with reads_from_replica(tyrion):
+        assert replica.db_for_read(Announcement) == 'replica'
+        assert replica.db_for_read(Programme) == 'replica'
+        assert replica.db_for_read(get_user_model()) is None
+        assert replica.db_for_write(Announcement) is None
+        with reads_from_primary():
+            assert replica.db_for_read(Announcement) is None
+
+    request = APIRequestFactory().post('/')
+    force_authenticate(request, tyrion)
+    assert views_json_api.mark_read(request, announcements[0].pk).status_code == 201
+    with reads_from_replica(tyrion):
+        assert replica.db_for_read(Announcement) is None
+    with reads_from_replica(users[2]):
+        assert replica.db_for_read(Announcement) == 'replica'
+
+
+@pytest.mark.skipif('replica' not in django_settings.DATABASES, reason='needs a second database aliased replica')
+@pytest.mark.django_db(databases=['default', 'replica'])
+def test_read_views_use_the_replica(replica, settings, users, announcements):
+    settings.DATABASE_ROUTERS = ['announcements.routers.ReplicaRouter']
+    tyrion = users[1]
+
+    def get():
+        request = APIRequestFactory().get('/')
+        force_authenticate(request, tyrion)
+        return views_json_api.get(request, announcements[0].pk).status_code
+
+    # the replica has none of the announcements written to the primary
+    assert get() == 404
+    request = APIRequestFactory().post('/')
+    force_authenticate(request, tyrion)
+    views_json_api.mark_read(request, announcements[0].pk)
+    assert get() == 200
+
+
+@pytest.mark.skipif('replica' not in django_settings.DATABASES, reason='needs a second database aliased replica')
+@pytest.mark.django_db(databases=['default', 'replica'])
+def test_watermarks_written_on_a_replica_read_are_read_back_from_the_primary(replica, settings, users, groups,
+                                                                             announcements):
+    settings.DATABASE_ROUTERS = ['announcements.routers.ReplicaRouter']
+    settings.ANNOUNCEMENTS_READ_STATE = 'watermark'
+    tyrion = users[1]
+
+    def count_unread():
+        caches['default'].clear()
+        request = APIRequestFactory().get('/')
+        force_authenticate(request, tyrion)
+        return views_json_api.count_unread(request).status_code
+
+    # migrated on first use, and rebased after a group change, while the replica has no watermark at all
+    assert count_unread() == 200
+    assert ReadWatermark.objects.using('default').filter(user=tyrion).exists()
+    assert not ReadWatermark.objects.using('replica').exists()
+    tyrion.groups.add(*groups)
+    assert count_unread() == 200
+    assert ReadWatermark.objects.using('default').get(user=tyrion).audience == 'students,tutors|'
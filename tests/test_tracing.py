@@ -0,0 +1,124 @@
+import json
+
+from django.core import mail
+from django.utils.timezone import now
+
+import pytest
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from announcements.models import Announcement
+from announcements.domain import (get_announcement, get_announcements, get_visible_announcements_for_user,
+                                  delete_announcement)
+from announcements.serializers import AnnouncementSerializer
+from announcements.views_json_api import visible
+from announcements.tracing import span, traced, get_exporter, current_span, null_span
+
+
+@pytest.fixture
+def collector(settings):
+    settings.ANNOUNCEMENTS_TRACING = {'EXPORTER': 'memory'}
+    return get_exporter()
+
+
+def test_span_is_a_no_op_when_tracing_is_disabled(settings):
+    settings.ANNOUNCEMENTS_TRACING = None
+    with span('test') as s:
+        assert s is null_span
+    assert get_exporter() is None
+
+
+def test_nested_spans_share_trace_and_parent(collector):
+    with span('outer', user_id=1):
+        with span('inner') as inner:
+            inner.set(rows=3)
+            assert current_span() is inner
+
+    inner, outer = collector.spans
+    assert outer['name'] == 'outer'
+    assert outer['parent_id'] is None
+    assert outer['attributes'] == {'user_id': 1}
+    assert inner['trace_id'] == outer['trace_id']
+    assert inner['parent_id'] == outer['span_id']
+    assert inner['attributes'] == {'rows': 3}
+    assert inner['duration'] >= 0
+
+
+def test_span_records_error(collector):
+    with pytest.raises(ValueError):
+        with span('failing'):
+            raise ValueError('boom')
+    assert collector.spans[0]['error'] == "ValueError('boom')"
+
+
+def test_json_lines_exporter(settings, tmp_path):
+    path = tmp_path / 'trace.jsonl'
+    settings.ANNOUNCEMENTS_TRACING = {'EXPORTER': 'jsonl', 'PATH': str(path)}
+    with span('one', announcement_id=5):
+        pass
+    with span('two'):
+        pass
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [line['name'] for line in lines] == ['one', 'two']
+    assert lines[0]['attributes'] == {'announcement_id': 5}
+
+
+@pytest.mark.django_db
+def test_domain_functions_are_traced(collector, announcements, users):
+    get_announcement(announcements[0].pk)
+    get_announcements()
+    list(get_visible_announcements_for_user(users[1], now()))
+
+    spans = {s['name']: s for s in collector.spans}
+    assert spans['domain.get_announcement']['attributes'] == {'announcement_id': announcements[0].pk}
+    assert spans['domain.get_announcements']['attributes']['rows'] == len(announcements)
+    assert spans['domain.get_visible_announcements_for_user']['attributes']['user_id'] == users[1].pk
+
+
+def test_traced_attributes_are_passed_the_arguments_they_name(collector):
+    @traced(attributes=lambda b, c: {'b': b, 'c': c})
+    def f(a, b, c=3, d=4, **kwargs):
+        return a
+
+    assert f(1, 2, d=5, e=6) == 1
+    assert collector.spans[-1]['attributes'] == {'b': 2, 'c': 3}
+
+
+@pytest.mark.django_db
+def test_delete_announcement_is_traced(collector, announcements, users):
+    delete_announcement(announcements[0], users[0], asynchronous=False)
+    assert collector.spans[-1]['attributes'] == {'announcement_id': announcements[0].pk, 'user_id': users[0].pk}
+
+
+@pytest.mark.django_db
+def test_visible_view_is_traced(collector, users, announcements):
+    request = APIRequestFactory().get('/visible/')
+    force_authenticate(request, users[1])
+    assert visible(request).status_code == 200
+
+    spans = {s['name']: s for s in collector.spans}
+    assert spans['domain.get_cached_for_user']['attributes']['cache_name'] == 'visible'
+    assert spans['views_json_api.visible']['attributes']['user_id'] == users[1].pk
+
+
+@pytest.mark.django_db
+def test_serializer_data_is_traced(collector, announcements):
+    AnnouncementSerializer(announcements, many=True).data
+    assert collector.spans[-1]['name'] == 'serializers.AnnouncementSerializer.data'
+    assert collector.spans[-1]['attributes']['rows'] == len(announcements)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_urgent_announcement_emails_are_traced(collector, users):
+    users[4].email = 'student.a@example.com'
+    users[4].save()
+    a = Announcement.objects.create(subject='urgent', body='body', audience='students', is_urgent=True, user=users[0])
+
+    spans = {s['name']: s for s in collector.spans}
+    enqueue = spans['emails.enqueue_announcement_emails']
+    assert enqueue['attributes'] == {'announcement_id': a.pk, 'rows': 1}
+    assert enqueue['parent_id'] == spans['emails.dispatch_due_announcement_emails']['span_id']
+    send = next(s for s in collector.spans if s['name'] == 'emails.send_outbox_emails')
+    assert send['attributes'] == {'batch_size': 100, 'rows': 1, 'failed': 0}
+    assert spans['emails.send_mail_batch']['parent_id'] == send['span_id']
+    assert spans['emails.send_mail_batch']['attributes'] == {'rows': 1, 'failed': 0}
+    assert len(mail.outbox) == 1
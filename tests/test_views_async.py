@@ -0,0 +1,71 @@
+import asyncio
+import json
+from importlib import reload
+
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+
+import django
+import pytest
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from announcements import caching, urls_json_api, views_async, views_json_api
+from announcements.models import Announcement, UserAnnouncement
+
+
+def request_as(user, method='get'):
+    request = getattr(APIRequestFactory(), method)('/')
+    if user is not None:
+        force_authenticate(request, user)
+    return request
+
+
+@pytest.mark.parametrize('name', ['visible', 'count_unread'])
+@pytest.mark.django_db(transaction=True)
+def test_async_views_match_sync_views(name, users, user_announcements):
+    for user in users[1:4]:
+        expected = getattr(views_json_api, name)(request_as(user)).render()
+        response = asyncio.run(getattr(views_async, name)(request_as(user)))
+        assert response.status_code == expected.status_code
+        assert json.loads(response.content) == json.loads(expected.content)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_mark_read_and_unread(users, announcements):
+    tyrion = users[1]
+    response = asyncio.run(views_async.mark_read(request_as(tyrion, 'post'), str(announcements[0].pk)))
+    assert response.status_code == 201
+    assert json.loads(response.content)['id'] == announcements[0].pk
+    assert UserAnnouncement.objects.filter(user=tyrion, announcement=announcements[0]).exists()
+    assert Announcement.objects.get(pk=announcements[0].pk).read_count == 1
+
+    response = asyncio.run(views_async.mark_unread(request_as(tyrion, 'delete'), str(announcements[0].pk)))
+    assert response.status_code == 204
+    assert not UserAnnouncement.objects.filter(user=tyrion).exists()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_views_check_method_and_authentication(settings, users):
+    settings.REST_FRAMEWORK = {'DEFAULT_PERMISSION_CLASSES': ['rest_framework.permissions.IsAuthenticated']}
+    assert asyncio.run(views_async.visible(request_as(users[1], 'post'))).status_code == 405
+    assert asyncio.run(views_async.visible(request_as(None))).status_code in (401, 403)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_visible_shares_the_visible_cache(users, user_announcements):
+    caches['default'].clear()
+    caching.stats.clear()
+    views_json_api.visible(request_as(users[1])).render()
+    asyncio.run(views_async.visible(request_as(users[1])))
+    assert caching.stats['visible', 'hits'] == 1
+
+
+@pytest.mark.skipif(django.VERSION >= (3, 1), reason='async views are served from Django 3.1')
+def test_async_views_need_django_3_1(settings):
+    settings.ANNOUNCEMENTS_ASYNC_VIEWS = True
+    try:
+        with pytest.raises(ImproperlyConfigured):
+            reload(urls_json_api)
+    finally:
+        settings.ANNOUNCEMENTS_ASYNC_VIEWS = False
+        reload(urls_json_api)
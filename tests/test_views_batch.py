@@ -0,0 +1,64 @@
+import json
+
+from django.core.cache import caches
+
+import pytest
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from announcements import views_json_api
+from announcements.models import UserAnnouncement
+
+
+def request_as(user, method='get', data=None):
+    request = getattr(APIRequestFactory(), method)('/announcements/api/batch/', data, format='json')
+    force_authenticate(request, user)
+    return request
+
+
+def batch(user, *specs):
+    response = views_json_api.batch(request_as(user, 'post', {'requests': list(specs)})).render()
+    assert response.status_code == 200
+    return json.loads(response.content)['responses']
+
+
+def direct(name, user, *args):
+    return json.loads(getattr(views_json_api, name)(request_as(user), *args).render().content)
+
+
+@pytest.mark.django_db
+def test_batch_runs_each_request_as_the_user(settings, users, user_announcements, announcements):
+    settings.ANNOUNCEMENTS_BATCH_CONCURRENT = False
+    tyrion = users[1]
+    count_unread = direct('count_unread', tyrion)
+    responses = batch(
+        tyrion,
+        {'path': 'visible/'},
+        {'path': 'count/unread/'},
+        {'method': 'POST', 'path': 'mark/read/%d' % announcements[3].pk},
+        {'path': '%d' % announcements[0].pk},
+        {'path': 'nowhere/'},
+        {'path': 'stream/'},
+    )
+    assert [r['status'] for r in responses] == [200, 200, 201, 200, 404, 404]
+    assert UserAnnouncement.objects.filter(user=tyrion, announcement=announcements[3]).exists()
+    assert responses[3]['body']['id'] == announcements[0].pk
+    assert responses[1]['body'] == count_unread
+
+
+@pytest.mark.django_db(transaction=True)
+def test_batch_runs_reads_concurrently(users, user_announcements):
+    # cohort lists left by other tests would be served stale while one thread refreshes them
+    caches['default'].clear()
+    for user in users[1:4]:
+        responses = batch(user, {'path': 'visible/'}, {'path': 'count/unread/'}, {'path': 'visible/?page_size=2'})
+        assert [r['status'] for r in responses] == [200, 200, 200]
+        assert responses[0]['body'] == direct('visible', user)
+        assert responses[1]['body'] == direct('count_unread', user)
+        assert len(responses[2]['body']['announcements']) >= min(2, len(responses[0]['body']))
+
+
+@pytest.mark.django_db
+def test_batch_rejects_bad_requests(settings, users):
+    settings.ANNOUNCEMENTS_BATCH_MAX_REQUESTS = 2
+    assert views_json_api.batch(request_as(users[1], 'post', {'requests': 'visible/'})).status_code == 400
+    assert views_json_api.batch(request_as(users[1], 'post', {'requests': [{}] * 3})).status_code == 400
@@ -0,0 +1,35 @@
+from mock import patch
+
+import pytest
+
+from announcements.domain import get_visible_announcements_for_user
+from announcements import visibility
+from announcements.visibility import get_visible_announcement_ids_for_users
+
+
+def expected(users, current_datetime, urgent_only=False):
+    result = {}
+    for user in users:
+        ids = [a.id for a in get_visible_announcements_for_user(user, current_datetime, urgent_only)]
+        if ids:
+            result[user.id] = ids
+    return result
+
+
+@pytest.mark.parametrize('numpy', [True, False])
+@pytest.mark.django_db
+def test_get_visible_announcement_ids_for_users(numpy, users, announcements, tnow):
+    with patch.object(visibility, 'np', visibility.np if numpy else None):
+        assert dict(get_visible_announcement_ids_for_users([u.id for u in users], tnow)) == expected(users, tnow)
+        assert dict(get_visible_announcement_ids_for_users(None, tnow, urgent_only=True)) == expected(users, tnow, True)
+
+
+@pytest.mark.django_db
+def test_get_visible_announcement_ids_for_users_in_chunks(users, announcements, tnow):
+    with patch.object(visibility, 'user_chunk_size', 2):
+        assert dict(get_visible_announcement_ids_for_users(None, tnow)) == expected(users, tnow)
+
+
+@pytest.mark.django_db
+def test_get_visible_announcement_ids_for_users_without_announcements(users):
+    assert get_visible_announcement_ids_for_users(None, users[0].date_joined.replace(year=2000)) == {}
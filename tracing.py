@@ -0,0 +1,220 @@
+import inspect
+import json
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter, time
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.utils.module_loading import import_string
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+
+_local = threading.local()
+
+_exporter = None
+
+
+class Span:
+
+    def __init__(self, name, trace_id, parent_id, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = dict(attributes)
+        self.start = time()
+        self.duration = None
+        self.error = None
+        self._otel_span = None
+        self._started = perf_counter()
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+        if self._otel_span is not None:
+            for k, v in attributes.items():
+                if v is not None:
+                    self._otel_span.set_attribute(k, v)
+
+    def finish(self):
+        self.duration = perf_counter() - self._started
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start': self.start,
+            'duration': self.duration,
+            'error': self.error,
+            'attributes': self.attributes,
+        }
+
+
+class NullSpan:
+
+    def set(self, **attributes):
+        pass
+
+
+null_span = NullSpan()
+
+
+class InMemoryCollector:
+
+    def __init__(self, **options):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        with self._lock:
+            self.spans.append(span.to_dict())
+
+    def clear(self):
+        with self._lock:
+            self.spans = []
+
+
+class JsonLinesExporter:
+
+    def __init__(self, path='announcements-trace.jsonl', **options):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self._lock, open(self.path, 'a') as f:
+            f.write(line + '\n')
+
+
+class OpenTelemetryExporter:
+
+    # spans are bridged live in span(), so there is nothing left to export
+    def __init__(self, **options):
+        if otel_trace is None:
+            raise ImportError('opentelemetry is not installed')
+        self.tracer = otel_trace.get_tracer('announcements')
+
+    def export(self, span):
+        pass
+
+
+EXPORTERS = {
+    'memory': InMemoryCollector,
+    'jsonl': JsonLinesExporter,
+    'opentelemetry': OpenTelemetryExporter,
+}
+
+
+def get_exporter():
+    # ANNOUNCEMENTS_TRACING = {'EXPORTER': 'memory' | 'jsonl' | 'opentelemetry' | dotted path, ...options}
+    global _exporter
+    if _exporter is None:
+        config = dict(getattr(settings, 'ANNOUNCEMENTS_TRACING', None) or {})
+        name = config.pop('EXPORTER', None)
+        if name is None:
+            _exporter = False
+        else:
+            cls = EXPORTERS[name] if name in EXPORTERS else import_string(name)
+            _exporter = cls(**{k.lower(): v for k, v in config.items()})
+    return _exporter or None
+
+
+def _reset_exporter(setting, **kwargs):
+    global _exporter
+    if setting == 'ANNOUNCEMENTS_TRACING':
+        _exporter = None
+
+
+setting_changed.connect(_reset_exporter)
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def current_span():
+    stack = _stack()
+    return stack[-1] if stack else null_span
+
+
+@contextmanager
+def span(name, **attributes):
+    exporter = get_exporter()
+    if exporter is None:
+        yield null_span
+        return
+
+    stack = _stack()
+    parent = stack[-1] if stack else None
+    s = Span(
+        name,
+        parent.trace_id if parent else uuid4().hex,
+        parent.span_id if parent else None,
+        {k: v for k, v in attributes.items() if v is not None}
+    )
+    stack.append(s)
+    try:
+        if isinstance(exporter, OpenTelemetryExporter):
+            with exporter.tracer.start_as_current_span(name, attributes=s.attributes) as otel_span:
+                s._otel_span = otel_span
+                yield s
+        else:
+            yield s
+    except Exception as e:
+        s.error = repr(e)
+        raise
+    finally:
+        s.finish()
+        stack.pop()
+        exporter.export(s)
+
+
+def traced(name=None, attributes=None):
+    # attributes is called with the wrapped function's arguments by name, defaults included, and returns span
+    # attributes. It is only passed the arguments it names, unless it takes **kwargs, so the function can gain
+    # parameters without its attributes changing
+    def decorator(func):
+        span_name = name or '%s.%s' % (func.__module__.rsplit('.', 1)[-1], func.__name__)
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if get_exporter() is None:
+                return func(*args, **kwargs)
+            with span(span_name, **(_call_attributes(attributes, signature, args, kwargs) if attributes else {})):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _call_attributes(attributes, signature, args, kwargs):
+    bound = signature.bind(*args, **kwargs)
+    bound.apply_defaults()
+    arguments = dict(bound.arguments)
+    for parameter in signature.parameters.values():
+        if parameter.kind == parameter.VAR_KEYWORD:
+            arguments.update(arguments.pop(parameter.name))
+        elif parameter.kind == parameter.VAR_POSITIONAL:
+            arguments.pop(parameter.name)
+    accepted = inspect.signature(attributes).parameters
+    if not any(p.kind == p.VAR_KEYWORD for p in accepted.values()):
+        arguments = {k: v for k, v in arguments.items() if k in accepted}
+    return attributes(**arguments)
+
+
+def request_attributes(request, pk=None, **kwargs):
+    return {
+        'user_id': getattr(request.user, 'pk', None),
+        'announcement_id': pk,
+        'method': request.method,
+    }
@@ -1,20 +1,35 @@
+import django
+from django.conf import settings
 from django.conf.urls import url
+from django.core.exceptions import ImproperlyConfigured
 
 from .views_json_api import visible, count_unread, mark_read, mark_unread, master_courses, scheduled_courses
-from .views_json_api import scheduled_course_groups, announcements, get, add, update, delete
+from .views_json_api import scheduled_course_groups, announcements, get, add, update, delete, stream, events, sync
+from .views_json_api import email_progress, preview, batch
+
+if getattr(settings, 'ANNOUNCEMENTS_ASYNC_VIEWS', False):
+    if django.VERSION < (3, 1):
+        raise ImproperlyConfigured('ANNOUNCEMENTS_ASYNC_VIEWS needs Django 3.1 or later to serve async views')
+    from .views_async import visible, count_unread, mark_read, mark_unread  # noqa: F811
 
 app_name = 'Announcements API'
 urlpatterns = [
     url(r'^$', announcements, name='announcements'),
     url(r'^(?P<pk>[0-9]+)$', get, name='get'),
     url(r'^add/$', add, name='add'),
+    url(r'^preview/$', preview, name='preview'),
     url(r'^update/(?P<pk>[0-9]+)$', update, name='update'),
     url(r'^delete/(?P<pk>[0-9]+)$', delete, name='delete'),
+    url(r'^emails/(?P<pk>[0-9]+)$', email_progress, name='email_progress'),
     url(r'^visible/$', visible, name='visible'),
     url(r'^count/unread/$', count_unread, name='count_unread'),
+    url(r'^sync/$', sync, name='sync'),
     url(r'^mark/read/(?P<pk>[0-9]+)$', mark_read, name='mark_read'),
     url(r'^mark/unread/(?P<pk>[0-9]+)$', mark_unread, name='mark_unread'),
     url(r'^masters/$', master_courses, name='master_courses'),
     url(r'^scheduleds/$', scheduled_courses, name='scheduled_courses'),
     url(r'^groups/$', scheduled_course_groups, name='scheduled_course_groups'),
+    url(r'^stream/$', stream, name='stream'),
+    url(r'^events/$', events, name='events'),
+    url(r'^batch/$', batch, name='batch'),
 ]
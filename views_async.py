@@ -0,0 +1,93 @@
+from django.http import HttpResponse, HttpResponseNotAllowed, JsonResponse
+
+from rest_framework.exceptions import APIException, NotAuthenticated, PermissionDenied
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+from rest_framework.status import HTTP_201_CREATED, HTTP_204_NO_CONTENT
+from rest_framework.utils.encoders import JSONEncoder
+
+from .routers import reads_from_replica, pin_to_primary
+from .serializers import UserAnnouncementSerializer
+from .domain import amark_announcement_read_for_user, amark_announcement_unread_for_user, run_in_thread_pool
+from .tracing import span
+from .views_json_api import visible_data, count_unread_data
+
+
+# async variants of the user-facing views in views_json_api, for Django 3.1+ under ASGI. DRF views cannot be
+# async, so authentication and permissions are applied here the way @api_view would, and as view decorators
+# only wrap sync views before Django 5.0 the csrf exemption and method checks are done by hand. visible and
+# count_unread build their responses with the same functions as the sync views, so share their cache
+
+
+async def visible(request):
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    user, error = await run_in_thread_pool(_authenticate, request)
+    if error is not None:
+        return error
+    with reads_from_replica(user):
+        try:
+            data = await run_in_thread_pool(_traced, 'views_async.visible', request, user, visible_data, request.GET)
+        except APIException as e:
+            return _json({'detail': e.detail}, status=e.status_code)
+    return _json(data)
+
+
+async def count_unread(request):
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    user, error = await run_in_thread_pool(_authenticate, request)
+    if error is not None:
+        return error
+    with reads_from_replica(user):
+        data = await run_in_thread_pool(_traced, 'views_async.count_unread', request, user, count_unread_data)
+    return _json(data)
+
+
+async def mark_read(request, pk):
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    user, error = await run_in_thread_pool(_authenticate, request)
+    if error is not None:
+        return error
+    announcement = await amark_announcement_read_for_user(int(pk), user)
+    pin_to_primary(user)
+    return _json(UserAnnouncementSerializer(announcement).data, status=HTTP_201_CREATED)
+
+
+async def mark_unread(request, pk):
+    if request.method != 'DELETE':
+        return HttpResponseNotAllowed(['DELETE'])
+    user, error = await run_in_thread_pool(_authenticate, request)
+    if error is not None:
+        return error
+    await amark_announcement_unread_for_user(int(pk), user)
+    pin_to_primary(user)
+    return HttpResponse(status=HTTP_204_NO_CONTENT)
+
+
+# SessionAuthentication enforces csrf itself
+visible.csrf_exempt = count_unread.csrf_exempt = mark_read.csrf_exempt = mark_unread.csrf_exempt = True
+
+
+def _traced(name, request, user, build, *args):
+    # in the thread pool, so the span and those of the calls it makes are on the same thread
+    with span(name, user_id=user.pk, method=request.method):
+        return build(user, *args)
+
+
+def _authenticate(request):
+    # runs in the thread pool, sessions and tokens are looked up in the database
+    drf_request = Request(request, authenticators=[a() for a in api_settings.DEFAULT_AUTHENTICATION_CLASSES])
+    try:
+        user = drf_request.user
+        for permission in api_settings.DEFAULT_PERMISSION_CLASSES:
+            if not permission().has_permission(drf_request, None):
+                raise NotAuthenticated() if not user.is_authenticated else PermissionDenied()
+    except APIException as e:
+        return None, _json({'detail': e.detail}, status=e.status_code)
+    return user, None
+
+
+def _json(data, status=200):
+    return JsonResponse(data, encoder=JSONEncoder, safe=False, status=status)
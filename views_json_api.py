@@ -1,9 +1,24 @@
+import asyncio
+import json
+from datetime import datetime, timezone
+from functools import partial
+from io import BytesIO
+from itertools import groupby
+from threading import Lock
+from time import monotonic
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIRequest
+from django.http import HttpResponse, StreamingHttpResponse
+from django.urls import Resolver404, resolve
 from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
 from django.views.decorators.csrf import csrf_exempt
 
-from rest_framework.status import HTTP_200_OK, HTTP_201_CREATED, HTTP_204_NO_CONTENT, HTTP_404_NOT_FOUND
-from rest_framework.decorators import api_view, authentication_classes, permission_classes
+from rest_framework.status import (HTTP_200_OK, HTTP_201_CREATED, HTTP_204_NO_CONTENT, HTTP_404_NOT_FOUND,
+                                   HTTP_503_SERVICE_UNAVAILABLE)
+from rest_framework.exceptions import ValidationError
+from rest_framework.decorators import api_view, authentication_classes, permission_classes, renderer_classes
 from rest_framework.authentication import SessionAuthentication, TokenAuthentication
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
@@ -13,11 +28,22 @@ from .domain import (add_announcement, update_announcement, get_master_courses,
                      get_scheduled_course_groups, get_visible_announcements_for_user,
                      get_announcements_marked_read_for_user, mark_announcement_read_for_user,
                      mark_announcement_unread_for_user, get_announcements,
-                     get_announcement, get_announcement_options, delete_announcement)
+                     get_announcement, get_announcement_options, delete_announcement,
+                     get_announcement_events_for_user, get_announcement_changes_for_user, get_announcement_reach,
+                     get_cached_for_user, get_visible_announcements_page_for_user, map_in_thread_pool,
+                     get_user_context)
+from .caching import request_memo
+from .emails import get_email_outbox_progress
+from .pubsub import get_broker, announcements_channel, user_channel, encode_cursor, decode_cursor
+from .renderers import EventStreamRenderer
+from .routers import replica_reads, pins_to_primary
+from .tracing import traced, request_attributes, current_span
 
 
 @api_view(['POST'])
 @csrf_exempt
+@traced(attributes=request_attributes)
+@pins_to_primary
 def add(request):
     announcement_serializer = AnnouncementSerializer(
         data=request.data,
@@ -33,7 +59,18 @@ def add(request):
     )
 
 
+@api_view(['POST'])
+@traced(attributes=request_attributes)
+def preview(request):
+    return Response(get_announcement_reach(
+        request.data.get('audience'),
+        request.data.get('programme') or None
+    ))
+
+
 @api_view(['PUT'])
+@traced(attributes=request_attributes)
+@pins_to_primary
 def update(request, pk):
     announcement = get_announcement(pk)
     if announcement is None:
@@ -57,6 +94,8 @@ def update(request, pk):
 
 
 @api_view(['DELETE'])
+@traced(attributes=request_attributes)
+@pins_to_primary
 def delete(request, pk):
     announcement = get_announcement(pk)
     if announcement is None:
@@ -72,6 +111,14 @@ def delete(request, pk):
 
 
 @api_view(['GET'])
+@traced(attributes=request_attributes)
+def email_progress(request, pk):
+    return Response(get_email_outbox_progress(pk))
+
+
+@api_view(['GET'])
+@traced(attributes=request_attributes)
+@replica_reads
 def get(request, pk):
     announcement = get_announcement(pk)
     if announcement is None:
@@ -88,6 +135,8 @@ def get(request, pk):
 
 
 @api_view(['POST'])
+@traced(attributes=request_attributes)
+@replica_reads
 def master_courses(request):
     return Response(
         get_master_courses(request.data),
@@ -96,6 +145,8 @@ def master_courses(request):
 
 
 @api_view(['POST'])
+@traced(attributes=request_attributes)
+@replica_reads
 def scheduled_courses(request):
     return Response(
         get_scheduled_courses(request.data),
@@ -104,6 +155,8 @@ def scheduled_courses(request):
 
 
 @api_view(['POST'])
+@traced(attributes=request_attributes)
+@replica_reads
 def scheduled_course_groups(request):
     return Response(
         get_scheduled_course_groups(request.data),
@@ -112,32 +165,86 @@ def scheduled_course_groups(request):
 
 
 @api_view(['GET'])
+@traced(attributes=request_attributes)
+@replica_reads
 def visible(request):
-    visible_announcements = list(get_visible_announcements_for_user(request.user, now()))
-    user_announcements = list(get_announcements_marked_read_for_user(
-        visible_announcements,
-        request.user
-    ))
-    serializer = UserAnnouncementSerializer(
-        user_announcements,
-        many=True
-    )
-    return Response(serializer.data)
+    return Response(visible_data(request.user, request.query_params))
 
 
 @api_view(['GET'])
+@traced(attributes=request_attributes)
+@replica_reads
 def count_unread(request):
-    visible_announcements = list(get_visible_announcements_for_user(request.user, now()))
+    return Response(count_unread_data(request.user))
+
+
+def visible_data(user, params):
+    # shared with the async view. Paginated when asked for a cursor, or page_size, else the whole list as before
+    if 'cursor' in params or 'page_size' in params:
+        page = get_visible_announcements_page_for_user(
+            user,
+            now(),
+            params.get('cursor'),
+            params.get('page_size') or 30,
+            context=get_user_context(user)
+        )
+        current_span().set(rows=len(page['announcements']))
+        return {
+            'announcements': UserAnnouncementSerializer(page['announcements'], many=True).data,
+            'next': page['next'],
+        }
+
+    def build():
+        context = get_user_context(user)
+        visible_announcements = list(get_visible_announcements_for_user(
+            user,
+            current_datetime,
+            context=context
+        ))
+        user_announcements = list(get_announcements_marked_read_for_user(
+            visible_announcements,
+            user,
+            context=context
+        ))
+        serializer = UserAnnouncementSerializer(
+            user_announcements,
+            many=True
+        )
+        return serializer.data
+
+    current_datetime = now()
+    data = get_cached_for_user(user, 'visible', current_datetime, build)
+    current_span().set(rows=len(data))
+    return data
+
+
+def count_unread_data(user):
+    # shared with the async view
+    context = get_user_context(user)
+    visible_announcements = list(get_visible_announcements_for_user(user, now(), context=context))
     user_announcements = list(get_announcements_marked_read_for_user(
         visible_announcements,
-        request.user
+        user,
+        with_text=False,
+        context=context
     ))
-    return Response({
+    return {
         'announcements': len(list(filter(lambda ua: ua['marked_read'] is None, user_announcements)))
-    })
+    }
+
+
+@api_view(['GET'])
+@traced(attributes=request_attributes)
+@replica_reads
+def sync(request):
+    changes = get_announcement_changes_for_user(request.user, request.query_params.get('token'), now())
+    changes['announcements'] = UserAnnouncementSerializer(changes['announcements'], many=True).data
+    return Response(changes)
 
 
 @api_view(['POST'])
+@traced(attributes=request_attributes)
+@pins_to_primary
 def mark_read(request, pk):
     announcement = mark_announcement_read_for_user(pk, request.user)
     serializer = UserAnnouncementSerializer(announcement)
@@ -148,6 +255,8 @@ def mark_read(request, pk):
 
 
 @api_view(['DELETE'])
+@traced(attributes=request_attributes)
+@pins_to_primary
 def mark_unread(request, pk):
     mark_announcement_unread_for_user(pk, request.user)
     return Response(
@@ -156,6 +265,8 @@ def mark_unread(request, pk):
 
 
 @api_view(['GET'])
+@traced(attributes=request_attributes)
+@replica_reads
 def announcements(request):
     params = request.query_params
     q = params.get('q', '')
@@ -163,12 +274,200 @@ def announcements(request):
     order = params.get('order', '')
     per_page = params.get('per_page', None)
     page = params.get('page', None)
+    include_archived = params.get('archived', '') in ('1', 'true')
 
     limitnum = int(per_page) if per_page else None
     limitfrom = (int(page) - 1) * limitnum if page and limitnum else None
 
-    announcements, total = get_announcements(column, order, q, limitfrom, limitnum)
+    announcements, total = get_announcements(column, order, q, limitfrom, limitnum, include_archived)
+    current_span().set(rows=total)
     return Response({
         'announcements': AnnouncementSerializer(many=True, instance=announcements).data,
         'total': total
     })
+
+
+@api_view(['GET'])
+@renderer_classes([EventStreamRenderer])
+@permission_classes([IsAuthenticated])
+@traced(attributes=request_attributes)
+def stream(request):
+    channels, cursors, checked_from = _event_cursor(request, request.META.get('HTTP_LAST_EVENT_ID'))
+    # each stream holds a worker thread, so past ANNOUNCEMENTS_STREAM_MAX_CONNECTIONS per process clients are turned
+    # away, and EventSource gives up on the 503 for the events/ long poll
+    if not _open_stream():
+        response = HttpResponse(status=HTTP_503_SERVICE_UNAVAILABLE)
+        response['Retry-After'] = getattr(settings, 'ANNOUNCEMENTS_STREAM_HEARTBEAT', 15)
+        return response
+    response = StreamingHttpResponse(
+        _ClosingStream(_event_stream(request.user, channels, cursors, checked_from), _close_stream),
+        content_type=EventStreamRenderer.media_type
+    )
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@api_view(['GET'])
+@traced(attributes=request_attributes)
+def events(request):
+    # long-poll fallback for clients that cannot use the event stream
+    channels, cursors, checked_from = _event_cursor(request, request.query_params.get('cursor'))
+    if checked_from is None:
+        return Response({
+            'events': [],
+            'cursor': _encode_event_cursor(cursors, channels, now())
+        })
+
+    new_events, cursors = get_broker().wait(cursors, getattr(settings, 'ANNOUNCEMENTS_LONG_POLL_TIMEOUT', 25))
+    current_datetime = now()
+    return Response({
+        'events': get_announcement_events_for_user(request.user, new_events, checked_from, current_datetime),
+        'cursor': _encode_event_cursor(cursors, channels, current_datetime)
+    })
+
+
+@api_view(['POST'])
+@traced(attributes=request_attributes)
+def batch(request):
+    # {"requests": [{"method": "GET", "path": "visible/?page_size=10", "body": {...}}, ...]} run against the routes
+    # of this API as the batch's user, sharing what they memoise; consecutive reads run concurrently
+    specs = request.data.get('requests') if isinstance(request.data, dict) else None
+    if not isinstance(specs, list) or not all(isinstance(spec, dict) for spec in specs):
+        raise ValidationError(_('Expected a list of requests'))
+    if len(specs) > getattr(settings, 'ANNOUNCEMENTS_BATCH_MAX_REQUESTS', 20):
+        raise ValidationError(_('Too many requests in one batch'))
+
+    resolved = [_resolve_batched(spec) for spec in specs]
+    responses = []
+    with request_memo():
+        for is_read, group in groupby(resolved, key=lambda r: r[0] is not None and r[0].url_name in batch_read_views):
+            group = list(group)
+            if is_read and len(group) > 1 and getattr(settings, 'ANNOUNCEMENTS_BATCH_CONCURRENT', True):
+                responses.extend(map_in_thread_pool(partial(_run_batched, request), group))
+            else:
+                responses.extend(_run_batched(request, r) for r in group)
+    current_span().set(rows=len(responses))
+    return Response({'responses': responses})
+
+
+# the views a batch may run concurrently, as they only read
+batch_read_views = ('announcements', 'get', 'visible', 'count_unread', 'sync', 'email_progress', 'preview',
+                    'master_courses', 'scheduled_courses', 'scheduled_course_groups')
+
+# streaming and batching themselves cannot be batched
+unbatchable_views = ('stream', 'events', 'batch')
+
+# the streams this process holds open
+_streams = {'open': 0}
+_streams_lock = Lock()
+
+
+def _resolve_batched(spec):
+    from . import urls_json_api
+
+    path, _sep, query = str(spec.get('path', '')).partition('?')
+    try:
+        match = resolve('/' + path.lstrip('/'), urlconf=urls_json_api)
+    except Resolver404:
+        return None, spec
+    if match.url_name in unbatchable_views:
+        return None, spec
+    # the async views are routed to when ANNOUNCEMENTS_ASYNC_VIEWS is set, batches run the sync ones
+    if asyncio.iscoroutinefunction(match.func):
+        match.func = globals()[match.func.__name__]
+    return match, spec
+
+
+def _run_batched(request, resolved):
+    match, spec = resolved
+    if match is None:
+        return {'status': HTTP_404_NOT_FOUND, 'body': {'detail': _('Not found.')}}
+
+    # a request of its own for the view, already authenticated as the batch's user
+    method = str(spec.get('method', 'GET')).upper()
+    path, _sep, query = str(spec.get('path', '')).partition('?')
+    body = json.dumps(spec.get('body', {})).encode()
+    environ = dict(request.META)
+    environ.update({
+        'REQUEST_METHOD': method,
+        'PATH_INFO': request.path_info.rsplit('batch/', 1)[0] + path.lstrip('/'),
+        'QUERY_STRING': query,
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': BytesIO(body),
+    })
+    sub_request = WSGIRequest(environ)
+    sub_request._force_auth_user = request.user
+    sub_request._force_auth_token = request.auth
+
+    response = match.func(sub_request, *match.args, **match.kwargs)
+    return {'status': response.status_code, 'body': response.data}
+
+
+def _event_stream(user, channels, cursors, checked_from):
+    broker = get_broker()
+    heartbeat = getattr(settings, 'ANNOUNCEMENTS_STREAM_HEARTBEAT', 15)
+    deadline = monotonic() + getattr(settings, 'ANNOUNCEMENTS_STREAM_TIMEOUT', 300)
+    checked_from = checked_from or now()
+
+    # the client reconnects with Last-Event-ID once the stream times out
+    yield 'retry: %d\n\n' % (heartbeat * 1000)
+    while monotonic() < deadline:
+        new_events, cursors = broker.wait(cursors, heartbeat)
+        current_datetime = now()
+        user_events = get_announcement_events_for_user(user, new_events, checked_from, current_datetime)
+        checked_from = current_datetime
+        cursor = _encode_event_cursor(cursors, channels, current_datetime)
+        for event in user_events:
+            yield 'id: %s\nevent: %s\ndata: %s\n\n' % (cursor, event['type'], json.dumps(event))
+        if not user_events:
+            yield 'id: %s\n: heartbeat\n\n' % cursor
+
+
+class _ClosingStream:
+
+    # calls on_close once when the stream ends or the response is closed, whether or not it was ever iterated
+    def __init__(self, events, on_close):
+        self._events = events
+        self._on_close = on_close
+
+    def __iter__(self):
+        try:
+            yield from self._events
+        finally:
+            self.close()
+
+    def close(self):
+        self._events.close()
+        if self._on_close is not None:
+            self._on_close, on_close = None, self._on_close
+            on_close()
+
+
+def _open_stream():
+    with _streams_lock:
+        if _streams['open'] >= getattr(settings, 'ANNOUNCEMENTS_STREAM_MAX_CONNECTIONS', 10):
+            return False
+        _streams['open'] += 1
+        return True
+
+
+def _close_stream():
+    with _streams_lock:
+        _streams['open'] -= 1
+
+
+def _event_cursor(request, value):
+    # cursors look like <announcements seq>.<user seq>-<last checked timestamp>
+    channels = [announcements_channel, user_channel(request.user.pk)]
+    seqs, _sep, checked_from = (value or '').partition('-')
+    cursors = decode_cursor(seqs, channels)
+    if cursors is None or not checked_from.isdigit():
+        return channels, get_broker().cursors(channels), None
+    return channels, cursors, datetime.fromtimestamp(int(checked_from), timezone.utc)
+
+
+def _encode_event_cursor(cursors, channels, checked_from):
+    return '%s-%d' % (encode_cursor(cursors, channels), checked_from.timestamp())
+
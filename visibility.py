@@ -0,0 +1,114 @@
+from collections import defaultdict
+
+from django.contrib.auth import get_user_model
+
+from programmes.models import UserProgramme
+from .domain import audience_group_names
+from .models import Announcement
+from .tracing import traced, current_span
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# bounds the number of query parameters and the size of the user x announcement matrix
+user_chunk_size = 900
+
+
+@traced(attributes=lambda user_ids, current_datetime, urgent_only=False: {'urgent_only': urgent_only})
+def get_visible_announcement_ids_for_users(user_ids, current_datetime, urgent_only=False):
+    # {user_id: [announcement ids in visible order]} for the given users, or all users when user_ids is None,
+    # leaving out users who can see nothing
+    announcements = Announcement \
+        .objects \
+        .filter(visible_from__lte=current_datetime, visible_to__gte=current_datetime, deleted__isnull=True) \
+        .order_by('-is_urgent', '-visible_from')
+    if urgent_only:
+        announcements = announcements.filter(is_urgent=True)
+    announcements = list(announcements.values_list('id', 'audience', 'programme_id'))
+
+    if user_ids is None:
+        user_ids = get_user_model().objects.order_by('id').values_list('id', flat=True)
+    user_ids = list(user_ids)
+
+    visible = {}
+    if announcements:
+        evaluate = _evaluate_with_numpy if np is not None else _evaluate_with_sets
+        for i in range(0, len(user_ids), user_chunk_size):
+            visible.update(evaluate(announcements, user_ids[i:i + user_chunk_size]))
+
+    current_span().set(rows=len(visible), announcements=len(announcements), users=len(user_ids))
+    return visible
+
+
+def _memberships(announcements, user_ids):
+    group_names = sorted(set(g for _id, audience, _p in announcements for g in audience_group_names(audience)))
+    programme_ids = sorted(set(p for _id, _a, p in announcements if p is not None))
+
+    user_groups = get_user_model().groups.through.objects \
+        .filter(user_id__in=user_ids, group__name__in=group_names) \
+        .values_list('user_id', 'group__name') if group_names else []
+    user_programmes = UserProgramme.objects \
+        .filter(user_id__in=user_ids, programme_id__in=programme_ids) \
+        .values_list('user_id', 'programme_id') if programme_ids else []
+
+    return group_names, programme_ids, list(user_groups), list(user_programmes)
+
+
+def _evaluate_with_sets(announcements, user_ids):
+    group_names, programme_ids, user_groups, user_programmes = _memberships(announcements, user_ids)
+
+    group_members = defaultdict(set)
+    for user_id, name in user_groups:
+        group_members[name].add(user_id)
+    programme_members = defaultdict(set)
+    for user_id, programme_id in user_programmes:
+        programme_members[programme_id].add(user_id)
+    everyone = set(user_ids)
+
+    visible = defaultdict(list)
+    for announcement_id, audience, programme_id in announcements:
+        groups = audience_group_names(audience)
+        users = set().union(*(group_members[g] for g in groups)) if groups else everyone
+        if programme_id is not None:
+            users = users & programme_members[programme_id]
+        for user_id in users:
+            visible[user_id].append(announcement_id)
+    return visible
+
+
+def _evaluate_with_numpy(announcements, user_ids):
+    group_names, programme_ids, user_groups, user_programmes = _memberships(announcements, user_ids)
+    user_index = {user_id: i for i, user_id in enumerate(user_ids)}
+    group_index = {name: i for i, name in enumerate(group_names)}
+    programme_index = {programme_id: i for i, programme_id in enumerate(programme_ids)}
+
+    # users x groups and users x programmes membership matrices
+    in_group = np.zeros((len(user_ids), len(group_names)), dtype=np.uint8)
+    for user_id, name in user_groups:
+        in_group[user_index[user_id], group_index[name]] = 1
+    in_programme = np.zeros((len(user_ids), len(programme_ids)), dtype=bool)
+    for user_id, programme_id in user_programmes:
+        in_programme[user_index[user_id], programme_index[programme_id]] = True
+
+    # announcements x groups audience matrix, announcements for everyone have no groups
+    audience = np.zeros((len(announcements), len(group_names)), dtype=np.uint8)
+    for i, (_id, a, _p) in enumerate(announcements):
+        for name in audience_group_names(a):
+            audience[i, group_index[name]] = 1
+    for_everyone = audience.sum(axis=1) == 0
+
+    # users x announcements
+    visible = (in_group @ audience.T > 0) | for_everyone
+    programme_columns = np.array([programme_index.get(p, -1) for _id, _a, p in announcements])
+    restricted = programme_columns >= 0
+    visible[:, restricted] &= in_programme[:, programme_columns[restricted]]
+
+    announcement_ids = [a[0] for a in announcements]
+    rows, columns = np.nonzero(visible)
+    result = defaultdict(list)
+    for row, column in zip(rows.tolist(), columns.tolist()):
+        result[user_ids[row]].append(announcement_ids[column])
+    return result